@@ -85,6 +85,8 @@ class Config:
                 group.addOption("m", self.getMachineLabel(), self.getMachineNameForDisplay(machine))
                 group.addOption("cp", "Times to run", 1, minimum=1, maximum=10000,
                                 description="Set this to some number larger than 1 to run the same test multiple times, for example to try to catch indeterminism in the system under test")
+                group.addOption("j", "Tests to run in parallel", 1, minimum=1, maximum=1000,
+                                description="Set this to some number larger than 1 to run that many tests at once in this process, when not using a grid")
                 if recordsUseCases:
                     group.addOption("delay", "Replay pause (sec)", 0.0,
                                     description="How long to wait, in seconds, between replaying each GUI action in the usecase file")
@@ -998,6 +1000,7 @@ class Config:
             raise plugins.TextTestError(
                 "Must provide '-b' argument to identify the batch session when running with '-coll' to collect batch run data")
         self.optionIntValue("delay", optionType=float)  # throws if it's not numeric...
+        self.optionIntValue("j")  # likewise
         if batchSession is not None and "coll" not in self.optionMap:
             batchFilter = batch.BatchVersionFilter(batchSession)
             batchFilter.verifyVersions(suite.app)
@@ -1412,6 +1415,8 @@ class Config:
                              "default": 0.0}, "Which relative tolerance to apply when comparing floating point values")
         app.setConfigDefault("floating_point_split", {
                              "default": ''}, "Separator to split at when comparing floating point values")
+        app.setConfigDefault("floating_point_alignment", {
+                             "default": ''}, "How to align lines with inserted or removed lines before comparing floating point values ('difflib' or 'patience'). Compares line by line if empty")
 
         app.setConfigDefault("collate_file", self.getDefaultCollations(),
                              "Mapping of result file names to paths to collect them from")
@@ -1518,6 +1523,10 @@ class Config:
                              "Username to use when logging in to bug systems defined in bug_system_location")
         app.setConfigDefault("bug_system_password", {},
                              "Password to use when logging in to bug systems defined in bug_system_location")
+        app.setConfigDefault("bug_system_cache_time", {"default": 600},
+                             "How many seconds information fetched from bug systems can be reused for")
+        app.setConfigDefault("bug_system_cache_file", "",
+                             "File to keep information fetched from bug systems in, so that other runs can reuse it")
         app.setConfigDefault("batch_jenkins_marked_artefacts", {
                              "default": []}, "Artefacts to highlight in the report when they are updated")
         app.setConfigDefault("batch_jenkins_archive_file_pattern", {
@@ -1673,6 +1682,16 @@ class Config:
                              "default": []}, "Versions to be run in addition to the one specified, for particular batch sessions")
         app.setConfigDefault("save_filtered_file_stems", [],
                              "Files where the filtered version should be saved rather than the SUT output")
+        app.setConfigDefault("filter_cache_directory", "",
+                             "Directory in which to cache filtered result files between runs, so that unchanged files need not be filtered again")
+        app.setConfigDefault("max_sandbox_backups", 0,
+                             "How many earlier runs of a test to keep beside its sandbox when it is rerun. 0 means keep them all")
+        app.setConfigDefault("schedule_by_duration", 0,
+                             "Start the tests expected to take longest first, rather than in test suite order")
+        app.setConfigDefault("test_duration_file", "",
+                             "File to record how long each test took in, for schedule_by_duration to use where there is no performance file")
+        app.setConfigDefault("unknown_test_duration", -1,
+                             "Duration in seconds for schedule_by_duration to expect from tests it knows nothing about. Negative means start them first.")
         # Applies to any interface...
         app.setConfigDefault("auto_sort_test_suites", 0,
                              "Automatically sort test suites in alphabetical order. 1 means sort in ascending order, -1 means sort in descending order.")
@@ -3,9 +3,10 @@ import sys
 import logging
 import types
 from texttestlib import plugins
+from .scheduling import TestScheduler
 from queue import Queue, Empty
 from collections import OrderedDict
-from threading import Lock
+from threading import Lock, RLock, Thread
 
 plugins.addCategory("cancelled", "cancelled", "were cancelled before starting")
 
@@ -32,19 +33,37 @@ class BaseActionRunner(plugins.Responder, plugins.Observable):
         self.killSignal = None
         self.diag = diag
         self.lockDiag = logging.getLogger("locks")
+        self.scheduler = self.makeScheduler()
+
+    def makeScheduler(self):
+        return TestScheduler()
 
     def notifyAdd(self, test, initial):
         if test.classId() == "test-case":
-            self.diag.info("Adding test " + test.uniqueName)
-            self.addTest(test)
+            if initial and self.scheduler.schedules(test):
+                # Hold on to it until we know about all the tests and can decide the order
+                self.diag.info("Scheduling test " + test.uniqueName)
+                self.scheduler.addTest(test)
+            else:
+                self.diag.info("Adding test " + test.uniqueName)
+                self.addTest(test)
 
     def addTest(self, test):
         self.testQueue.put(test)
 
+    def addScheduledTests(self):
+        for test in self.scheduler.getTestsInOrder():
+            self.diag.info("Adding scheduled test " + test.uniqueName)
+            self.addTest(test)
+
     def notifyAllRead(self, *args):
+        self.addScheduledTests()
         self.diag.info("All read, adding terminator")
         self.testQueue.put(None)
 
+    def notifyLifecycleChange(self, test, state, changeDesc):
+        self.scheduler.notifyLifecycleChange(test, state, changeDesc)
+
     def notifyComplete(self, test):
         if not self.exited and "stop" in self.optionMap and test.state.hasFailed():
             self.exited = True
@@ -57,6 +76,7 @@ class BaseActionRunner(plugins.Responder, plugins.Observable):
 
     def notifyAllComplete(self):
         self.allComplete = True
+        self.scheduler.save()
 
     def notifyKill(self, test):
         self.lock.acquire()
@@ -95,10 +115,16 @@ class BaseActionRunner(plugins.Responder, plugins.Observable):
             if self.exited:
                 self.cancel(test)
                 self.diag.info("Cancelled " + desc + " " + test.uniqueName)
+                self.testNotRun(test)
             elif not test.state.isComplete():
                 self.diag.info(desc.capitalize() + " test " + test.uniqueName)
                 runMethod(test)
                 self.diag.info("Completed " + desc + " " + test.uniqueName)
+            else:
+                self.testNotRun(test)
+
+    def testNotRun(self, test):
+        pass  # for overriding in case anything is waiting for the test
 
     def getItemFromQueue(self, queue, block, replaceTerminators=False):
         try:
@@ -121,48 +147,147 @@ class BaseActionRunner(plugins.Responder, plugins.Observable):
 class ActionRunner(BaseActionRunner):
     def __init__(self, optionMap, *args):
         BaseActionRunner.__init__(self, optionMap, logging.getLogger("Action Runner"))
-        self.currentTestRunner = None
+        self.currentTestRunners = []
         self.previousTestRunner = None
         self.appRunners = OrderedDict()
+        self.workerCount = max(int(optionMap.get("j") or 1), 1)
+        # When running in parallel, we set up each suite once and tear it down when it has no tests left
+        self.testsRemaining = {}
+        self.suitesStarted = OrderedDict()
+
+    def runsInParallel(self):
+        return self.workerCount > 1
 
     def addSuite(self, suite):
         plugins.log.info("Using " + suite.app.description(includeCheckout=True))
         appRunner = ApplicationRunner(suite, self.diag)
         self.appRunners[suite.app] = appRunner
 
+    def addTest(self, test):
+        if self.runsInParallel():
+            self.lock.acquire()
+            for suite in self.findAncestors(test):
+                self.testsRemaining[suite] = self.testsRemaining.get(suite, 0) + 1
+            self.lock.release()
+        BaseActionRunner.addTest(self, test)
+
+    def findAncestors(self, test):
+        suites = []
+        currCheck = test.parent
+        while currCheck is not None:
+            suites.append(currCheck)
+            currCheck = currCheck.parent
+        return suites
+
     def notifyAllReadAndNotified(self):
         # kicks off processing. Don't use notifyAllRead as we end up running all the tests before
         # everyone's been notified of the reading.
         self.runAllTests()
 
+    def runAllTests(self):
+        if self.runsInParallel():
+            self.diag.info("Running tests with " + str(self.workerCount) + " workers")
+            workers = [Thread(target=self.runQueue, args=(self.getTestForParallelRun, self.runTest, "running"))
+                       for _ in range(self.workerCount)]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            # Anything left over, innermost first
+            self.tearDownStartedSuites(reversed(list(self.suitesStarted.keys())))
+            self.cleanup()
+            self.diag.info("Terminating")
+        else:
+            BaseActionRunner.runAllTests(self)
+
+    def getTestForParallelRun(self, block=True):
+        # Leave the terminator in the queue so every worker gets to see it
+        return self.getItemFromQueue(self.testQueue, block=block, replaceTerminators=True)
+
+    def findCurrentTestRunner(self, test):
+        for testRunner in self.currentTestRunners:
+            if testRunner.test is test:
+                return testRunner
+
     def notifyRerun(self, test):
-        if self.currentTestRunner and self.currentTestRunner.test is test:
+        testRunner = self.findCurrentTestRunner(test)
+        if testRunner:
             self.diag.info("Got rerun notification for " + repr(test) + ", resetting actions")
-            self.currentTestRunner.resetActionSequence()
+            testRunner.resetActionSequence()
 
     def runTest(self, test):
         # We have the lock coming in to here...
         appRunner = self.appRunners.get(test.app)
         if appRunner:
             self.lock.acquire()
-            self.currentTestRunner = TestRunner(test, appRunner, self.diag, self.exited, self.killSignal)
+            testRunner = self.makeTestRunner(test, appRunner)
+            self.currentTestRunners.append(testRunner)
+            if self.runsInParallel():
+                self.markSuitesStarted(testRunner)
             self.lock.release()
 
-            self.currentTestRunner.performActions(self.previousTestRunner)
-            self.previousTestRunner = self.currentTestRunner
+            if self.runsInParallel():
+                testRunner.performActionSequence()
+            else:
+                testRunner.performActions(self.previousTestRunner)
+                self.previousTestRunner = testRunner
 
             self.lock.acquire()
-            self.currentTestRunner = None
+            self.currentTestRunners.remove(testRunner)
             self.notifyComplete(test)
+            suitesFinished = self.markTestFinished(test) if self.runsInParallel() else []
+            self.lock.release()
+            self.tearDownStartedSuites(suitesFinished)
+
+    def makeTestRunner(self, test, appRunner):
+        return TestRunner(test, appRunner, self.diag, self.exited, self.killSignal)
+
+    def testNotRun(self, test):
+        # Its suites shouldn't wait for it before being torn down
+        if self.runsInParallel():
+            self.lock.acquire()
+            suitesFinished = self.markTestFinished(test)
             self.lock.release()
+            self.tearDownStartedSuites(suitesFinished)
+
+    def markSuitesStarted(self, testRunner):
+        # Called with the lock. Earlier suites are set up first
+        suites = self.findAncestors(testRunner.test)
+        suites.reverse()
+        for suite in suites:
+            if suite not in self.suitesStarted:
+                self.suitesStarted[suite] = testRunner.appRunner
+                testRunner.appRunner.markForSetUp(suite)
+
+    def markTestFinished(self, test):
+        # Called with the lock. Returns the suites that have nothing left to run, innermost first
+        suitesFinished = []
+        for suite in self.findAncestors(test):
+            self.testsRemaining[suite] = self.testsRemaining.get(suite, 1) - 1
+            if self.testsRemaining[suite] <= 0 and suite in self.suitesStarted:
+                suitesFinished.append(suite)
+        return suitesFinished
+
+    def tearDownStartedSuites(self, suites):
+        for suite in suites:
+            self.lock.acquire()
+            appRunner = self.suitesStarted.pop(suite, None)
+            self.lock.release()
+            if appRunner:
+                try:
+                    appRunner.tearDownSuite(suite)
+                except Exception:
+                    sys.stderr.write("Exception thrown tearing down " + repr(suite) + " :\n")
+                    plugins.printException()
 
     def killTests(self):
-        if self.currentTestRunner:
-            self.currentTestRunner.kill(self.killSignal)
+        for testRunner in self.currentTestRunners:
+            testRunner.kill(self.killSignal)
 
     def killOrCancel(self, test):
-        if self.currentTestRunner and self.currentTestRunner.test is test:
-            self.currentTestRunner.kill()
+        testRunner = self.findCurrentTestRunner(test)
+        if testRunner:
+            testRunner.kill()
         else:
             self.cancel(test)
 
@@ -199,6 +324,8 @@ class ApplicationRunner:
         self.suitesSetUp = {}
         self.suitesToSetUp = {}
         self.diag = diag
+        # Suites are shared between tests running in parallel, so only one of them may set up or tear down at once
+        self.suiteLock = RLock()
         self.actionSequence = self.getActionSequence()
         self.setUpApplications()
 
@@ -225,11 +352,16 @@ class ApplicationRunner:
         newActions = []
         for action in self.actionSequence:
             newActions.append(action)
-        self.suitesToSetUp[suite] = newActions
+        with self.suiteLock:
+            self.suitesToSetUp[suite] = newActions
 
     def setUpSuites(self, action, test):
+        with self.suiteLock:
+            self._setUpSuites(action, test)
+
+    def _setUpSuites(self, action, test):
         if test.parent:
-            self.setUpSuites(action, test.parent)
+            self._setUpSuites(action, test.parent)
         if test.classId() == "test-suite":
             if action in self.suitesToSetUp[test]:
                 self.setUpSuite(action, test)
@@ -245,11 +377,12 @@ class ApplicationRunner:
 
     def tearDownSuite(self, suite):
         self.diag.info("Try tear down " + repr(suite))
-        actionsToTearDown = self.suitesSetUp.get(suite, [])
-        for action in actionsToTearDown:
-            self.diag.info(str(action) + " tear down " + repr(suite))
-            action.tearDownSuite(suite)
-        self.suitesSetUp[suite] = []
+        with self.suiteLock:
+            actionsToTearDown = self.suitesSetUp.get(suite, [])
+            for action in actionsToTearDown:
+                self.diag.info(str(action) + " tear down " + repr(suite))
+                action.tearDownSuite(suite)
+            self.suitesSetUp[suite] = []
 
     def getActionSequence(self):
         actionSequenceFromConfig = self.testSuite.app.getActionSequence()
@@ -314,6 +447,9 @@ class TestRunner:
             self.handleExceptions(previousTestRunner.appRunner.tearDownSuite, suite)
         for suite in setUpSuites:
             self.appRunner.markForSetUp(suite)
+        self.performActionSequence()
+
+    def performActionSequence(self):
         abandon = self.test.state.shouldAbandon()
         while len(self.actionSequence):
             action = self.actionSequence.pop(0)
@@ -13,6 +13,7 @@ from texttestlib.default.batch import testoverview
 from texttestlib import plugins
 from .summarypages import GenerateSummaryPage, GenerateGraphs  # only so they become package level entities
 from .ci import CIPlatform
+from .repositoryindex import RepositoryIndex
 from collections import OrderedDict
 from .batchutils import getBatchRunName, BatchVersionFilter, parseFileName, convertToUrl
 import subprocess
@@ -523,8 +524,8 @@ class SaveState(plugins.Responder):
 
     def saveToRepository(self, test):
         testRepository = self.repositories[test.app]
-        targetDir = os.path.join(testRepository, test.app.name, getVersionName(test.app, self.allApps),
-                                 test.getRelPath())
+        versionDir = os.path.join(testRepository, test.app.name, getVersionName(test.app, self.allApps))
+        targetDir = os.path.join(versionDir, test.getRelPath())
         try:
             plugins.ensureDirectoryExists(targetDir)
         except EnvironmentError:
@@ -543,6 +544,9 @@ class SaveState(plugins.Responder):
                     shutil.copyfile(test.getStateFile(), targetFile)
                 except EnvironmentError:
                     plugins.printWarning("Could not write file at " + targetFile)
+                else:
+                    # So the report doesn't need to read the file unless it needs the details
+                    RepositoryIndex(versionDir).recordState(test.getRelPath(), self.runPostfix, test.state)
 
     def addSuite(self, suite):
         testStateRepository = getBatchRepository(suite)
@@ -0,0 +1,249 @@
+# Persistent index of a batch result repository, so that generating the historical report
+# doesn't need to walk the whole repository and re-read every succeeded_* file each time.
+# Each directory is only listed again when its modification time changes, and each succeeded_* file
+# is only read again when its size or modification time changes. So anything writing to the repository
+# (SaveState, archiving, manual cleaning) is picked up without needing to know about the index.
+# SaveState also records a summary of each teststate file it writes, so the report only needs to read
+# the state files themselves for the details of the tests that didn't succeed.
+
+import os
+import logging
+from texttestlib import plugins
+
+try:
+    import sqlite3
+except ImportError:  # pragma: no cover - some embedded Pythons leave it out
+    sqlite3 = None
+
+
+class RepositoryIndex:
+    fileName = ".texttest_repository_index.db"
+    stateFilePrefix = "teststate_"
+    successFilePrefix = "succeeded_"
+    # Increase when the tables change, any older index is then thrown away and rebuilt
+    schemaVersion = 3
+
+    def __init__(self, repository):
+        self.repository = repository
+        self.diag = logging.getLogger("Repository Index")
+        self.connection = self.connect()
+        self.fileSystemTime = None
+
+    def connect(self):
+        if sqlite3 is None:
+            return
+        path = os.path.join(self.repository, self.fileName)
+        try:
+            connection = sqlite3.connect(path)
+            self.createTables(connection)
+            return connection
+        except sqlite3.Error as e:
+            # e.g. read-only repository. Build the index in memory, which at least only walks the repository once
+            self.diag.info("Could not use index at " + path + " : " + str(e))
+            connection = sqlite3.connect(":memory:")
+            self.createTables(connection)
+            return connection
+
+    def createTables(self, connection):
+        with connection:
+            if connection.execute("PRAGMA user_version").fetchone()[0] != self.schemaVersion:
+                for table in ["dirs", "states", "successFiles", "successes"]:
+                    connection.execute("DROP TABLE IF EXISTS " + table)
+                connection.execute("PRAGMA user_version = " + str(self.schemaVersion))
+            connection.execute("CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY, parent TEXT, mtime INTEGER)")
+            connection.execute("CREATE TABLE IF NOT EXISTS states (dir TEXT, tag TEXT, signature TEXT, category TEXT, " +
+                               "briefText TEXT, breakdownText TEXT, executionHosts TEXT, hasComparisons INTEGER, hasFreeText INTEGER)")
+            connection.execute("CREATE TABLE IF NOT EXISTS successFiles (dir TEXT, name TEXT, signature TEXT)")
+            connection.execute("CREATE TABLE IF NOT EXISTS successes (dir TEXT, name TEXT, lineNumber INTEGER, tag TEXT, text TEXT)")
+            connection.execute("CREATE INDEX IF NOT EXISTS statesDir ON states (dir)")
+            connection.execute("CREATE INDEX IF NOT EXISTS successFilesDir ON successFiles (dir)")
+            connection.execute("CREATE INDEX IF NOT EXISTS successesDir ON successes (dir)")
+
+    def findFiles(self):
+        # Returns the teststate files as (path, tag, summary) and the succeeded_* files as (path, [(tag, text)])
+        # The summary is None if we don't have one, text is None for lines with only a tag
+        if self.connection is not None:
+            try:
+                self.refresh()
+                return self.getStateFiles(), self.getSuccessFiles()
+            except sqlite3.Error as e:
+                # e.g. someone else is updating it right now
+                self.diag.info("Failed to use index for " + self.repository + " : " + str(e))
+            finally:
+                self.connection.close()
+        return self.walkRepository()
+
+    def walkRepository(self):
+        stateFiles, successFiles = [], []
+        for root, _, files in sorted(os.walk(self.repository)):
+            for file in files:
+                path = os.path.join(root, file)
+                if file.startswith(self.stateFilePrefix):
+                    stateFiles.append((path, file[len(self.stateFilePrefix):], None))
+                elif file.startswith(self.successFilePrefix):
+                    successFiles.append((path, self.readSuccessFile(path)))
+        return stateFiles, successFiles
+
+    def readSuccessFile(self, path):
+        lines = []
+        with open(path) as f:
+            for line in f:
+                parts = line.strip().split(" ", 1)
+                if len(parts) == 2:
+                    lines.append((parts[0], parts[1]))
+                elif parts[0]:
+                    lines.append((parts[0], None))
+        return lines
+
+    def getSignature(self, path, safe=True):
+        stat = os.stat(path)
+        mtime = self.getSafeTimestamp(stat.st_mtime_ns) if safe else stat.st_mtime_ns
+        return str(stat.st_size) + " " + str(mtime)
+
+    def getSafeTimestamp(self, mtime):
+        # If it was changed just now, it might change again without the timestamp moving. Make sure we look again.
+        return -1 if plugins.isRecentlyModified(mtime, self.fileSystemTime) else mtime
+
+    @staticmethod
+    def isSafe(signature):
+        return signature is not None and not signature.endswith(" -1")
+
+    def recordState(self, relPath, tag, state):
+        # Called when a teststate file has just been written, so the report can use this instead of reading it
+        if self.connection is None:
+            return
+        try:
+            stateFile = os.path.join(self.repository, relPath, self.stateFilePrefix + tag)
+            comparison = state.getMostSevereFileComparison() if hasattr(state, "getMostSevereFileComparison") else None
+            with self.connection:
+                self.connection.execute("DELETE FROM states WHERE dir = ? AND tag = ?", (relPath, tag))
+                self.connection.execute("INSERT INTO states VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                        (relPath, tag, self.getSignature(stateFile, safe=False), state.category, state.briefText,
+                                         state.getTypeBreakdown()[1], ", ".join(state.executionHosts),
+                                         comparison is not None, bool(state.freeText)))
+        except (OSError, sqlite3.Error) as e:
+            self.diag.info("Failed to record state in index for " + self.repository + " : " + str(e))
+        finally:
+            self.connection.close()
+
+    def refresh(self):
+        self.fileSystemTime = plugins.getFileSystemTime(self.repository)
+        knownDirs = {}
+        children = {}
+        for path, parent, mtime in self.connection.execute("SELECT * FROM dirs"):
+            knownDirs[path] = mtime
+            children.setdefault(parent, []).append(path)
+        knownSuccessFiles = {}
+        for relPath, name, signature in self.connection.execute("SELECT * FROM successFiles"):
+            knownSuccessFiles.setdefault(relPath, {})[name] = signature
+
+        seenDirs = set()
+        dirsToCheck = [""]
+        rescanned, reread = 0, 0
+        with self.connection:
+            while dirsToCheck:
+                relPath = dirsToCheck.pop()
+                fullPath = os.path.join(self.repository, relPath)
+                try:
+                    mtime = os.stat(fullPath).st_mtime_ns
+                except OSError:
+                    continue
+                seenDirs.add(relPath)
+                knownSignatures = knownSuccessFiles.get(relPath, {})
+                if knownDirs.get(relPath) == mtime:
+                    subDirs = children.get(relPath, [])
+                    successNames = list(knownSignatures)
+                else:
+                    subDirs, successNames = self.rescanDirectory(relPath, fullPath, mtime)
+                    rescanned += 1
+                reread += self.updateSuccessFiles(relPath, fullPath, successNames, knownSignatures)
+                dirsToCheck += subDirs
+
+            for relPath in set(knownDirs).difference(seenDirs):
+                self.removeDirectory(relPath)
+        self.diag.info("Refreshed index for " + self.repository + ": checked " + str(len(seenDirs)) +
+                       " directories, listed " + str(rescanned) + ", read " + str(reread) + " success files")
+
+    def rescanDirectory(self, relPath, fullPath, mtime):
+        subDirs, stateTags, successNames = [], set(), []
+        for entry in os.scandir(fullPath):
+            if entry.is_dir() and not entry.is_symlink():  # as os.walk does
+                subDirs.append(os.path.join(relPath, entry.name))
+            elif entry.name.startswith(self.stateFilePrefix):
+                stateTags.add(entry.name[len(self.stateFilePrefix):])
+            elif entry.name.startswith(self.successFilePrefix):
+                successNames.append(entry.name)
+
+        self.updateStates(relPath, fullPath, stateTags)
+        parent = os.path.dirname(relPath) if relPath else None
+        self.connection.execute("INSERT OR REPLACE INTO dirs VALUES (?, ?, ?)",
+                                (relPath, parent, self.getSafeTimestamp(mtime)))
+        return subDirs, successNames
+
+    def updateStates(self, relPath, fullPath, stateTags):
+        # Keep the summaries SaveState recorded, as long as the file is still the one it wrote.
+        # Teststate files are never rewritten in place, so there is no need to distrust recent timestamps here
+        knownTags = set()
+        for tag, signature in self.connection.execute("SELECT tag, signature FROM states WHERE dir = ?", (relPath,)).fetchall():
+            knownTags.add(tag)
+            try:
+                stateFile = os.path.join(fullPath, self.stateFilePrefix + tag)
+                unchanged = signature is not None and signature == self.getSignature(stateFile, safe=False)
+            except OSError:
+                unchanged = False
+            if tag not in stateTags:
+                self.connection.execute("DELETE FROM states WHERE dir = ? AND tag = ?", (relPath, tag))
+            elif not unchanged:
+                self.connection.execute("UPDATE states SET signature = NULL, category = NULL WHERE dir = ? AND tag = ?", (relPath, tag))
+        self.connection.executemany("INSERT INTO states (dir, tag) VALUES (?, ?)",
+                                    [(relPath, tag) for tag in stateTags.difference(knownTags)])
+
+    def updateSuccessFiles(self, relPath, fullPath, successNames, knownSignatures):
+        # Returns how many files were read
+        reread = 0
+        for name in set(successNames).union(knownSignatures):
+            signature = None
+            if name in successNames:
+                try:
+                    signature = self.getSignature(os.path.join(fullPath, name))
+                except OSError:
+                    pass
+
+            knownSignature = knownSignatures.get(name)
+            if signature == knownSignature and (signature is None or self.isSafe(signature)):
+                continue
+
+            self.connection.execute("DELETE FROM successes WHERE dir = ? AND name = ?", (relPath, name))
+            self.connection.execute("DELETE FROM successFiles WHERE dir = ? AND name = ?", (relPath, name))
+            if signature is not None:
+                lines = self.readSuccessFile(os.path.join(fullPath, name))
+                self.connection.executemany("INSERT INTO successes VALUES (?, ?, ?, ?, ?)",
+                                            [(relPath, name, lineNumber, tag, text) for lineNumber, (tag, text) in enumerate(lines)])
+                self.connection.execute("INSERT INTO successFiles VALUES (?, ?, ?)", (relPath, name, signature))
+                reread += 1
+        return reread
+
+    def removeDirectory(self, relPath):
+        self.connection.execute("DELETE FROM dirs WHERE path = ?", (relPath,))
+        self.connection.execute("DELETE FROM states WHERE dir = ?", (relPath,))
+        self.connection.execute("DELETE FROM successFiles WHERE dir = ?", (relPath,))
+        self.connection.execute("DELETE FROM successes WHERE dir = ?", (relPath,))
+
+    def getStateFiles(self):
+        # Same order as walking the sorted directory tree
+        stateFiles = []
+        for row in self.connection.execute("SELECT dir, tag, category, briefText, breakdownText, executionHosts, " +
+                                           "hasComparisons, hasFreeText FROM states"):
+            relPath, tag, summary = row[0], row[1], row[2:]
+            path = os.path.join(self.repository, relPath, self.stateFilePrefix + tag)
+            stateFiles.append((path, tag, summary if summary[0] is not None else None))
+        stateFiles.sort(key=lambda info: info[:2])
+        return stateFiles
+
+    def getSuccessFiles(self):
+        successFiles = {}
+        for relPath, name, tag, text in self.connection.execute("SELECT dir, name, tag, text FROM successes " +
+                                                                "ORDER BY dir, name, lineNumber"):
+            path = os.path.join(self.repository, relPath, name)
+            successFiles.setdefault(path, []).append((tag, text))
+        return sorted(successFiles.items())
@@ -14,6 +14,7 @@ from collections import OrderedDict
 from glob import glob
 from datetime import datetime, timedelta
 from .batchutils import convertToUrl, getEnvironmentFromRunFiles
+from .repositoryindex import RepositoryIndex
 HTMLgen.PRINTECHO = 0
 
 
@@ -164,11 +165,11 @@ class GenerateWebPages(object):
                 categoryHandlers = {}
                 self.diag.info("Processing " + str(len(stateFiles)) + " teststate files")
                 relevantFiles = 0
-                for stateFile, repository in stateFiles:
+                for stateFile, repository, summary in stateFiles:
                     tag = self.getTagFromFile(stateFile)
                     if len(tags) == 0 or tag in tags:
                         relevantFiles += 1
-                        testId, state, extraVersion = self.processTestStateFile(stateFile, repository)
+                        testId, state, extraVersion = self.processTestStateFile(stateFile, repository, summary)
                         loggedTests.setdefault(extraVersion, OrderedDict()).setdefault(
                             testId, OrderedDict())[tag] = state
                         categoryHandlers.setdefault(tag, CategoryHandler()).registerInCategory(
@@ -177,28 +178,25 @@ class GenerateWebPages(object):
                             self.diag.info("- Processed " + str(relevantFiles) + " files with matching tags so far")
                 self.diag.info("Processed " + str(relevantFiles) + " relevant teststate files")
                 self.diag.info("Processing " + str(len(successFiles)) + " success files")
-                for successFile, repository in successFiles:
+                for successFile, repository, successLines in successFiles:
                     testId = self.getTestIdentifier(successFile, repository)
                     extraVersion = self.findExtraVersion(repository)
-                    with open(successFile) as f:
-                        fileTags = set()
-                        for line in f:
-                            parts = line.strip().split(" ", 1)
-                            if len(parts) != 2:
-                                continue
-                            tag, text = parts
-                            if tag in fileTags:
-                                sys.stderr.write("WARNING: more than one result present for tag '" +
-                                                 tag + "' in file " + successFile + "!\n")
-                                sys.stderr.write("Ignoring later ones\n")
-                                continue
-
-                            fileTags.add(tag)
-                            if len(tags) == 0 or tag in tags:
-                                loggedTests.setdefault(extraVersion, OrderedDict()).setdefault(
-                                    testId, OrderedDict())[tag] = text
-                                categoryHandlers.setdefault(tag, CategoryHandler()).registerInCategory(
-                                    testId, "success", extraVersion, text)
+                    fileTags = set()
+                    for tag, text in successLines:
+                        if text is None:  # only counts for archiving
+                            continue
+                        if tag in fileTags:
+                            sys.stderr.write("WARNING: more than one result present for tag '" +
+                                             tag + "' in file " + successFile + "!\n")
+                            sys.stderr.write("Ignoring later ones\n")
+                            continue
+
+                        fileTags.add(tag)
+                        if len(tags) == 0 or tag in tags:
+                            loggedTests.setdefault(extraVersion, OrderedDict()).setdefault(
+                                testId, OrderedDict())[tag] = text
+                            categoryHandlers.setdefault(tag, CategoryHandler()).registerInCategory(
+                                testId, "success", extraVersion, text)
                 self.diag.info("Processed " + str(len(successFiles)) + " success files")
                 versionToShow = self.removePageVersion(version)
                 hasData = False
@@ -310,28 +308,21 @@ class GenerateWebPages(object):
         tagData, stateFiles, successFiles = {}, [], []
         for _, dir in repositoryDirs:
             self.diag.info("Looking for teststate files in " + dir)
-            for root, _, files in sorted(os.walk(dir)):
-                for file in files:
-                    path = os.path.join(root, file)
-                    if file.startswith("teststate_"):
-                        tag = self.getTagFromFile(file)
-                        stateFiles.append((path, dir))
-                        tagData.setdefault(tag, []).append(path)
-                    elif file.startswith("succeeded_"):
-                        successFiles.append((path, dir))
-                        with open(path) as f:
-                            for line in f:
-                                parts = line.split()
-                                if parts:
-                                    tag = parts[0]
-                                    tagData.setdefault(tag, []).append(path)
+            dirStateFiles, dirSuccessFiles = RepositoryIndex(dir).findFiles()
+            for path, tag, summary in dirStateFiles:
+                stateFiles.append((path, dir, summary))
+                tagData.setdefault(tag, []).append(path)
+            for path, successLines in dirSuccessFiles:
+                successFiles.append((path, dir, successLines))
+                for tag, _ in successLines:
+                    tagData.setdefault(tag, []).append(path)
 
             self.diag.info("Found " + str(len(stateFiles)) + " teststate files and " +
                            str(len(successFiles)) + " success files in " + dir)
         return tagData, stateFiles, successFiles
 
-    def processTestStateFile(self, stateFile, repository):
-        state = self.readState(stateFile)
+    def processTestStateFile(self, stateFile, repository, summary=None):
+        state = IndexedTestState(stateFile, *summary) if summary else self.readState(stateFile)
         testId = self.getTestIdentifier(stateFile, repository)
         extraVersion = self.findExtraVersion(repository)
         return testId, state, extraVersion
@@ -348,7 +339,8 @@ class GenerateWebPages(object):
     def readState(cls, stateFile):
         file = open(stateFile, "rb")
         try:
-            state = plugins.getNewTestStateFromFile(file)
+            # Most of the free text is never looked at in the report, so leave it in the file until it is
+            state = plugins.getNewTestStateFromFile(file, lazyText=True)
             if isinstance(state, plugins.TestState):
                 return state
             else:
@@ -467,6 +459,38 @@ class GenerateWebPages(object):
         return time.mktime(time.strptime(timePart, "%d%b%Y"))
 
 
+class IndexedTestState:
+    # Stands in for a state in the repository, using what the repository index recorded about it when it was saved.
+    # Anything else is found by reading the state file, which only happens for the details of failing tests
+    def __init__(self, stateFile, category, briefText, breakdownText, executionHosts, hasComparisons, hasFreeText):
+        self.stateFile = stateFile
+        self.category = category
+        self.briefText = briefText
+        self.breakdownText = breakdownText
+        self.executionHosts = executionHosts.split(", ") if executionHosts else []
+        self.hasComparisons = hasComparisons
+        self.hasFreeText = hasFreeText
+        self.state = None
+
+    def getTypeBreakdown(self):
+        return self.category, self.breakdownText
+
+    def getMostSevereFileComparison(self):
+        if self.hasComparisons and hasattr(self.getState(), "getMostSevereFileComparison"):
+            return self.state.getMostSevereFileComparison()
+
+    def getState(self):
+        if self.state is None:
+            self.state = GenerateWebPages.readState(self.stateFile)
+        return self.state
+
+    def __getattr__(self, name):
+        if name == "freeText" and not self.hasFreeText:
+            return ""
+        # Anything not recorded in the index comes from the actual state...
+        return getattr(self.getState(), name)
+
+
 class TestTable:
     def __init__(self, getConfigValue, resourceNames, descriptionInfo, tags, categoryHandlers, pageVersion, version, graphFilePath):
         self.getConfigValue = getConfigValue
@@ -652,8 +676,11 @@ class TestTable:
         return "N/A", True, self.colourFinder.find("test_default_fg"), self.colourFinder.find("no_results_bg")
 
     def getCellDataFromState(self, state):
-        fileComp = state.getMostSevereFileComparison() if hasattr(state, "getMostSevereFileComparison") else None
         category = state.category if hasattr(state, "category") else "success"
+        fileComp = None
+        # Only needed for the colour of performance differences, and it may mean reading the state file
+        if self.getBackgroundColourKey(category) in ["performance", "memory"] and hasattr(state, "getMostSevereFileComparison"):
+            fileComp = state.getMostSevereFileComparison()
         fgcol, bgcol = self.getColours(category, fileComp)
         if not hasattr(state, "category"):
             brief, hosts = parseState(state)
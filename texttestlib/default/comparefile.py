@@ -1,11 +1,11 @@
 
 import os
-import filecmp
 import time
 import subprocess
 import logging
 import re
 from texttestlib import plugins
+from texttestlib.default.filtercache import DigestRegistry
 from shutil import copyfile
 
 from fnmatch import fnmatch
@@ -15,6 +15,7 @@ class FileComparison:
     SAME = 0
     DIFFERENT = 1
     APPROVED = 2
+    freeTextBody = plugins.LazyText()
 
     def __init__(self, test, stem, standardFile, tmpFile, testInProgress=False, **kw):
         self.stdFile = standardFile
@@ -40,8 +41,7 @@ class FileComparison:
         self.freeTextBody = None
         # subclasses may override if they don't want to store in this way
         self.cacheDifferences(test, testInProgress)
-        self.diag.info("Created file comparison std: " + repr(self.stdFile) + " tmp: " +
-                       repr(self.tmpFile) + " diff: " + repr(self.differenceCache))
+        self.diag.info("Created file comparison std: %r tmp: %r diff: %r", self.stdFile, self.tmpFile, self.differenceCache)
 
     def stemForConfig(self):
         return self.stem
@@ -49,7 +49,7 @@ class FileComparison:
     def setStandardFile(self, standardFile):
         self.stdFile = standardFile
         self.stdCmpFile = self.stdFile
-        self.diag.info("Setting standard file for " + self.stem + " to " + repr(standardFile))
+        self.diag.info("Setting standard file for %s to %r", self.stem, standardFile)
 
     def recompute(self, test):
         self.freeTextBody = None
@@ -170,7 +170,7 @@ class FileComparison:
 
         stdModTime = plugins.modifiedTime(self.stdFile)
         if self.recalculationTime:
-            self.diag.info("Already recalculated, checking if file updated since then : " + self.stdFile)
+            self.diag.info("Already recalculated, checking if file updated since then : %s", self.stdFile)
             # If we're already recalculated, only do it again if standard file changes since then
             return stdModTime > self.recalculationTime
 
@@ -245,13 +245,12 @@ class FileComparison:
 
     def updateDifferenceCache(self, valueForEqual):
         if self.stdCmpFile and self.tmpCmpFile:
-            if filecmp.cmp(self.stdCmpFile, self.tmpCmpFile, 0):
+            if DigestRegistry.filesEqual(self.stdCmpFile, self.tmpCmpFile):
                 if self.differenceCache != self.APPROVED:
                     self.differenceCache = valueForEqual
             else:
                 self.differenceCache = self.DIFFERENT
-            self.diag.info("Caching differences " + repr(self.stdCmpFile) + " " +
-                           repr(self.tmpCmpFile) + " = " + repr(self.differenceCache))
+            self.diag.info("Caching differences %r %r = %r", self.stdCmpFile, self.tmpCmpFile, self.differenceCache)
 
     def cacheDifferences(self, test, testInProgress):
         self.setCmpFiles(test, testInProgress)
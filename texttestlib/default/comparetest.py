@@ -34,7 +34,7 @@ class BaseTestComparison(plugins.TestState):
         lists = [self.changedResults, self.newResults, self.missingResults]
         if includeSuccess:
             lists.append(self.correctResults)
-        self.diag.info("Finding comparison for stem " + stem)
+        self.diag.info("Finding comparison for stem %s", stem)
         for list in lists:
             for comparison in list:
                 if comparison.stem == stem:
@@ -71,13 +71,7 @@ class BaseTestComparison(plugins.TestState):
             test.changeState(self)
 
     def getRerunCount(self, test):
-        number = 1
-        while True:
-            path = test.makeBackupFileName(number)
-            if path and os.path.exists(path):
-                number += 1
-            else:
-                return number - 1
+        return test.getBackupCount()
 
     def fakeMissingFileText(self):
         return plugins.fakeMissingFileText()
@@ -113,9 +107,9 @@ class BaseTestComparison(plugins.TestState):
         tmpFiles = self.makeStemDict(test.listTmpFiles())
         stdFiles = self.makeStandardStemDict(test, tmpFiles, ignoreMissing)
         for tmpStem, tmpFile in list(tmpFiles.items()):
-            self.notifyIfMainThread("ActionProgress")
+            self.notifyProgressIfMainThread()
             stdFile = stdFiles.get(tmpStem)
-            self.diag.info("Comparing " + repr(stdFile) + "\nwith " + tmpFile)
+            self.diag.info("Comparing %r\nwith %s", stdFile, tmpFile)
             comparison = self.createFileComparison(test, tmpStem, stdFile, tmpFile)
             if comparison:
                 self.addComparison(comparison)
@@ -124,7 +118,7 @@ class BaseTestComparison(plugins.TestState):
 
     def makeMissingComparisons(self, test, stdFiles, tmpFiles):
         for stdStem, stdFile in list(stdFiles.items()):
-            self.notifyIfMainThread("ActionProgress")
+            self.notifyProgressIfMainThread()
             if stdStem not in tmpFiles:
                 comparison = self.createFileComparison(test, stdStem, stdFile, None)
                 if comparison:
@@ -239,7 +233,7 @@ class TestComparison(BaseTestComparison):
             if self.diag.isEnabledFor(logging.INFO):
                 self.diag.info(comparison.stem + " dates " + comparison.modifiedDates())
             if comparison.needsRecalculation():
-                self.diag.info("Recalculation needed for file " + comparison.stem)
+                self.diag.info("Recalculation needed for file %s", comparison.stem)
                 comparisons.append(comparison)
         self.diag.info("All file comparisons up to date")
         return comparisons
@@ -623,7 +617,8 @@ class PrintObsoleteVersions(plugins.Action):
         stem = os.path.basename(file).split(".")[0]
         from .rundependent import FilterAction
         action = FilterAction()
-        action.performAllFilterings(test, stem, file, newFile)
+        filters = action.makeAllFilters(test, stem, test.app)
+        action.performAllFilterings(filters, file, newFile)
         return newFile
 
     def compareFiles(self, test, filePair1, filePair2):
@@ -0,0 +1,167 @@
+# Persistent cache of filtered result files. Identified per test and per output file,
+# and keyed by content hashes of the input file and the filters applied to it, so that
+# result files that haven't changed since the last run don't need re-filtering.
+# Also remembers the content hashes of all filtered files it has seen, so that comparing two of them
+# doesn't need to read them again.
+
+import os
+import filecmp
+import hashlib
+import shutil
+import logging
+from collections import OrderedDict
+from tempfile import mkdtemp
+from threading import Lock
+from texttestlib import plugins
+from texttestlib.texttest_version import version
+
+
+def getFileDigest(fileName, blockSize=1024 * 1024):
+    sha = hashlib.sha1()
+    with open(fileName, "rb") as f:
+        block = f.read(blockSize)
+        while block:
+            sha.update(block)
+            block = f.read(blockSize)
+    return sha.hexdigest()
+
+
+class DigestRegistry:
+    # Content hashes of files we have written or restored, valid as long as the file is unchanged.
+    # A rewrite in the same clock tick needn't change the signature, so whoever rewrites a file must forget it first.
+    # Only the most recently used are kept
+    digests = OrderedDict()
+    maxEntries = 10000
+    lock = Lock()
+
+    @classmethod
+    def getSignature(cls, fileName):
+        try:
+            stat = os.stat(fileName)
+            return stat.st_ino, stat.st_size, stat.st_mtime_ns, stat.st_ctime_ns
+        except OSError:
+            pass
+
+    @classmethod
+    def register(cls, fileName, digest):
+        signature = cls.getSignature(fileName)
+        if signature:
+            with cls.lock:
+                cls.digests[fileName] = signature, digest
+                cls.digests.move_to_end(fileName)
+                if len(cls.digests) > cls.maxEntries:
+                    cls.digests.popitem(last=False)
+
+    @classmethod
+    def forget(cls, fileName):
+        with cls.lock:
+            cls.digests.pop(fileName, None)
+
+    @classmethod
+    def lookup(cls, fileName):
+        with cls.lock:
+            signature, digest = cls.digests.get(fileName, (None, None))
+            if signature is not None:
+                cls.digests.move_to_end(fileName)
+        if signature is not None and signature == cls.getSignature(fileName):
+            return digest
+
+    @classmethod
+    def getDigest(cls, fileName):
+        return cls.lookup(fileName) or getFileDigest(fileName)
+
+    @classmethod
+    def filesEqual(cls, fileName1, fileName2):
+        digest1 = cls.lookup(fileName1)
+        digest2 = cls.lookup(fileName2)
+        if digest1 and digest2:
+            return digest1 == digest2
+        else:
+            return filecmp.cmp(fileName1, fileName2, 0)
+
+
+class FilterCache:
+    keyFileName = "key"
+    digestFileName = "digest"
+    resultFileName = "result"
+
+    def __init__(self, rootDir):
+        self.rootDir = rootDir
+        self.diag = logging.getLogger("Filter Cache")
+
+    @classmethod
+    def create(cls, test):
+        rootDir = test.getConfigValue("filter_cache_directory")
+        if rootDir:
+            return cls(os.path.join(rootDir, test.getWriteDirRelPath()))
+
+    def makeKey(self, fileName, filters):
+        sha = hashlib.sha1()
+        sha.update(version.encode())
+        sha.update(getFileDigest(fileName).encode())
+        for fileFilter in filters:
+            sha.update(fileFilter.getCacheKey().encode("utf-8", errors="replace"))
+        return sha.hexdigest()
+
+    def getSlotDir(self, newFileName):
+        return os.path.join(self.rootDir, os.path.basename(newFileName))
+
+    def readSlotFile(self, slotDir, fileName):
+        path = os.path.join(slotDir, fileName)
+        if os.path.isfile(path):
+            with open(path) as f:
+                return f.read().strip()
+
+    def restore(self, key, newFileName, postfixes):
+        slotDir = self.getSlotDir(newFileName)
+        if self.readSlotFile(slotDir, self.keyFileName) != key:
+            self.diag.info("No cached filtering for " + newFileName)
+            return False
+
+        try:
+            for postfix in postfixes:
+                cachedFile = os.path.join(slotDir, postfix)
+                if os.path.isfile(cachedFile):
+                    shutil.copyfile(cachedFile, newFileName + "." + postfix)
+            shutil.copyfile(os.path.join(slotDir, self.resultFileName), newFileName)
+            digest = self.readSlotFile(slotDir, self.digestFileName)
+            # Another run may have replaced the slot while we were copying it
+            replaced = self.readSlotFile(slotDir, self.keyFileName) != key
+        except OSError:
+            self.diag.info("Failed to restore cached filtering for " + newFileName + ":\n" + plugins.getExceptionString())
+            return False
+
+        if replaced:
+            self.diag.info("Cached filtering for " + newFileName + " changed while restoring it")
+            return False
+        if digest:
+            DigestRegistry.register(newFileName, digest)
+        self.diag.info("Restored cached filtering for " + newFileName)
+        return True
+
+    def store(self, key, newFileName, postfixes):
+        slotDir = self.getSlotDir(newFileName)
+        tmpSlotDir = None
+        try:
+            # Fill a new slot somewhere else and move it into place, other runs may be using the old one
+            plugins.ensureDirectoryExists(self.rootDir)
+            tmpSlotDir = mkdtemp(dir=self.rootDir, prefix=os.path.basename(slotDir) + ".")
+            for postfix in postfixes:
+                intermediateFile = newFileName + "." + postfix
+                if os.path.isfile(intermediateFile):
+                    shutil.copyfile(intermediateFile, os.path.join(tmpSlotDir, postfix))
+            shutil.copyfile(newFileName, os.path.join(tmpSlotDir, self.resultFileName))
+            digest = getFileDigest(newFileName)
+            DigestRegistry.register(newFileName, digest)
+            with open(os.path.join(tmpSlotDir, self.digestFileName), "w") as f:
+                f.write(digest + "\n")
+            with open(os.path.join(tmpSlotDir, self.keyFileName), "w") as f:
+                f.write(key + "\n")
+            plugins.removeInBackground(slotDir)
+            os.rename(tmpSlotDir, slotDir)
+            self.diag.info("Stored filtering of " + newFileName + " in cache")
+        except OSError:
+            # The cache is only an optimisation, never fail the test because of it. Usually another run just stored it
+            self.diag.info("Failed to store filtering of " + newFileName + ":\n" + plugins.getExceptionString())
+            if tmpSlotDir and os.path.isdir(tmpSlotDir):
+                shutil.rmtree(tmpSlotDir, True)
@@ -1,5 +1,17 @@
+import re
 import sys
 import difflib
+from bisect import bisect_left
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Lines are compared in blocks, so that the numbers from huge files don't all need to be in memory at once
+_blockSize = 10000
+# Runs of the characters _getNumberAt considers part of a number
+_numberRun = re.compile("([0-9.eE+-]+)")
 
 
 def _getNumberAt(l, pos):
@@ -65,9 +77,96 @@ def _fpequal(l1, l2, tolerance, relTolerance):
     return equal and l1 == "" and l2 == ""
 
 
+def _isSimpleNumber(run):
+    # _getNumberAt would find the whole run as one number wherever it started
+    return run.count(".") <= 1 and run.count("e") + run.count("E") <= 1
+
+
+class _BulkComparison:
+    # Extracts the numbers from many lines at once and compares them all together.
+    # Lines where the text around the numbers differs, or the numbers are unusual, are compared by _fpequal instead
+    def __init__(self, tolerance, relTolerance):
+        self.tolerance = tolerance
+        self.relTolerance = relTolerance
+        self.unequalLines = set()
+        self.lineIndices = []
+        self.fromNumbers = []
+        self.toNumbers = []
+
+    def add(self, index, l1, l2):
+        if index in self.unequalLines:
+            return
+        parts1 = _numberRun.split(l1)
+        parts2 = _numberRun.split(l2)
+        if len(parts1) != len(parts2) or parts1[0::2] != parts2[0::2]:
+            return self.addCharacterComparison(index, l1, l2)
+        differentRuns = [(run1, run2) for run1, run2 in zip(parts1[1::2], parts2[1::2]) if run1 != run2]
+        if not all((_isSimpleNumber(run1) and _isSimpleNumber(run2) for run1, run2 in differentRuns)):
+            return self.addCharacterComparison(index, l1, l2)
+        try:
+            numbers = [(float(run1), float(run2)) for run1, run2 in differentRuns]
+        except ValueError:
+            self.unequalLines.add(index)
+            return
+        for number1, number2 in numbers:
+            self.lineIndices.append(index)
+            self.fromNumbers.append(number1)
+            self.toNumbers.append(number2)
+
+    def addCharacterComparison(self, index, l1, l2):
+        if not _fpequal(l1, l2, self.tolerance, self.relTolerance):
+            self.unequalLines.add(index)
+
+    def addUnequal(self, index):
+        self.unequalLines.add(index)
+
+    def findUnequalLines(self):
+        if numpy is not None:
+            equalFlags = self.compareWithNumpy()
+        else:
+            equalFlags = list(map(self.numbersEqual, self.fromNumbers, self.toNumbers))
+        for index, equal in zip(self.lineIndices, equalFlags):
+            if not equal:
+                self.unequalLines.add(index)
+        return self.unequalLines
+
+    def numbersEqual(self, number1, number2):
+        deviation = abs(number1 - number2)
+        if self.tolerance != None and deviation <= self.tolerance:
+            return True
+        elif self.relTolerance != None:
+            referenceValue = abs(number1)
+            if referenceValue == 0:
+                return deviation == 0
+            else:
+                return deviation / referenceValue <= self.relTolerance
+        return False
+
+    def compareWithNumpy(self):
+        fromNumbers = numpy.array(self.fromNumbers, dtype=float)
+        toNumbers = numpy.array(self.toNumbers, dtype=float)
+        with numpy.errstate(all="ignore"):
+            deviations = numpy.abs(fromNumbers - toNumbers)
+            equalFlags = numpy.zeros(len(deviations), dtype=bool)
+            if self.tolerance != None:
+                equalFlags |= deviations <= self.tolerance
+            if self.relTolerance != None:
+                referenceValues = numpy.abs(fromNumbers)
+                equalFlags |= numpy.where(referenceValues == 0, deviations == 0,
+                                          deviations / referenceValues <= self.relTolerance)
+        return equalFlags
+
+
 def _cmpLines(fromlines, tolines, outlines, tolerance, relTolerance, split):
-    for fromline, toline in zip(fromlines, tolines):
-        equal = True
+    lineCount = min(len(fromlines), len(tolines))
+    for blockStart in range(0, lineCount, _blockSize):
+        blockEnd = min(blockStart + _blockSize, lineCount)
+        _cmpBlock(fromlines[blockStart:blockEnd], tolines[blockStart:blockEnd], outlines, tolerance, relTolerance, split)
+
+
+def _cmpBlock(fromlines, tolines, outlines, tolerance, relTolerance, split):
+    comparison = _BulkComparison(tolerance, relTolerance)
+    for index, (fromline, toline) in enumerate(zip(fromlines, tolines)):
         if fromline != toline:
             if split != '':
                 fromSplit = fromline.split(split)
@@ -75,27 +174,136 @@ def _cmpLines(fromlines, tolines, outlines, tolerance, relTolerance, split):
                 if len(fromSplit) == len(toSplit):
                     for f, t in zip(fromSplit, toSplit):
                         f, t = f.strip(), t.strip()
-                        if f != t and not _fpequal(f, t, tolerance, relTolerance):
-                            equal = False
-                            break
+                        if f != t:
+                            comparison.add(index, f, t)
                 else:
-                    equal = False
-            elif not _fpequal(fromline, toline, tolerance, relTolerance):
-                equal = False
-        if equal:
-            outlines.write(fromline)
-        else:
+                    comparison.addUnequal(index)
+            else:
+                comparison.add(index, fromline, toline)
+    unequalLines = comparison.findUnequalLines()
+    for index, (fromline, toline) in enumerate(zip(fromlines, tolines)):
+        if index in unequalLines:
             outlines.write(toline)
+        else:
+            outlines.write(fromline)
+
+
+class PatienceMatcher:
+    # Provides get_opcodes() like difflib.SequenceMatcher, but aligns lines that occur exactly once in both files first
+    # (patience diff), which is close to linear, rather than searching for the longest matching blocks, which is quadratic.
+    # difflib is only used on small regions with no unique lines in common.
+    maxDifflibRegion = 1000000
+
+    def __init__(self, a, b):
+        self.a = a
+        self.b = b
+
+    def get_opcodes(self):
+        opcodes = []
+        i, j = 0, 0
+        for ai, bj in sorted(self.findMatches()) + [(len(self.a), len(self.b))]:
+            if i < ai and j < bj:
+                opcodes.append(("replace", i, ai, j, bj))
+            elif i < ai:
+                opcodes.append(("delete", i, ai, j, j))
+            elif j < bj:
+                opcodes.append(("insert", i, i, j, bj))
+            if ai < len(self.a):
+                if opcodes and opcodes[-1][0] == "equal":
+                    _, ei1, _, ej1, _ = opcodes.pop()
+                    opcodes.append(("equal", ei1, ai + 1, ej1, bj + 1))
+                else:
+                    opcodes.append(("equal", ai, ai + 1, bj, bj + 1))
+            i, j = ai + 1, bj + 1
+        return opcodes
+
+    def findMatches(self):
+        a, b = self.a, self.b
+        matches = []
+        regions = [(0, len(a), 0, len(b))]
+        while regions:
+            alo, ahi, blo, bhi = regions.pop()
+            while alo < ahi and blo < bhi and a[alo] == b[blo]:
+                matches.append((alo, blo))
+                alo += 1
+                blo += 1
+            while alo < ahi and blo < bhi and a[ahi - 1] == b[bhi - 1]:
+                ahi -= 1
+                bhi -= 1
+                matches.append((ahi, bhi))
+            if alo == ahi or blo == bhi:
+                continue
+
+            anchors = self.findUniqueAnchors(alo, ahi, blo, bhi)
+            if anchors:
+                prevA, prevB = alo, blo
+                for ai, bj in anchors:
+                    matches.append((ai, bj))
+                    regions.append((prevA, ai, prevB, bj))
+                    prevA, prevB = ai + 1, bj + 1
+                regions.append((prevA, ahi, prevB, bhi))
+            elif (ahi - alo) * (bhi - blo) <= self.maxDifflibRegion:
+                matcher = difflib.SequenceMatcher(None, a[alo:ahi], b[blo:bhi])
+                for ai, bj, size in matcher.get_matching_blocks():
+                    matches += [(alo + ai + k, blo + bj + k) for k in range(size)]
+        return matches
+
+    def findUniqueAnchors(self, alo, ahi, blo, bhi):
+        # line -> [count in a, count in b, index in a, index in b]
+        counts = {}
+        for i in range(alo, ahi):
+            info = counts.get(self.a[i])
+            if info is None:
+                counts[self.a[i]] = [1, 0, i, -1]
+            else:
+                info[0] += 1
+        for j in range(blo, bhi):
+            info = counts.get(self.b[j])
+            if info is not None:
+                info[1] += 1
+                info[3] = j
+        # In order of their position in a, as dictionaries preserve insertion order
+        candidates = [(i, j) for countA, countB, i, j in counts.values() if countA == 1 and countB == 1]
+        return self.longestIncreasingSequence(candidates)
+
+    def longestIncreasingSequence(self, candidates):
+        # Patience sorting on the positions in b
+        pileTops, pileTopIndices, previous = [], [], []
+        for index, (_, j) in enumerate(candidates):
+            pile = bisect_left(pileTops, j)
+            if pile == len(pileTops):
+                pileTops.append(j)
+                pileTopIndices.append(index)
+            else:
+                pileTops[pile] = j
+                pileTopIndices[pile] = index
+            previous.append(pileTopIndices[pile - 1] if pile > 0 else None)
+        sequence = []
+        index = pileTopIndices[-1] if pileTopIndices else None
+        while index is not None:
+            sequence.append(candidates[index])
+            index = previous[index]
+        sequence.reverse()
+        return sequence
+
+
+def _makeMatcher(fromlines, tolines, alignment):
+    if alignment == "patience":
+        return PatienceMatcher(fromlines, tolines)
+    else:
+        return difflib.SequenceMatcher(None, fromlines, tolines)
 
 
-def fpfilter(fromlines, tolines, outlines, tolerance, relTolerance=None, useDifflib=False, split=''):
+def fpfilter(fromlines, tolines, outlines, tolerance, relTolerance=None, useDifflib=False, split='', alignment=""):
     if split == 'None':
         split = None
-    if not useDifflib:
+    if useDifflib and not alignment:
+        alignment = "difflib"
+    if not alignment:
         _cmpLines(fromlines, tolines, outlines, tolerance, relTolerance, split)
         outlines.writelines(tolines[len(fromlines):])
         return
-    s = difflib.SequenceMatcher(None, fromlines, tolines)
+    s = _makeMatcher(fromlines, tolines, alignment)
     for tag, i1, i2, j1, j2 in s.get_opcodes():
         if tag == "replace" and i2 - i1 == j2 - j1:
             _cmpLines(fromlines[i1:i2], tolines[j1:j2], outlines, tolerance, relTolerance, split)
@@ -6,7 +6,7 @@ import types
 import logging
 import sys
 from . import entrycompletion
-from texttestlib import plugins
+from texttestlib import plugins, testmodel
 from .guiutils import guiConfig, SubGUI, GUIConfig, createApplicationEvent
 from texttestlib.jobprocess import killProcessAndChildren
 from collections import OrderedDict
@@ -337,10 +337,15 @@ class BasicActionGUI(SubGUI, GtkActionWrapper):
     def _runInteractive(self):
         try:
             BasicActionGUI.busy = True
+            # Write test suite files once at the end, however many tests the action changes
+            testmodel.TestSuite.testSuiteFileHandler.holdWrites()
             self.startPerform()
         finally:
-            self.endPerform()
-            BasicActionGUI.busy = False
+            try:
+                testmodel.TestSuite.testSuiteFileHandler.flush()
+            finally:
+                self.endPerform()
+                BasicActionGUI.busy = False
 
     def messageBeforePerform(self):
         # Don't change this by default, most of these things don't take very long
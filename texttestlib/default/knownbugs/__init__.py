@@ -5,10 +5,14 @@ import sys
 import logging
 import glob
 import re
+import time
 from texttestlib import plugins
 from configparser import ConfigParser, NoOptionError
 from copy import copy
 from collections import OrderedDict
+from threading import local, Lock, Event
+from tempfile import mkstemp
+from pickle import Pickler, Unpickler, UnpicklingError
 
 plugins.addCategory("bug", "known bugs", "had known bugs")
 plugins.addCategory("badPredict", "internal errors", "had internal errors")
@@ -28,7 +32,7 @@ class FailedPrediction(plugins.TestState):
 
 class Bug:
     rerunLine = "(NOTE: Test was run %d times in total and each time encountered this issue."
-    prevResultLine = "Results of previous runs can be found in framework_tmp/backup.previous.* under the sandbox directory.)"
+    prevResultLine = "Results of previous runs can be found in backup.previous.* in the .backups directory beside the sandbox directory.)"
 
     def __init__(self, priority, rerunCount, rerunOnly, allowAllRerunsFail):
         self.priority = priority
@@ -52,6 +56,142 @@ class Bug:
             return ""
 
 
+class BugSystemError(Exception):
+    # Raised by bug system modules when they couldn't find out about a bug, with the information to show instead.
+    # That information isn't cached, as the bug system may well be able to answer next time
+    def getInfo(self):
+        return self.args
+
+
+class BugInfoCache:
+    # Information from bug systems, shared by the whole run so that a bug which many tests hit is only looked up once.
+    # If several threads want the same bug at once, one of them asks the bug system and the others wait for its answer.
+    # Can also be kept in a file between runs, see bug_system_cache_file
+    entries = {}
+    pending = {}
+    lock = Lock()
+    loadedFiles = set()
+    diag = logging.getLogger("Bug Info Cache")
+
+    @classmethod
+    def getBugSystemModule(cls, bugSystem):
+        namespace = {}
+        try:
+            exec("from . import " + bugSystem + " as _module", globals(), namespace)
+            return namespace["_module"]
+        except ImportError:
+            pass
+
+    @classmethod
+    def makeKey(cls, bugSystem, bugId, location, username):
+        return bugSystem, location, username, bugId
+
+    @classmethod
+    def getCached(cls, key, maxAge):
+        entry = cls.entries.get(key)
+        if entry and time.time() - entry[0] < maxAge:
+            return entry[1]
+
+    @classmethod
+    def findBugInfo(cls, bugSystem, bugId, location, username, password, maxAge, cacheFile=None):
+        key = cls.makeKey(bugSystem, bugId, location, username)
+        with cls.lock:
+            cls.loadFile(cacheFile)
+            info = cls.getCached(key, maxAge)
+            if info:
+                cls.diag.info("Using cached information for bug %s", bugId)
+                return info
+            event = cls.pending.get(key)
+            fetching = event is None
+            if fetching:
+                event = cls.pending[key] = Event()
+
+        if not fetching:
+            cls.diag.info("Waiting for another lookup of bug %s", bugId)
+            event.wait()
+            with cls.lock:
+                info = cls.getCached(key, maxAge)
+            if info:
+                return info
+        try:
+            info = cls.fetchBugInfo(bugSystem, bugId, location, username, password)
+            cls.store({key: info}, cacheFile)
+            return info
+        except BugSystemError as e:
+            cls.diag.info("Failed to look up bug %s, not caching the result", bugId)
+            return e.getInfo()
+        finally:
+            if fetching:
+                with cls.lock:
+                    del cls.pending[key]
+                event.set()
+
+    @classmethod
+    def fetchBugInfo(cls, bugSystem, bugId, location, username, password):
+        cls.diag.info("Looking up bug %s in %s", bugId, bugSystem)
+        module = cls.getBugSystemModule(bugSystem)
+        if module:
+            return module.findBugInfo(bugId, location, username, password)
+        else:
+            return "unknown", "Bug " + bugId + " in unknown bug system '" + bugSystem + "'", False, bugId
+
+    @classmethod
+    def prefetch(cls, bugSystem, bugIds, location, username, password, maxAge, cacheFile=None):
+        # Bug systems that can look up several bugs in one request provide findBugInfos, returning a dictionary
+        # from the bug IDs. Any they leave out are looked up one at a time when needed, as usual.
+        module = cls.getBugSystemModule(bugSystem)
+        if not hasattr(module, "findBugInfos"):
+            return
+        with cls.lock:
+            cls.loadFile(cacheFile)
+            toFetch = [bugId for bugId in bugIds if not cls.getCached(cls.makeKey(bugSystem, bugId, location, username), maxAge)]
+        if len(toFetch) > 1:
+            cls.diag.info("Looking up bugs %s in %s", toFetch, bugSystem)
+            infos = module.findBugInfos(toFetch, location, username, password)
+            cls.store({cls.makeKey(bugSystem, bugId, location, username): info for bugId, info in infos.items()}, cacheFile)
+
+    @classmethod
+    def store(cls, newInfo, cacheFile):
+        now = time.time()
+        with cls.lock:
+            for key, info in newInfo.items():
+                cls.entries[key] = now, info
+            if cacheFile and newInfo:
+                cls.saveFile(cacheFile)
+
+    @classmethod
+    def readFile(cls, cacheFile):
+        if os.path.isfile(cacheFile):
+            try:
+                with open(cacheFile, "rb") as f:
+                    return Unpickler(f).load()
+            except (OSError, EOFError, UnpicklingError, AttributeError, ValueError):
+                cls.diag.info("Could not read bug information from %s, ignoring it", cacheFile)
+        return {}
+
+    @classmethod
+    def loadFile(cls, cacheFile):
+        if cacheFile and cacheFile not in cls.loadedFiles:
+            cls.loadedFiles.add(cacheFile)
+            for key, entry in cls.readFile(cacheFile).items():
+                if key not in cls.entries or cls.entries[key][0] < entry[0]:
+                    cls.entries[key] = entry
+
+    @classmethod
+    def saveFile(cls, cacheFile):
+        # Other runs may be using the same file, keep what they found as well
+        entries = cls.readFile(cacheFile)
+        entries.update(cls.entries)
+        try:
+            plugins.ensureDirectoryExists(os.path.dirname(os.path.abspath(cacheFile)))
+            fd, tmpFileName = mkstemp(dir=os.path.dirname(os.path.abspath(cacheFile)))
+            with os.fdopen(fd, "wb") as f:
+                Pickler(f, protocol=4).dump(entries)
+            os.replace(tmpFileName, cacheFile)
+        except OSError as e:
+            cls.diag.info("Could not write bug information to %s : %s", cacheFile, e)
+
+
 class BugSystemBug(Bug):
     def __init__(self, bugSystem, bugId, priorityStr, *args):
         self.bugId = bugId
@@ -62,23 +202,26 @@ class BugSystemBug(Bug):
     def __repr__(self):
         return self.bugId
 
-    def findInfo(self, test):
+    def getLookupArgs(self, test):
         location = test.getCompositeConfigValue("bug_system_location", self.bugSystem)
         username = test.getCompositeConfigValue("bug_system_username", self.bugSystem)
         password = test.getCompositeConfigValue("bug_system_password", self.bugSystem)
-        status, bugText, isResolved, bugId = self.findBugInfo(self.bugId, location, username, password)
+        maxAge = int(test.getCompositeConfigValue("bug_system_cache_time", self.bugSystem))
+        cacheFile = test.getConfigValue("bug_system_cache_file")
+        return location, username, password, maxAge, cacheFile
+
+    def findInfo(self, test):
+        status, bugText, isResolved, bugId = self.findBugInfo(self.bugId, *self.getLookupArgs(test))
         self.bugId = bugId
         category = self.findCategory(isResolved)
         briefText = "bug " + self.bugId + " (" + status + ")"
         return category, briefText, self.getRerunText() + bugText
 
-    def findBugInfo(self, bugId, location, username, password):
-        namespace = {}
-        try:
-            exec("from ." + self.bugSystem + " import findBugInfo as _findBugInfo", globals(), namespace)
-            return namespace["_findBugInfo"](self.bugId, location, username, password)  # @UndefinedVariable
-        except ImportError:
-            return "unknown", "Bug " + bugId + " in unknown bug system '" + self.bugSystem + "'", False, bugId
+    def findBugInfo(self, bugId, location, username, password, maxAge=0, cacheFile=None):
+        return BugInfoCache.findBugInfo(self.bugSystem, bugId, location, username, password, maxAge, cacheFile)
+
+    def prefetch(self, test, bugIds):
+        BugInfoCache.prefetch(self.bugSystem, bugIds, *self.getLookupArgs(test))
 
 class UnreportedBug(Bug):
     def __init__(self, fullText, briefText, internalError, priorityStr, *args):
@@ -210,11 +353,16 @@ class BugTrigger:
 
 
 class FileBugData:
+    # Regular expressions that can't be combined with others and still mean the same thing
+    backReferenceRegex = re.compile(r"\\[1-9]|\(\?P=")
+
     def __init__(self):
         self.presentList = []
         self.absentList = []
         self.identicalList = []
         self.checkUnchanged = False
+        self.lineFilter = None
+        self.alwaysCheck = None
         self.diag = logging.getLogger("Check For Bugs")
 
     def addBugTrigger(self, getOption):
@@ -227,6 +375,47 @@ class FileBugData:
             self.identicalList.append(bugTrigger)
         else:
             self.presentList.append(bugTrigger)
+        self.alwaysCheck = None
+
+    def reset(self):
+        for bugTrigger in self.presentList + self.absentList + self.identicalList:
+            bugTrigger.textTrigger.reset()
+
+    def prepareLineFilter(self):
+        # Most lines match none of the triggers. One regular expression made from all of their lines tells us that,
+        # so only the lines it matches need checking trigger by trigger
+        if self.alwaysCheck is not None:
+            return
+        patterns, self.alwaysCheck = [], set()
+        for bugTrigger in self.presentList + self.absentList:
+            triggerPatterns = self.getCombinablePatterns(bugTrigger)
+            if triggerPatterns is None:
+                self.alwaysCheck.add(bugTrigger)
+            else:
+                patterns += triggerPatterns
+        try:
+            self.lineFilter = re.compile("|".join(patterns)) if patterns else None
+        except re.error:
+            self.lineFilter = None
+            self.alwaysCheck = set(self.presentList + self.absentList)
+        self.diag.info("Checking all lines for %d triggers, others only if they match %s",
+                       len(self.alwaysCheck), self.lineFilter)
+
+    def getCombinablePatterns(self, bugTrigger):
+        patterns = []
+        for trigger in bugTrigger.textTrigger.triggers:
+            if trigger.regex:
+                if trigger.regex.groupindex or self.backReferenceRegex.search(trigger.text):
+                    return
+                pattern = "(?:" + trigger.text + ")"
+                try:
+                    re.compile(pattern)
+                except re.error:
+                    return
+                patterns.append(pattern)
+            else:
+                patterns.append(re.escape(trigger.text))
+        return patterns
 
     def findBugs(self, fileName, execHosts, isChanged, multipleDiffs):
         if not self.checkUnchanged and not isChanged:
@@ -241,29 +430,43 @@ class FileBugData:
 
         self.diag.info("Looking for bugs in " + fileName)
         dirname = os.path.dirname(fileName)
-        return self.findBugsInText(open(fileName).readlines(), execHosts=execHosts, isChanged=isChanged, multipleDiffs=multipleDiffs, tmpDir=dirname)
+        with open(fileName) as f:
+            # Only triggers on identical files need the whole file at once
+            lines = f.readlines() if self.identicalList else f
+            return self.findBugsInText(lines, execHosts=execHosts, isChanged=isChanged, multipleDiffs=multipleDiffs, tmpDir=dirname)
 
     def findBugsInText(self, lines, **kw):
+        self.prepareLineFilter()
+        currPresent = copy(self.presentList)
         currAbsent = copy(self.absentList)
         bugs = []
         for bugTrigger in self.identicalList:
             if bugTrigger not in bugs and bugTrigger.exactMatch(lines, **kw):
                 bugs.append(bugTrigger)
+        diagnose = self.diag.isEnabledFor(logging.INFO)
         for line in lines:
-            self.diag.info("Checking " + repr(line))
-            for bugTrigger in self.presentList:
-                self.diag.info("Checking for existence of " + repr(bugTrigger))
-                if bugTrigger not in bugs and bugTrigger.hasBug(line, **kw):
-                    self.diag.info("FOUND!")
-                    bugs.append(bugTrigger)
-            toRemove = []
-            for bugTrigger in currAbsent:
-                self.diag.info("Checking for absence of " + repr(bugTrigger))
-                if bugTrigger.matchesText(line):
-                    self.diag.info("PRESENT!")
-                    toRemove.append(bugTrigger)
-            for bugTrigger in toRemove:
-                currAbsent.remove(bugTrigger)
+            if not currPresent and not currAbsent:
+                break
+            mayMatch = self.lineFilter is not None and self.lineFilter.search(line)
+            if not mayMatch and not self.alwaysCheck:
+                continue
+            if diagnose:
+                self.diag.info("Checking " + repr(line))
+            for bugTrigger in list(currPresent):
+                if mayMatch or bugTrigger in self.alwaysCheck:
+                    if diagnose:
+                        self.diag.info("Checking for existence of " + repr(bugTrigger))
+                    if bugTrigger.hasBug(line, **kw):
+                        self.diag.info("FOUND!")
+                        bugs.append(bugTrigger)
+                        currPresent.remove(bugTrigger)
+            for bugTrigger in list(currAbsent):
+                if mayMatch or bugTrigger in self.alwaysCheck:
+                    if diagnose:
+                        self.diag.info("Checking for absence of " + repr(bugTrigger))
+                    if bugTrigger.matchesText(line):
+                        self.diag.info("PRESENT!")
+                        currAbsent.remove(bugTrigger)
 
         return bugs + self.findAbsenceBugs(currAbsent, **kw)
 
@@ -288,6 +491,22 @@ class ParseMethod:
 
 
 class BugMap(OrderedDict):
+    prefetched = False
+
+    def getBugIds(self, bugSystem):
+        bugIds = []
+        for bugData in self.values():
+            for bugTrigger in bugData.presentList + bugData.absentList + bugData.identicalList:
+                bugInfo = bugTrigger.bugInfo
+                if isinstance(bugInfo, BugSystemBug) and bugInfo.bugSystem == bugSystem and bugInfo.bugId not in bugIds:
+                    bugIds.append(bugInfo.bugId)
+        return bugIds
+
+    def reset(self):
+        # Multi-line triggers remember how far they got, start again for each test
+        for bugData in self.values():
+            bugData.reset()
+
     def checkUnchanged(self):
         for bugData in list(self.values()):
             if bugData.checkUnchanged:
@@ -363,6 +582,10 @@ class CheckForCrashes(plugins.Action):
 
 
 class CheckForBugs(plugins.Action):
+    # Parsed knownbugs files, for each list of files, kept while none of them changes.
+    # The triggers remember where they got to in a file, so each thread has its own.
+    threadData = local()
+
     def __init__(self):
         self.diag = logging.getLogger("Check For Bugs")
 
@@ -377,7 +600,7 @@ class CheckForBugs(plugins.Action):
         newState, rerunCount = self.checkTest(test, test.state)
         if newState:
             test.changeState(newState)
-        if rerunCount and not test.app.isReconnecting() and not os.path.exists(test.makeBackupFileName(rerunCount)):
+        if rerunCount and not test.app.isReconnecting() and not test.hasBackup(rerunCount):
             self.describe(test, " - found an issue that triggered a rerun")
             test.saveState()
             # Current thread, must be done immediately or we might exit...
@@ -385,7 +608,7 @@ class CheckForBugs(plugins.Action):
             # for test synchronisation, mainly
             test.notify("RerunTriggered")
 
-        if test.state.category == "killed" and os.path.exists(test.makeBackupFileName(1)):
+        if test.state.category == "killed" and test.hasBackup(1):
             newState = test.restoreLatestBackup()
             if newState:
                 self.fixBackupMessage(newState)
@@ -405,6 +628,7 @@ class CheckForBugs(plugins.Action):
             if bugTrigger.bugInfo.rerunOnly:
                 return None, bugTrigger.bugInfo.rerunCount
             else:
+                self.prefetchBugInfo(test, bugTrigger.bugInfo, activeBugs)
                 absenceBug = bugTrigger in activeBugs[bugStem].absentList
                 category, briefText, fullText = bugTrigger.findBugInfo(test, bugStem, absenceBug)
                 self.diag.info("Changing to " + category + " with text " + briefText)
@@ -413,7 +637,16 @@ class CheckForBugs(plugins.Action):
         else:
             return None, 0
 
+    def prefetchBugInfo(self, test, bugInfo, activeBugs):
+        # Other tests are likely to hit the other bugs in the same bug system, get them all at once
+        if isinstance(bugInfo, BugSystemBug) and not activeBugs.prefetched:
+            activeBugs.prefetched = True
+            bugIds = activeBugs.getBugIds(bugInfo.bugSystem)
+            if len(bugIds) > 1:
+                bugInfo.prefetch(test, bugIds)
+
     def findAllBugs(self, test, state, activeBugs):
+        activeBugs.reset()
         multipleDiffs = self.hasMultipleDifferences(test, state)
         bugs, bugStems = [], []
         for stem, fileBugData in list(activeBugs.items()):
@@ -482,14 +715,30 @@ class CheckForBugs(plugins.Action):
         return diffCount > 1
 
     def readBugs(self, test):
-        bugMap = BugMap()
         # Mostly for backwards compatibility, reverse the list so that more specific bugs
         # get checked first.
-        for bugFile in reversed(test.getAllPathNames("knownbugs")):
+        bugFiles = tuple(reversed(test.getAllPathNames("knownbugs")))
+        signatures = list(map(self.getSignature, bugFiles))
+        bugMaps = self.threadData.__dict__.setdefault("bugMaps", {})
+        cachedSignatures, bugMap = bugMaps.get(bugFiles, (None, None))
+        if bugMap is not None and cachedSignatures == signatures:
+            return bugMap
+
+        bugMap = BugMap()
+        for bugFile in bugFiles:
             self.diag.info("Reading bugs from file " + bugFile)
             bugMap.readFromFile(bugFile)
+        bugMaps[bugFiles] = signatures, bugMap
         return bugMap
 
+    @staticmethod
+    def getSignature(fileName):
+        try:
+            stat = os.stat(fileName)
+            return stat.st_mtime_ns, stat.st_size
+        except OSError:
+            pass
+
     def fixBackupMessage(self, newState):
         newFreeText = ""
         backupRegex = re.compile(Bug.rerunLine.replace("%d", "[0-9]*").replace("(", "\\("))
@@ -3,6 +3,7 @@ import base64
 import json
 import re
 import os
+from . import BugSystemError
 
 def _makeURL(location, bugText):
     return location + "/_workitems/edit/" + bugText
@@ -103,39 +104,60 @@ def _handleHTTPError(http_error, location, rest_url):
     return "Failure while accessing '" + rest_url + "': \n" + message + "\n", internal_error
 
 
+fields_to_fetch = ["System.AssignedTo",
+                   "System.AreaPath",
+                   "System.CreatedDate",
+                   "Microsoft.VSTS.Common.Severity",
+                   "System.CreatedBy",
+                   "System.State",
+                   "System.ChangedDate",
+                   "System.Title"]
+
 def findBugInfo(bugId, location, username, password):
-    fields_to_fetch = ["System.AssignedTo",
-                       "System.AreaPath",
-                       "System.CreatedDate",
-                       "Microsoft.VSTS.Common.Severity",
-                       "System.CreatedBy",
-                       "System.State",
-                       "System.ChangedDate",
-                       "System.Title"]
     rest_url = location + "/_apis/wit/workitems?ids=" + bugId + "&api-version=7.1-preview.3&fields=" + ",".join(fields_to_fetch)
     if not password:
         # This variable is set in azure devops pipelines, make use of it
         password = os.getenv("SYSTEM_ACCESSTOKEN")
     if not username and not password:
         # We have no means of logging in, perhaps the user didn't want to. Be nice...
-        return findBugInfoWithoutLogin(bugId, location)
+        raise BugSystemError(*findBugInfoWithoutLogin(bugId, location))
 
     error_label = "AZURE DEVOPS ERROR"
     try:
         json_dict = _getJson(rest_url, username, password)
     except urllib.request.HTTPError as h:
         message, internal_error = _handleHTTPError(h, location, rest_url)
-        return error_label, message, internal_error, bugId
+        raise BugSystemError(error_label, message, internal_error, bugId)
     except Exception as e:
         message = "Exception while accessing '" + rest_url + "':\n" + str(e)  + "\n"
-        return error_label, message, False, bugId
+        raise BugSystemError(error_label, message, False, bugId)
 
     try:
         return _parseReply(json_dict, location, bugId)
     except Exception as e:
         message = "Failed to parse reply from '" + rest_url + "':\n" + str(e) + "\n"
-        raise
-        return "PARSE ERROR", message, False, bugId
+        raise BugSystemError("PARSE ERROR", message, False, bugId)
+
+
+# Several work items in one request. Anything that goes wrong just means they get looked up one at a time instead
+def findBugInfos(bugIds, location, username, password):
+    if not password:
+        password = os.getenv("SYSTEM_ACCESSTOKEN")
+    if not username and not password:
+        return {}
+    # Work items are at most 200 per request, and missing ones shouldn't fail the whole request
+    rest_url = location + "/_apis/wit/workitems?ids=" + ",".join(bugIds[:200]) + \
+        "&errorPolicy=omit&api-version=7.1-preview.3&fields=" + ",".join(fields_to_fetch)
+    try:
+        json_dict = _getJson(rest_url, username, password)
+        infos = {}
+        for item in json_dict["value"]:
+            if item:
+                bugId = str(item["id"])
+                infos[bugId] = _parseReply({"count": 1, "value": [item]}, location, bugId)
+        return infos
+    except Exception:
+        return {}
 
 
 # Used by Jenkins plugin
@@ -9,6 +9,7 @@
 
 import xmlrpc.client
 from collections import OrderedDict
+from . import BugSystemError
 
 def getEntry(dict, key):
     return dict.get(key, "UNKNOWN")
@@ -54,7 +55,7 @@ def parseReply(reply, location, id):
         message = ("Could not parse reply from bugzilla's web service, "
                    "maybe incompatible interface. Text of reply follows : \n"
                    + str(reply))
-        return "BAD SCRIPT", message, False, id
+        raise BugSystemError("BAD SCRIPT", message, False, id)
 
 
 def findBugInfo(bugId, location, *args):
@@ -63,7 +64,9 @@ def findBugInfo(bugId, location, *args):
     try:
         return parseReply(proxy.Bug.get_bugs({"ids": [bugId]}), location, bugId)
     except xmlrpc.client.Fault as e:
-        return "NONEXISTENT", e.faultString, False, bugId
+        raise BugSystemError("NONEXISTENT", e.faultString, False, bugId)
+    except BugSystemError:
+        raise
     except Exception as e:
         message = ("Failed to communicate with '" + scriptLocation + "': "
                    + str(e)
@@ -71,4 +74,4 @@ def findBugInfo(bugId, location, *args):
                    "'bug_system_location' points to a correct location of a "
                    "Bugzilla version 3.x installation. The current value is '"
                    + location + "'.")
-        return "BAD SCRIPT", message, False, bugId
+        raise BugSystemError("BAD SCRIPT", message, False, bugId)
@@ -4,6 +4,7 @@
 # server. Tested on bugzilla 2.16.
 
 import urllib.request
+from . import BugSystemError
 
 def findBugInfo(bugId, location, *args):
     bugzillaRequest = location + "/cli.cgi?bug=" + bugId
@@ -13,15 +14,15 @@ def findBugInfo(bugId, location, *args):
         message = "Failed to open URL '" + bugzillaRequest + "': " + str(e) + \
                   ".\n\nPlease make sure that the configuration entry 'bug_system_location' " + \
                   "points to the correct script to run to extract bugzilla information. The current value is '" + location + "'."
-        return "BAD SCRIPT", message, False, bugId
+        raise BugSystemError("BAD SCRIPT", message, False, bugId)
 
     if len(reply) == 1 and reply[0] == "":
         message = "Bug " + bugId + " could not be found in the Bugzilla version 2 instance at " + location + "."
-        return "NONEXISTENT", message, False, bugId
+        raise BugSystemError("NONEXISTENT", message, False, bugId)
     elif len(reply) < 8:
         message = "Could not parse reply from Bugzilla's cli.cgi script, maybe incompatible interface (this only works on version 2). Text of reply follows : \n" + \
             reply[0]
-        return "BAD SCRIPT", message, False, bugId
+        raise BugSystemError("BAD SCRIPT", message, False, bugId)
 
     status = reply[4]
     bugText = "******************************************************\n" + \
@@ -6,6 +6,7 @@ import os
 import sys
 import ssl
 import urllib.request
+from . import BugSystemError
 import json
 
 
@@ -27,10 +28,10 @@ def findBugInfo(bugId, location, *args):
                    "and that the configuration entry 'bug_system_location' " +
                    "points to the correct GitHub repository.\nThe current value is '" + location +
                    "', it often looks like: 'https://api.github.com/repos/<user>/<repo>/'.")
-        return "NONEXISTENT", message, False, bugId
+        raise BugSystemError("NONEXISTENT", message, False, bugId)
     if len(info) <= 1:
         message = "Could not parse reply from GitHub, maybe incompatible interface."
-        return "BAD SCRIPT", message, False, bugId
+        raise BugSystemError("BAD SCRIPT", message, False, bugId)
     bugText = "******************************************************\n" + \
         "Ticket #%s (%s)\n" % (bugId, info['state']) + \
         "%s\n%sticket/%s\n" % (info['title'], location, bugId) + \
@@ -41,7 +42,10 @@ def findBugInfo(bugId, location, *args):
     return info['state'], bugText, info['state'] == "closed", bugId
 
 
-if __name__ == "__main__":  # pragma: no cover - test code
-    import sys
-    for item in findBugInfo(sys.argv[1], sys.argv[2]):
+if __name__ == "__main__":  # pragma: no cover - test code, run with python -m texttestlib.default.knownbugs.github
+    try:
+        info = findBugInfo(sys.argv[1], sys.argv[2])
+    except BugSystemError as e:
+        info = e.getInfo()
+    for item in info:
         print(item)
@@ -1,7 +1,9 @@
 import urllib.request
+import urllib.parse
 import base64
 import json
 import re
+from . import BugSystemError
 
 def _makeURL(location, bugText):
     return location + "/browse/" + bugText
@@ -90,17 +92,18 @@ def _handleHTTPError(http_error, location, rest_url):
     return "Failure while accessing '" + rest_url + "': \n" + message + "\n", internal_error
 
 
+fields_to_fetch = ["assignee",
+                   "components",
+                   "created",
+                   "description",
+                   "priority",
+                   "reporter",
+                   "resolution",
+                   "status",
+                   "updated",
+                   "summary"]
+
 def findBugInfo(bugId, location, username, password):
-    fields_to_fetch = ["assignee",
-                       "components",
-                       "created",
-                       "description",
-                       "priority",
-                       "reporter",
-                       "resolution",
-                       "status",
-                       "updated",
-                       "summary"]
     rest_url = location + "/rest/api/2/issue/" + bugId \
         + "?fields=" + ",".join(fields_to_fetch)
 
@@ -109,16 +112,32 @@ def findBugInfo(bugId, location, username, password):
         json_dict = _getJson(rest_url, username, password)
     except urllib.request.HTTPError as h:
         message, internal_error = _handleHTTPError(h, location, rest_url)
-        return jira_error_label, message, internal_error, bugId
+        raise BugSystemError(jira_error_label, message, internal_error, bugId)
     except Exception as e:
         message = "Exception while accessing '" + rest_url + "':\n" + str(e)  + "\n"
-        return jira_error_label, message, False, bugId
+        raise BugSystemError(jira_error_label, message, False, bugId)
 
     try:
         return _parseReply(json_dict, location)
     except Exception as e:
         message = "Failed to parse reply from '" + rest_url + "':\n" + str(e) + "\n"
-        return "PARSE ERROR", message, False, bugId
+        raise BugSystemError("PARSE ERROR", message, False, bugId)
+
+
+# Several bugs in one search. Anything that goes wrong just means they get looked up one at a time instead
+def findBugInfos(bugIds, location, username, password):
+    jql = "key in (" + ",".join(bugIds) + ")"
+    rest_url = location + "/rest/api/2/search?" + \
+        urllib.parse.urlencode({"jql": jql, "fields": ",".join(fields_to_fetch), "maxResults": len(bugIds)})
+    try:
+        json_dict = _getJson(rest_url, username, password)
+        infos = {}
+        for issue in json_dict["issues"]:
+            info = _parseReply(issue, location)
+            infos[info[3]] = info
+        return infos
+    except Exception:
+        return {}
 
 
 # Used by Jenkins plugin
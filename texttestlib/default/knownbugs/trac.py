@@ -6,6 +6,7 @@ import os
 import sys
 import ssl
 import urllib.request
+from . import BugSystemError
 
 def findBugInfo(bugId, location, *args):
     if location and location[-1] != '/':
@@ -23,12 +24,12 @@ def findBugInfo(bugId, location, *args):
                   ".\n\nPlease make sure that bug " + bugId + " exists\n" + \
                   "and that the configuration entry 'bug_system_location' " + \
                   "points to the correct trac instance.\nThe current value is '" + location + "'."
-        return "NONEXISTENT", message, False, bugId
+        raise BugSystemError("NONEXISTENT", message, False, bugId)
     keys = content[0].split('\t')
     values = ("".join(content[1:])).split('\t')
     if len(keys) == 1 or len(keys) > len(values):
         message = "Could not parse reply from trac, maybe incompatible interface."
-        return "BAD SCRIPT", message, False, bugId
+        raise BugSystemError("BAD SCRIPT", message, False, bugId)
     info = {'status': '', 'description': '', 'reporter': '', 'resolution': '', 'component': '', 'summary': '',
             'priority': '', 'version': '', 'milestone': '', 'owner': '', 'type': ''}
     for k, v in zip(keys, values):
@@ -44,7 +45,10 @@ def findBugInfo(bugId, location, *args):
     return info['status'], bugText, info['status'] == "closed", bugId
 
 
-if __name__ == "__main__":  # pragma: no cover - test code
-    import sys
-    for item in findBugInfo(sys.argv[1], sys.argv[2]):
+if __name__ == "__main__":  # pragma: no cover - test code, run with python -m texttestlib.default.knownbugs.trac
+    try:
+        info = findBugInfo(sys.argv[1], sys.argv[2])
+    except BugSystemError as e:
+        info = e.getInfo()
+    for item in info:
         print(item)
@@ -2,12 +2,16 @@
 
 
 import os
+import re
 import logging
 import shutil
 from texttestlib.default import fpdiff
+from texttestlib.default.filtercache import FilterCache, DigestRegistry
 from texttestlib import plugins
 from optparse import OptionParser
 from io import StringIO
+from multiprocessing import cpu_count
+from concurrent.futures import ThreadPoolExecutor
 
 
 class Filtering(plugins.TestState):
@@ -18,6 +22,8 @@ class Filtering(plugins.TestState):
 
 
 class FilterAction(plugins.Action):
+    runInParallel = False
+
     def __init__(self, useFilteringStates=False):
         self.diag = logging.getLogger("Filter Actions")
         self.useFilteringStates = useFilteringStates
@@ -26,11 +32,25 @@ class FilterAction(plugins.Action):
         if self.useFilteringStates:
             self.changeToFilteringState(test)
 
+        # Set up all the filters first : they read the configuration, which isn't thread-safe
+        cache = FilterCache.create(test)
+        filterArgs = []
         for fileName, postfix in self.filesToFilter(test):
-            self.diag.info("Considering for filtering : " + fileName)
+            self.diag.info("Considering for filtering : %s", fileName)
             stem = self.getStem(fileName)
             newFileName = test.makeTmpFileName(stem + "." + test.app.name + postfix, forFramework=1)
-            self.performAllFilterings(test, stem, fileName, newFileName)
+            filters = self.makeAllFilters(test, stem, test.app)
+            if len(filters) > 0:
+                filterArgs.append((filters, fileName, newFileName, cache))
+
+        if self.runInParallel and len(filterArgs) > 1:
+            with ThreadPoolExecutor(max_workers=min(len(filterArgs), cpu_count())) as executor:
+                futures = [executor.submit(self.performAllFilterings, *args) for args in filterArgs]
+                for future in futures:
+                    future.result()
+        else:
+            for args in filterArgs:
+                self.performAllFilterings(*args)
 
     def getStem(self, fileName):
         return os.path.basename(fileName).split(".")[0]
@@ -38,23 +58,40 @@ class FilterAction(plugins.Action):
     def changeToFilteringState(self, *args):  # pragma: no cover - documentation only
         pass
 
-    def performAllFilterings(self, test, stem, fileName, newFileName):
-        currFileName = fileName
-        filters = self.makeAllFilters(test, stem, test.app)
-        for fileFilter in filters:
-            writeFileName = newFileName + "." + fileFilter.postfix
-            self.diag.info("Applying " + fileFilter.__class__.__name__ +
-                           " to make\n" + writeFileName + " from\n " + currFileName)
-            if os.path.isfile(writeFileName):
-                self.diag.info("Removing previous file at " + writeFileName)
-                os.remove(writeFileName)
-            currFile = open(currFileName, errors="ignore")
-            writeFile = plugins.openForWrite(writeFileName)
-            fileFilter.filterFile(currFile, writeFile)
-            writeFile.close()
-            currFileName = writeFileName
-        if len(filters) > 0 and currFileName != newFileName:
-            shutil.move(currFileName, newFileName)
+    def performAllFilterings(self, filters, fileName, newFileName, cache=None):
+        # Whatever we knew about the file is about to be out of date, maybe without its signature changing
+        DigestRegistry.forget(newFileName)
+        intermediatePostfixes = [f.postfix for f in filters[:-1] if f.keepIntermediate]
+        if cache:
+            key = cache.makeKey(fileName, filters)
+            if cache.restore(key, newFileName, intermediatePostfixes):
+                return
+
+        self.applyFilters(filters, fileName, newFileName)
+        if cache:
+            cache.store(key, newFileName, intermediatePostfixes)
+
+    def applyFilters(self, filters, fileName, newFileName):
+        # Stream the lines through all the filters in one go. Only write intermediate files that someone will look at
+        with open(fileName, errors="ignore") as currFile:
+            lines = currFile
+            for index, fileFilter in enumerate(filters):
+                self.diag.info("Applying %s to make\n%s from\n %s", fileFilter.__class__.__name__, newFileName, fileName)
+                lines = fileFilter.filterLines(lines)
+                writeFileName = newFileName + "." + fileFilter.postfix
+                if os.path.isfile(writeFileName):
+                    self.diag.info("Removing previous file at " + writeFileName)
+                    os.remove(writeFileName)
+                if fileFilter.keepIntermediate and index < len(filters) - 1:
+                    lines = self.writeIntermediate(lines, writeFileName)
+            with plugins.openForWrite(newFileName) as writeFile:
+                writeFile.writelines(lines)
+
+    def writeIntermediate(self, lines, writeFileName):
+        with plugins.openForWrite(writeFileName) as writeFile:
+            for line in lines:
+                writeFile.write(line)
+                yield line
 
     def getAllFilters(self, test, fileName, app):
         stem = self.getStem(fileName)
@@ -62,22 +99,12 @@ class FilterAction(plugins.Action):
 
     def getFilteredText(self, test, fileName, app):
         filters = self.getAllFilters(test, fileName, app)
-        inFile = open(fileName, errors="ignore")
-        if len(filters) == 0:
-            try:
-                return inFile.read()
-            finally:
-                inFile.close()
-        for fileFilter in filters:
-            self.diag.info("Applying " + fileFilter.__class__.__name__ + " to " + fileName)
-            outFile = StringIO()
-            fileFilter.filterFile(inFile, outFile)
-            inFile.close()
-            inFile = outFile
-            inFile.seek(0)
-        value = outFile.getvalue()
-        outFile.close()
-        return value
+        with open(fileName, errors="ignore") as inFile:
+            lines = inFile
+            for fileFilter in filters:
+                self.diag.info("Applying %s to %s", fileFilter.__class__.__name__, fileName)
+                lines = fileFilter.filterLines(lines)
+            return "".join(lines)
 
     def makeAllFilters(self, test, stem, app):
         filters = self._makeAllFilters(test, stem, app)
@@ -108,6 +135,8 @@ class FilterAction(plugins.Action):
 
 
 class FilterOriginal(FilterAction):
+    runInParallel = True
+
     def filesToFilter(self, test):
         resultFiles, defFiles = test.listApprovedFiles(allVersions=False, defFileCategory="regenerate")
         return self.constantPostfix(resultFiles + defFiles, "origcmp")
@@ -126,16 +155,19 @@ class FilterOnTempFile(FilterAction):
         floatTolerance = test.getCompositeConfigValue("floating_point_tolerance", stem)
         relTolerance = test.getCompositeConfigValue("relative_float_tolerance", stem)
         floatSplit = test.getCompositeConfigValue("floating_point_split", stem)
+        floatAlignment = test.getCompositeConfigValue("floating_point_alignment", stem)
         if floatTolerance or relTolerance:
             origFile = test.makeTmpFileName(stem + "." + app.name + "origcmp", forFramework=1)
             if not os.path.isfile(origFile):
                 origFile = test.getFileName(stem)
             if origFile and os.path.isfile(origFile):
-                filters.append(FloatingPointFilter(origFile, floatTolerance, relTolerance, floatSplit))
+                filters.append(FloatingPointFilter(origFile, floatTolerance, relTolerance, floatSplit, floatAlignment))
         return filters
 
 
 class FilterTemporary(FilterOnTempFile):
+    runInParallel = True
+
     def filesToFilter(self, test):
         return self.constantPostfix(test.listTmpFiles(), "cmp")
 
@@ -180,28 +212,50 @@ class FilterResultRecompute(FilterOnTempFile):
 
 class FloatingPointFilter:
     postfix = "fpdiff"
+    keepIntermediate = False
 
-    def __init__(self, origFileName, tolerance, relative, split):
+    def __init__(self, origFileName, tolerance, relative, split, alignment=""):
         self.origFileName = origFileName
         self.tolerance = tolerance if tolerance else None
         self.relative = relative if relative else None
         self.split = split
+        self.alignment = alignment
+
+    def getCacheKey(self):
+        return self.__class__.__name__ + DigestRegistry.getDigest(self.origFileName) + \
+            repr((self.tolerance, self.relative, self.split, self.alignment))
 
     def filterFile(self, inFile, writeFile):
-        fromlines = open(self.origFileName, errors="ignore").readlines()
-        tolines = inFile.readlines()
-        fpdiff.fpfilter(fromlines, tolines, writeFile, self.tolerance, self.relative, split=self.split)
+        with open(self.origFileName, errors="ignore") as origFile:
+            fromlines = origFile.readlines()
+        tolines = list(inFile)
+        fpdiff.fpfilter(fromlines, tolines, writeFile, self.tolerance, self.relative,
+                        split=self.split, alignment=self.alignment)
+
+    def filterLines(self, lines):
+        # Needs the whole file to align it with the original, so this one can't stream
+        writeFile = StringIO()
+        self.filterFile(lines, writeFile)
+        writeFile.seek(0)
+        yield from writeFile
 
 
 class RunDependentTextFilter(plugins.Observable):
     configKey = "run_dependent_text"
     postfix = "normal"
+    # Viewed in the GUI and saved by save_filtered_file_stems, when other filters follow
+    keepIntermediate = True
 
     def __init__(self, filterTexts, testId=""):
         plugins.Observable.__init__(self)
         self.diag = logging.getLogger("Run Dependent Text")
+        self.filterTexts = filterTexts
+        self.testId = testId
         self.lineFilters = [LineFilter(text, testId, self.diag) for text in filterTexts]
 
+    def getCacheKey(self):
+        return self.__class__.__name__ + repr((self.filterTexts, self.testId))
+
     def findRelevantFilters(self, file):
         relevantFilters, sectionFilters = [], []
         for lineFilter in self.lineFilters:
@@ -244,38 +298,58 @@ class RunDependentTextFilter(plugins.Observable):
         for sectionFilter in sectionFilters:
             sectionFilter.trigger.reset()
             sectionFilter.untrigger.reset()
-        file.seek(0)
+        if hasattr(file, "seek"):
+            file.seek(0)
         return relevantFilters
 
+    def hasSectionFilters(self):
+        return any((lineFilter.untrigger is not None for lineFilter in self.lineFilters))
+
     def filterFile(self, file, newFile, filteredAway=None):
+        newFile.writelines(self.filterLines(file, filteredAway))
+
+    def filterLines(self, lines, filteredAway=None):
+        if self.hasSectionFilters() and not hasattr(lines, "seek"):
+            lines = list(lines)  # we need to read them twice
         lineNumber = 0
         seekPoints = []
-        lineFilters = self.findRelevantFilters(file)
-        for line in file:
+        lineFilters = self.findRelevantFilters(lines)
+        triggerMatcher = CombinedTriggerMatcher.create(lineFilters)
+        # {PREVLINES} can remove lines we've already filtered, so we can't pass anything on until we're done
+        canRemovePrevious = any((lineFilter.prevLinesToRemove for lineFilter, _ in lineFilters))
+        written = []
+        for line in lines:
             # We don't want to stack up ActionProgreess calls in ThreaderNotificationHandler ...
-            self.notifyIfMainThread("ActionProgress")
+            self.notifyProgressIfMainThread()
             lineNumber += 1
-            lineFilter, filteredLine, removeCount = self.getFilteredLine(line, lineNumber, lineFilters)
+            lineFilter, filteredLine, removeCount = self.getFilteredLine(line, lineNumber, lineFilters, triggerMatcher)
             if removeCount:
                 seekPoint = seekPoints[-removeCount - 1] if removeCount < len(seekPoints) else 0
-                self.diag.info("Removing " + repr(removeCount) + " lines")
-                newFile.seek(seekPoint)
-                newFile.truncate()
+                self.diag.info("Removing %r lines", removeCount)
+                del written[seekPoint:]
                 seekPoints = []
             if filteredLine:
-                newFile.write(filteredLine)
+                if canRemovePrevious:
+                    written.append(filteredLine)
+                else:
+                    yield filteredLine
             else:
                 if filteredAway is not None and lineFilter is not None:
                     filteredAway.setdefault(lineFilter, []).append(line)
-            seekPoints.append(newFile.tell())
+            seekPoints.append(len(written))
+        yield from written
 
-    def getFilteredLine(self, line, lineNumber, lineFilters):
+    def getFilteredLine(self, line, lineNumber, lineFilters, triggerMatcher=None):
         appliedLineFilter = None
         filteredLine = line
         linesToRemove = 0
         filtersToRemove = []
         alreadyFilteredAway = False
+        # If none of the simple triggers can match this line, the filters that use them need not be asked
+        anyTriggerMatches = triggerMatcher is None or triggerMatcher.matches(line)
         for lineFilter, lastRelevantLine in lineFilters:
+            if not anyTriggerMatches and lastRelevantLine is None and triggerMatcher.canSkip(lineFilter):
+                continue
             changed, currFilteredLine, removeCount = lineFilter.applyTo(line, lineNumber, alreadyFilteredAway)
             if lastRelevantLine is not None and lineNumber >= lastRelevantLine:
                 filtersToRemove.append((lineFilter, lastRelevantLine))
@@ -285,6 +359,8 @@ class RunDependentTextFilter(plugins.Observable):
                 linesToRemove = max(removeCount, linesToRemove)
                 if currFilteredLine and filteredLine:
                     line = currFilteredLine
+                    # Line has changed, so what we know about which triggers match it no longer applies
+                    anyTriggerMatches = True
                 if filteredLine:
                     filteredLine = currFilteredLine
                 if currFilteredLine is None:
@@ -295,25 +371,80 @@ class RunDependentTextFilter(plugins.Observable):
         return appliedLineFilter, filteredLine, linesToRemove
 
 
+class CombinedTriggerMatcher:
+    # Compiled patterns are shared between all tests and files with the same filters
+    compiledPatterns = {}
+    # Patterns that can't safely be part of a bigger one : back references and global flags
+    unsafePattern = re.compile(r"\\[1-9]|\(\?P=|\(\?[aiLmsux]+\)")
+
+    def __init__(self, regex, lineFilters):
+        self.regex = regex
+        self.lineFilters = lineFilters
+
+    @classmethod
+    def create(cls, lineFilters):
+        patterns, coveredFilters = [], set()
+        for lineFilter, _ in lineFilters:
+            pattern = cls.getPattern(lineFilter.trigger)
+            if pattern is not None:
+                if pattern not in patterns:
+                    patterns.append(pattern)
+                coveredFilters.add(lineFilter)
+        if len(coveredFilters) > 1:
+            regex = cls.compilePatterns(tuple(patterns))
+            if regex is not None:
+                return cls(regex, coveredFilters)
+
+    @classmethod
+    def getPattern(cls, trigger):
+        # Line number triggers have nothing to do with the text. MatchNumberTriggers count matches, so it's fine to skip them when they don't match
+        if not isinstance(trigger, plugins.TextTrigger) or isinstance(trigger, plugins.MultilineTextTrigger):
+            return
+        if trigger.regex is None:
+            return re.escape(trigger.text)
+        elif not cls.unsafePattern.search(trigger.text):
+            return trigger.text
+
+    @classmethod
+    def compilePatterns(cls, patterns):
+        if patterns not in cls.compiledPatterns:
+            try:
+                regex = re.compile("|".join("(?:" + pattern + ")" for pattern in patterns))
+            except re.error:
+                regex = None
+            cls.compiledPatterns[patterns] = regex
+        return cls.compiledPatterns[patterns]
+
+    def matches(self, line):
+        return self.regex.search(line) is not None
+
+    def canSkip(self, lineFilter):
+        # Filters in the middle of removing several lines must always be applied
+        return lineFilter.autoRemove == 0 and lineFilter in self.lineFilters
+
+
 class UnorderedTextFilter(RunDependentTextFilter):
     configKey = "unordered_text"
     postfix = "sorted"
+    keepIntermediate = False
 
     def filterFile(self, file, newFile):
+        newFile.writelines(self.filterLines(file))
+
+    def filterLines(self, lines):
         unorderedLines = {}
-        RunDependentTextFilter.filterFile(self, file, newFile, unorderedLines)
-        self.writeUnorderedText(newFile, unorderedLines)
+        yield from RunDependentTextFilter.filterLines(self, lines, unorderedLines)
+        yield from self.getUnorderedText(unorderedLines)
 
-    def writeUnorderedText(self, newFile, lines):
+    def getUnorderedText(self, lines):
         for filter in self.lineFilters:
             unordered = lines.get(filter, [])
             if len(unordered) == 0:
                 continue
             unordered.sort()
-            newFile.write("-- Unordered text as found by filter '" + filter.originalText + "' --" + "\n")
-            for line in unordered:
-                newFile.write(line)
-            newFile.write("\n")
+            yield "-- Unordered text as found by filter '" + filter.originalText + "' --" + "\n"
+            yield from unordered
+            yield "\n"
 
 
 class LineNumberTrigger:
@@ -471,7 +602,7 @@ class LineFilter:
             return False, None, 0
 
         if self.trigger.matches(line, lineNumber):
-            self.diag.info(repr(self.trigger) + " matched " + line.rstrip())
+            self.diag.info("%r matched %s", self.trigger, line.rstrip())
             return self.applyMatchingTrigger(line)
         else:
             return False, line, 0
@@ -479,7 +610,7 @@ class LineFilter:
     def applyAutoRemove(self, line):
         if self.untrigger:
             if self.untrigger.matches(line.rstrip()):
-                self.diag.info(repr(self.untrigger) + " (end) matched " + line.rstrip())
+                self.diag.info("%r (end) matched %s", self.untrigger, line.rstrip())
                 self.autoRemove = 0
                 if self.divider.endswith("]}"):
                     return True, None, 0
@@ -502,9 +633,9 @@ class LineFilter:
             stripped = line.rstrip()
             postfix = line.replace(stripped, "", 1)
             words = stripped.split(" ")
-            self.diag.info("Removing word " + str(self.wordNumber) + " from " + repr(words))
+            self.diag.info("Removing word %s from %r", self.wordNumber, words)
             realNumber = self.findRealWordNumber(words)
-            self.diag.info("Real number was " + str(realNumber))
+            self.diag.info("Real number was %s", realNumber)
             if realNumber < len(words):
                 if self.removeWordsAfter:
                     words = words[:realNumber]
@@ -45,10 +45,11 @@ class RunTest(plugins.Action):
     def __init__(self):
         self.diag = logging.getLogger("run test")
         self.killDiag = logging.getLogger("kill processes")
-        self.currentProcess = None
-        self.currentTimer = None
+        # All keyed by test, as several tests may be running at once
+        self.currentProcesses = {}
+        self.currentTimers = {}
         self.killedTests = []
-        self.killSignal = None
+        self.killSignals = {}
         self.lock = Lock()
 
     def __repr__(self):
@@ -72,27 +73,24 @@ class RunTest(plugins.Action):
         # Default to not bothering to print the machine name: all is local anyway
         return ""
 
-    def startTimer(self, timer):
-        self.currentTimer = timer
-        self.currentTimer.start()
+    def getKillSignal(self, test):
+        return self.killSignals.get(test)
 
-    def runMultiTimer(self, timeout, method, args):
+    def startTimer(self, test, timer):
+        self.currentTimers[test] = timer
+        timer.start()
+
+    def runMultiTimer(self, test, timeout, method, args):
         # Break the timer up into 5 sub-timers
         # The point is to prevent timing out too early if the process gets suspended
         subTimerCount = 5  # whatever
         subTimerTimeout = float(timeout) / subTimerCount
         timer = Timer(subTimerTimeout, method, args)
         for _ in range(subTimerCount - 1):
-            timer = Timer(subTimerTimeout, self.startTimer, [timer])
-        self.startTimer(timer)
+            timer = Timer(subTimerTimeout, self.startTimer, [test, timer])
+        self.startTimer(test, timer)
 
     def runTest(self, test):
-        # If previous test (or test run) timed out, don't leave killSignal set, other tests can still run here
-        if self.killSignal == "timeout":
-            self.killSignal = None
-            if test in self.killedTests:
-                self.killedTests.remove(test)
-
         self.describe(test)
         machine = test.app.getRunMachine()
         killTimeout = test.getConfigValue("kill_timeout")
@@ -108,15 +106,23 @@ class RunTest(plugins.Action):
                 self.changeToRunningState(test)
 
             if killTimeout and not test.app.isRecording() and not test.app.isActionReplay():
-                self.runMultiTimer(killTimeout, self.kill, (test, "timeout"))
+                self.runMultiTimer(test, killTimeout, self.kill, (test, "timeout"))
                 self.wait(process)
-                self.currentTimer.cancel()
-                self.currentTimer = None
+                self.currentTimers.pop(test).cancel()
             else:
                 self.wait(process)
             self.checkAndClear(test, postfix)
-            if self.killSignal is not None:
+            if self.getKillSignal(test) is not None:
                 break  # Don't start other processes
+        self.forgetKill(test)
+
+    def forgetKill(self, test):
+        # The test is done with, it may yet be rerun, and we don't want to keep all the tests anyway
+        self.lock.acquire()
+        self.killSignals.pop(test, None)
+        if test in self.killedTests:
+            self.killedTests.remove(test)
+        self.lock.release()
 
     def getTestRunPostfixes(self, test):
         postfixes = [""]
@@ -127,7 +133,7 @@ class RunTest(plugins.Action):
 
     def registerProcess(self, test, process):
         self.lock.acquire()
-        self.currentProcess = process
+        self.currentProcesses[test] = process
         if test in self.killedTests:
             self.killProcess(test)
         self.lock.release()
@@ -138,14 +144,14 @@ class RunTest(plugins.Action):
         file.close()
 
     def checkAndClear(self, test, postfix):
-        returncode = self.currentProcess.returncode
+        returncode = self.currentProcesses[test].returncode
         self.diag.info("Process terminated with return code " + repr(returncode))
         if os.name == "posix" and test not in self.killedTests and returncode < 0:
             # Process externally killed, but we haven't been notified. Wait for a while to see if we get kill notification
-            self.waitForKill()
+            self.waitForKill(test)
 
         self.lock.acquire()
-        self.currentProcess = None
+        del self.currentProcesses[test]
         if test in self.killedTests:
             self.changeToKilledState(test)
         elif returncode:  # Don't bother to store return code when tests are killed, it isn't interesting
@@ -153,10 +159,10 @@ class RunTest(plugins.Action):
 
         self.lock.release()
 
-    def waitForKill(self):
+    def waitForKill(self, test):
         for _ in range(10):
             sleep(0.2)
-            if self.killSignal is not None:
+            if self.getKillSignal(test) is not None:
                 return
 
     def changeToKilledState(self, test):
@@ -166,13 +172,14 @@ class RunTest(plugins.Action):
         test.changeState(Killed(briefText, freeText, test.state))
 
     def getKillInfo(self, test):
-        if self.killSignal is None or self.killSignal == signal.SIGINT or (self.killSignal == 0 and os.name == "nt"):
+        killSignal = self.getKillSignal(test)
+        if killSignal is None or killSignal == signal.SIGINT or (killSignal == 0 and os.name == "nt"):
             return self.getExplicitKillInfo()
-        elif self.killSignal == "timeout":
+        elif killSignal == "timeout":
             return "TIMEOUT", "exceeded wallclock time limit of " + str(test.getConfigValue("kill_timeout")) + " seconds"
-        elif self.killSignal == signal.SIGTERM:
+        elif killSignal == signal.SIGTERM:
             return "TERMINATED", "terminated via SIGTERM signal"
-        elif hasattr(signal, "SIGXCPU") and self.killSignal == signal.SIGXCPU:
+        elif hasattr(signal, "SIGXCPU") and killSignal == signal.SIGXCPU:
             return "CPULIMIT", "exceeded maximum cpu time allowed"
         else:
             return self.getKillInfoOtherSignal(test)
@@ -186,7 +193,7 @@ class RunTest(plugins.Action):
         return str(sigNum)
 
     def getKillInfoOtherSignal(self, test):
-        briefText = self.getSignalName(self.killSignal)
+        briefText = self.getSignalName(self.getKillSignal(test))
         return briefText, "terminated by signal " + briefText
 
     def getExplicitKillInfo(self):
@@ -196,8 +203,8 @@ class RunTest(plugins.Action):
     def kill(self, test, sig):
         self.lock.acquire()
         self.killedTests.append(test)
-        self.killSignal = sig
-        if self.currentProcess is not None:
+        self.killSignals[test] = sig
+        if test in self.currentProcesses:
             self.killProcess(test)
         self.lock.release()
 
@@ -205,8 +212,9 @@ class RunTest(plugins.Action):
         machine = test.app.getRunMachine()
         if machine != "localhost" and test.getConfigValue("remote_shell_program") == "ssh":
             self.killRemoteProcess(test, machine)
-        self.killDiag.info("Killing running test (process id " + str(self.currentProcess.pid) + ")")
-        killProcessAndChildren(self.currentProcess.pid, cmd=test.getConfigValue("kill_command"))
+        pid = self.currentProcesses[test].pid
+        self.killDiag.info("Killing running test (process id " + str(pid) + ")")
+        killProcessAndChildren(pid, cmd=test.getConfigValue("kill_command"))
 
     def killRemoteProcess(self, test, machine):
         tmpDir = self.getTmpDirectory(test)
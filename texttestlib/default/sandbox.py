@@ -6,14 +6,24 @@ import subprocess
 import glob
 import logging
 import difflib
-import time
 import sys
+import hashlib
+from tempfile import mkstemp
+from threading import Lock
 from texttestlib import plugins
 from texttestlib.jobprocess import killProcessAndChildren
 from .runtest import Killed
 from collections import OrderedDict
 from string import Template
 
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+# From linux/fs.h : make the target share the source's data blocks until either is written to
+FICLONE = 0x40049409
+
 
 def getScriptArgs(script):
     args = script.split()
@@ -35,6 +45,10 @@ class MakeWriteDirectory(plugins.Action):
 
 class PrepareWriteDirectory(plugins.Action):
     storytextDirsCopied = set()
+    dataStoreName = ".shared_test_data"
+    dataStoreLock = Lock()
+    dataStoreFileLocks = {}
+    storeCanClone = True
 
     def __init__(self, ignoreCatalogues):
         self.diag = logging.getLogger("Prepare Writedir")
@@ -183,14 +197,16 @@ class PrepareWriteDirectory(plugins.Action):
             except OSError:
                 pass  # If this doesn't work, assume it's on the remote machine and we'll handle it later
 
+        method = test.getCompositeConfigValue("copy_test_path_method", os.path.basename(target))
+        storeDir = os.path.join(test.app.writeDirectory, self.dataStoreName)
         if os.path.isfile(fullPath):
             if os.path.isfile(target):
                 with open(target, "a") as f:
                     f.write(open(fullPath).read())
             else:
-                self.copyfile(fullPath, target)
+                self.copyfile(fullPath, target, method, storeDir)
         if os.path.isdir(fullPath):
-            self.copytree(fullPath, target)
+            self.copytree(fullPath, target, method, storeDir)
 
     def copytimes(self, src, dst):
         if os.path.isdir(src) and os.name == "nt":
@@ -201,7 +217,7 @@ class PrepareWriteDirectory(plugins.Action):
         if hasattr(os, 'utime'):
             os.utime(dst, (st[stat.ST_ATIME], st[stat.ST_MTIME]))
 
-    def copytree(self, src, dst):
+    def copytree(self, src, dst, method="copy", storeDir=None):
         # Code is a copy of shutil.copytree, with copying modification times
         # so that we can tell when things change...
         names = os.listdir(src)
@@ -216,9 +232,9 @@ class PrepareWriteDirectory(plugins.Action):
                 if os.path.islink(srcname):
                     self.copylink(srcname, dstname)
                 elif os.path.isdir(srcname):
-                    self.copytree(srcname, dstname)
+                    self.copytree(srcname, dstname, method, storeDir)
                 else:
-                    self.copyfile(srcname, dstname)
+                    self.copyfile(srcname, dstname, method, storeDir)
             except (IOError, os.error) as why:
                 print("Can't copy", srcname, "to", dstname, ":", why)
         # Last of all, keep the modification time as it was
@@ -230,11 +246,95 @@ class PrepareWriteDirectory(plugins.Action):
             linkto = os.readlink(srcname)
         os.symlink(linkto, dstname)
 
-    def copyfile(self, srcname, dstname):
+    def copyfile(self, srcname, dstname, method="copy", storeDir=None):
+        if method == "readonly" and storeDir:
+            # Hard links need the same file system, and tests shouldn't share the original
+            srcname = self.getStoredFile(srcname, storeDir)
+        if method != "copy" and self.shareFile(srcname, dstname, method, storeDir):
+            return
         # Basic aim is to keep the permission bits and times where possible, but ensure it is writeable
         shutil.copy2(srcname, dstname)
         plugins.makeWriteable(dstname)
 
+    def shareFile(self, srcname, dstname, method, storeDir=None):
+        if self.cloneFile(srcname, dstname) or self.cloneViaStore(srcname, dstname, method, storeDir):
+            return True
+        if method == "readonly":
+            try:
+                os.link(srcname, dstname)
+                self.diag.info("Hard linked " + srcname + " to " + dstname)
+                return True
+            except OSError as e:
+                self.diag.info("Failed to hard link " + srcname + " : " + str(e))
+        return False
+
+    def cloneViaStore(self, srcname, dstname, method, storeDir):
+        # Clones only work within a file system: bring the file into the write directory's one first, if that can clone at all
+        if method != "clone" or not storeDir or not self.storeCanClone or not self.onOtherFileSystem(srcname, dstname):
+            return False
+        storedFile = self.getStoredFile(srcname, storeDir)
+        if storedFile == srcname:
+            return False
+        if self.cloneFile(storedFile, dstname):
+            return True
+        self.diag.info("Not using the data store for clones any more")
+        PrepareWriteDirectory.storeCanClone = False
+        return False
+
+    def onOtherFileSystem(self, srcname, dstname):
+        try:
+            return os.stat(srcname).st_dev != os.stat(os.path.dirname(dstname)).st_dev
+        except OSError:
+            return False
+
+    def cloneFile(self, srcname, dstname):
+        if fcntl is None:
+            return False
+        try:
+            with open(srcname, "rb") as src, open(dstname, "wb") as dst:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        except OSError as e:  # Not Linux, not the same file system, or a file system that can't do it
+            self.diag.info("Failed to clone " + srcname + " : " + str(e))
+            if os.path.isfile(dstname):
+                os.remove(dstname)
+            return False
+        self.diag.info("Cloned " + srcname + " to " + dstname)
+        shutil.copystat(srcname, dstname)
+        plugins.makeWriteable(dstname)
+        return True
+
+    def getStoredFile(self, srcname, storeDir):
+        # Bring each source file into the run's write directory once, so all the tests using it can share that.
+        # Identified by path, size and modification time, reading all the data to hash the contents would defeat the point
+        try:
+            st = os.stat(srcname)
+        except OSError:
+            return srcname
+        key = os.path.realpath(srcname) + " " + str(st.st_size) + " " + str(st.st_mtime_ns)
+        storedFile = os.path.join(storeDir, hashlib.sha1(key.encode("utf-8", "surrogateescape")).hexdigest())
+        with self.dataStoreLock:
+            fileLock = self.dataStoreFileLocks.setdefault(storedFile, Lock())
+        with fileLock:
+            if not os.path.isfile(storedFile):
+                tmpFileName = None
+                try:
+                    plugins.ensureDirectoryExists(storeDir)
+                    # Slaves on other machines may share the store, so move the complete file into place
+                    fd, tmpFileName = mkstemp(dir=storeDir)
+                    os.close(fd)
+                    if not self.cloneFile(srcname, tmpFileName):
+                        shutil.copy2(srcname, tmpFileName)
+                    # Shared via hard links, so make sure tests can't change it by accident
+                    os.chmod(tmpFileName, stat.S_IMODE(st.st_mode) & ~0o222)
+                    os.replace(tmpFileName, storedFile)
+                    self.diag.info("Stored " + srcname + " as " + storedFile)
+                except OSError as e:
+                    self.diag.info("Failed to store " + srcname + " : " + str(e))
+                    if tmpFileName and os.path.isfile(tmpFileName):
+                        os.remove(tmpFileName)
+                    return srcname
+        return storedFile
+
     def linkTestPath(self, test, fullPath, target):
         # Linking doesn't exist on windows!
         if os.name != "posix":
@@ -625,7 +725,8 @@ class TestEnvironmentCreator:
 class CollateFiles(plugins.Action):
     def __init__(self):
         self.filesPresentBefore = {}
-        self.collationProc = None
+        # Tests can be collated in parallel, keep track of which process belongs to which
+        self.collationProcs = {}
         self.diag = logging.getLogger("Collate Files")
 
     def expandCollations(self, test):
@@ -791,10 +892,8 @@ class CollateFiles(plugins.Action):
         return localTestDir, localFiles
 
     def globDir(self, testDir, sourcePattern):
-        origCwd = os.getcwd()
-        os.chdir(testDir)
-        result = glob.glob(sourcePattern)
-        os.chdir(origCwd)
+        # Don't change directory, other tests may be collating at the same time
+        result = glob.glob(sourcePattern, root_dir=testDir)
         return [os.path.join(testDir, f) for f in result]
 
     def findPaths(self, test, sourcePattern):
@@ -828,9 +927,8 @@ class CollateFiles(plugins.Action):
                 stderr.close()
 
     def kill(self, test, sig):
-        if self.collationProc:
-            proc = self.collationProc
-            self.collationProc = None
+        proc = self.collationProcs.pop(test, None)
+        if proc:
             killProcessAndChildren(proc, cmd=test.getConfigValue("kill_command"))
 
     def extract(self, test, sourceFiles, targetFile, collationErrFile):
@@ -844,12 +942,12 @@ class CollateFiles(plugins.Action):
                 sys.stderr.write(msg)
             return shutil.copyfile(sourceFiles[0], targetFile)
 
-        self.collationProc = None
+        collationProc = None
         stdin = None
         for script in scripts:
             args = script.split()
-            if self.collationProc:
-                stdin = self.collationProc.stdout
+            if collationProc:
+                stdin = collationProc.stdout
             else:
                 args += sourceFiles
             self.diag.info("Opening extract process with args " + repr(args))
@@ -860,8 +958,11 @@ class CollateFiles(plugins.Action):
                 stdout = subprocess.PIPE
                 stderr = subprocess.STDOUT
 
-            self.collationProc = self.runCollationScript(args, test, stdin, stdout, stderr)
-            if not self.collationProc:
+            collationProc = self.runCollationScript(args, test, stdin, stdout, stderr)
+            if collationProc:
+                self.collationProcs[test] = collationProc
+            else:
+                self.collationProcs.pop(test, None)
                 if os.path.isfile(targetFile):
                     os.remove(targetFile)
                 errorMsg = "Could not find extract script '" + script + \
@@ -872,12 +973,11 @@ class CollateFiles(plugins.Action):
                 stderr.close()
                 return
 
-        if self.collationProc:
+        if collationProc:
             self.diag.info("Waiting for collation process to terminate...")
-            self.collationProc.wait()
-            if self.collationProc:
-                self.collationProc = None
-            else:
+            collationProc.wait()
+            # If it was killed, it will have been removed already
+            if not self.collationProcs.pop(test, None):
                 procName = args[0]
                 briefText = "KILLED (" + os.path.basename(procName) + ")"
                 freeText = "Killed collation script '" + procName + \
@@ -993,29 +1093,34 @@ class CreateCatalogue(plugins.Action):
         return processes
 
     def findAllPaths(self, test):
+        # Doesn't store anything on self, so tests running in parallel can do this at the same time
         allPaths = OrderedDict()
-        paths, ignoredPaths = test.listUnownedTmpPaths()
-        for path in paths:
-            editInfo = self.getEditInfo(path)
-            self.diag.info("Path " + path + " edit info " + editInfo)
-            allPaths[path] = editInfo
+        entries, ignoredPaths = test.scanUnownedTmpPaths()
+        for entry in entries:
+            editInfo = self.getEditInfo(entry)
+            self.diag.info("Path " + entry.path + " edit info " + repr(editInfo))
+            allPaths[entry.path] = editInfo
         return allPaths, ignoredPaths
 
-    def getEditInfo(self, fullPath):
-        # Check modified times for files and directories, targets for links
-        if os.path.islink(fullPath):
-            return os.path.realpath(fullPath)
-        else:
-            return time.strftime(plugins.datetimeFormat, time.localtime(plugins.modifiedTime(fullPath)))
+    def getEditInfo(self, entry):
+        # Check targets for links. Otherwise size, modification time to the nanosecond and inode,
+        # so that edits within the same second, or files replaced by others, are also noticed
+        if entry.is_symlink():
+            return os.path.realpath(entry.path)
+        try:
+            info = entry.stat(follow_symlinks=False)
+            return info.st_size, info.st_mtime_ns, info.st_ino
+        except OSError:  # removed while we were looking
+            return None
 
     def findDifferences(self, oldPaths, newPaths, ignoredPaths, writeDir):
         pathsGained, pathsEdited, pathsLost = [], [], []
-        for path, modTime in list(newPaths.items()):
+        for path, editInfo in newPaths.items():
             if path not in oldPaths:
                 pathsGained.append(self.outputPathName(path, writeDir))
-            elif oldPaths[path] != modTime:
+            elif oldPaths[path] != editInfo:
                 pathsEdited.append(self.outputPathName(path, writeDir))
-        for path, modTime in list(oldPaths.items()):
+        for path in oldPaths:
             if path not in newPaths:
                 pathsLost.append(self.outputPathName(path, writeDir))
         # Clear out duplicates
@@ -1029,14 +1134,14 @@ class CreateCatalogue(plugins.Action):
         return pathsLost, pathsEdited, pathsGained
 
     def removeParents(self, toRemove, toFind):
-        removeList = []
-        for path in toFind:
-            parent = os.path.split(path)[0]
-            if parent in toRemove and not parent in removeList:
-                removeList.append(parent)
-        for path in removeList:
-            self.diag.info("Removing parent path " + path)
-            toRemove.remove(path)
+        parents = set(os.path.split(path)[0] for path in toFind)
+        remaining = []
+        for path in toRemove:
+            if path in parents:
+                self.diag.info("Removing parent path " + path)
+            else:
+                remaining.append(path)
+        toRemove[:] = remaining
 
     def outputPathName(self, path, writeDir):
         self.diag.info("Output name for " + path)
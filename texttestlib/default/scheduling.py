@@ -0,0 +1,109 @@
+# Decides what order to start tests in when schedule_by_duration is set. Tests expected to take longest
+# go first, so that a long test near the end of the test suite doesn't hold up the end of the run
+# after everything else has finished.
+# Expected durations come from the approved performance files where there are any, otherwise from
+# how long the test took in previous runs, if a test_duration_file has been configured to record that in.
+
+import os
+import time
+import logging
+from texttestlib import plugins
+from threading import Lock
+from tempfile import mkstemp
+from . import performance
+
+
+class TestScheduler:
+    def __init__(self, active=True):
+        self.active = active
+        self.testsToSchedule = []
+        self.startTimes = {}
+        self.durationFiles = {}
+        self.newDurations = {}
+        self.lock = Lock()
+        self.diag = logging.getLogger("Test Scheduler")
+
+    def schedules(self, test):
+        return self.active and test.getConfigValue("schedule_by_duration")
+
+    def addTest(self, test):
+        self.testsToSchedule.append(test)
+
+    def getTestsInOrder(self):
+        tests, self.testsToSchedule = self.testsToSchedule, []
+        durations = {test: self.getExpectedDuration(test) for test in tests}
+        # Stable sort, so tests we know equally little about stay in test suite order
+        tests.sort(key=lambda test: -durations[test])
+        if self.diag.isEnabledFor(logging.INFO):
+            for test in tests:
+                self.diag.info("Expecting %s to take %s seconds", test.uniqueName, durations[test])
+        return tests
+
+    def getExpectedDuration(self, test):
+        if "mem" not in test.getConfigValue("default_performance_stem"):
+            perf = performance.getTestPerformance(test)
+            if perf >= 0:
+                return perf
+
+        duration = self.getDurations(test.getConfigValue("test_duration_file")).get(self.getKey(test))
+        if duration is not None:
+            return duration
+
+        duration = float(test.getConfigValue("unknown_test_duration"))
+        return duration if duration >= 0 else float("inf")
+
+    def getKey(self, test):
+        return test.app.name + test.app.versionSuffix() + " " + test.getRelPath()
+
+    def getDurations(self, durationFile):
+        if not durationFile:
+            return {}
+        if durationFile not in self.durationFiles:
+            self.durationFiles[durationFile] = self.readFile(durationFile)
+        return self.durationFiles[durationFile]
+
+    def readFile(self, durationFile):
+        durations = {}
+        if os.path.isfile(durationFile):
+            with open(durationFile) as f:
+                for line in f:
+                    parts = line.rstrip("\n").rsplit(" ", 1)
+                    if len(parts) == 2:
+                        try:
+                            durations[parts[0]] = float(parts[1])
+                        except ValueError:
+                            pass
+        return durations
+
+    def notifyLifecycleChange(self, test, state, changeDesc):
+        if not self.active or not test.getConfigValue("test_duration_file"):
+            return
+        if changeDesc == "start":
+            self.startTimes[test] = time.time()
+        elif changeDesc == "complete" and state.hasResults() and test in self.startTimes:
+            duration = round(time.time() - self.startTimes.pop(test), 1)
+            with self.lock:
+                self.newDurations.setdefault(test.getConfigValue("test_duration_file"), {})[self.getKey(test)] = duration
+
+    def save(self):
+        with self.lock:
+            for durationFile, newDurations in self.newDurations.items():
+                self.saveFile(durationFile, newDurations)
+            self.newDurations = {}
+
+    def saveFile(self, durationFile, newDurations):
+        # Other runs may have recorded different tests in the same file, keep those
+        durations = self.readFile(durationFile)
+        durations.update(newDurations)
+        self.durationFiles[durationFile] = durations
+        try:
+            dirName = os.path.dirname(os.path.abspath(durationFile))
+            plugins.ensureDirectoryExists(dirName)
+            fd, tmpFileName = mkstemp(dir=dirName)
+            with os.fdopen(fd, "w") as f:
+                for key in sorted(durations):
+                    f.write(key + " " + str(durations[key]) + "\n")
+            os.replace(tmpFileName, durationFile)
+            self.diag.info("Recorded %d test durations in %s", len(newDurations), durationFile)
+        except OSError as e:
+            self.diag.info("Could not write test durations to %s : %s", durationFile, e)
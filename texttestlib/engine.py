@@ -134,6 +134,7 @@ class Activator(plugins.Responder, plugins.Observable):
             except plugins.TextTestError as e:
                 rejectionInfo[suite.app] = str(e)
 
+        testmodel.DirectoryIndex.save()
         self.notify("AllRead", goodSuites)
 
         if len(rejectionInfo) > 0:
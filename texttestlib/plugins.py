@@ -14,11 +14,14 @@ import fnmatch
 import subprocess
 from collections import OrderedDict, deque
 from traceback import format_exception
-from threading import currentThread, RLock
+from threading import current_thread, main_thread, RLock, Thread
+from tempfile import mkdtemp, mkstemp
 from queue import Queue, Empty
 from glob import glob
 from datetime import datetime
-from pickle import Unpickler, UnpicklingError
+from pickle import Pickler, Unpickler, UnpicklingError
+from struct import pack, unpack
+from io import BytesIO
 from locale import getpreferredencoding
 
 
@@ -608,12 +611,22 @@ class Observable:
     threadedNotificationHandler = ThreadedNotificationHandler()
     obsDiag = None
     LAST_OBSERVER = "last observer"
+    # Which observer classes have which notify methods, found once rather than for each notification
+    observerMethods = {}
+    # Progress notifications just let the GUI update, doing that more often than this is wasted effort
+    progressInterval = 0.05
+    lastProgressTime = 0.0
 
     @classmethod
-    def diagnoseObs(klass, message, *args, **kwargs):
+    def obsDiagEnabled(klass):
         if not klass.obsDiag:
             klass.obsDiag = logging.getLogger("Observable")
-        klass.obsDiag.info(message + " " + str(klass) + " " + repr(args) + repr(kwargs))
+        return klass.obsDiag.isEnabledFor(logging.INFO)
+
+    @classmethod
+    def diagnoseObs(klass, message, *args, **kwargs):
+        if klass.obsDiagEnabled():
+            klass.obsDiag.info(message + " " + str(klass) + " " + repr(args) + repr(kwargs))
 
     def __init__(self, passSelf=False):
         self.observers = []
@@ -626,7 +639,7 @@ class Observable:
         self.observers = [x for x in observers if x is not self]
 
     def inMainThread(self):
-        return currentThread().getName() == "MainThread"
+        return current_thread() is main_thread()
 
     def notify(self, *args, **kwargs):
         if self.threadedNotificationHandler.active and not self.inMainThread():
@@ -652,12 +665,37 @@ class Observable:
             self.diagnoseObs("Perform directly", *args, **kwargs)
             self.performNotify(*args, **kwargs)
 
+    def notifyProgressIfMainThread(self):
+        # For loops over lots of small steps, which would otherwise spend their time updating the GUI
+        if self.inMainThread():
+            now = time.monotonic()
+            if now - Observable.lastProgressTime >= self.progressInterval:
+                Observable.lastProgressTime = now
+                self.diagnoseObs("Perform directly", "ActionProgress")
+                self.performNotify("ActionProgress")
+
+    @classmethod
+    def hasObserverMethod(klass, observer, methodName):
+        observerClass = observer.__class__
+        key = observerClass, methodName
+        if key not in klass.observerMethods:
+            if hasattr(observerClass, methodName):
+                klass.observerMethods[key] = True
+            elif hasattr(observerClass, "__getattr__"):
+                klass.observerMethods[key] = None  # could be anything, have to ask each time
+            else:
+                klass.observerMethods[key] = False
+        hasMethod = klass.observerMethods[key]
+        return hasattr(observer, methodName) if hasMethod is None else hasMethod
+
     def performNotify(self, name, *args, **kwargs):
         methodName = "notify" + name
         lastObserver = None
+        diagnose = self.obsDiagEnabled()
         for observer in self.observers:
-            if hasattr(observer, methodName):
-                self.diagnoseObs("Notify observer " + name + " " + str(observer.__class__))
+            if self.hasObserverMethod(observer, methodName):
+                if diagnose:
+                    self.diagnoseObs("Notify observer " + name + " " + str(observer.__class__))
                 answer = self.notifyObserver(observer, methodName, *args, **kwargs)
                 if answer == self.LAST_OBSERVER:
                     self.diagnoseObs("Setting as last observer", *args, **kwargs)
@@ -713,6 +751,53 @@ class Responder:
         return True
 
 
+# Test state files start with this and a format version. Anything else is a plain pickle from an older version.
+# After the header comes the length of the pickled state, the pickled state, and then the bulky texts it refers to.
+stateFileHeader = b"TEXTTEST STATE "
+stateFileVersion = 1
+
+
+class StoredText:
+    # Bulky text from a state file, which is only read when something asks for it
+    def __init__(self, text=None, fileName=None, offset=0, length=0):
+        self.text = text
+        self.fileName = fileName
+        self.offset = offset
+        self.length = length
+
+    def read(self):
+        if self.text is None:
+            with open(self.fileName, "rb") as f:
+                f.seek(self.offset)
+                self.text = f.read(self.length).decode("utf-8", "surrogateescape")
+        return self.text
+
+    def __reduce__(self):
+        # Anything else pickling it just sees the text
+        return str, (self.read(),)
+
+
+class LazyText:
+    # Attribute whose value may still be a StoredText, which is read the first time the attribute is used
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, obj, owner=None):
+        if obj is None:
+            return self
+        try:
+            value = obj.__dict__[self.name]
+        except KeyError:
+            raise AttributeError(self.name)
+        if isinstance(value, StoredText):
+            value = value.read()
+            obj.__dict__[self.name] = value
+        return value
+
+    def __set__(self, obj, value):
+        obj.__dict__[self.name] = value
+
+
 # Generic state which tests can be in, should be overridden by subclasses
 # Acts as a static state for tests which have not run (yet)
 # Free text is text of arbitrary length: it will appear in the "Text Info" GUI window when the test is viewed
@@ -721,6 +806,7 @@ class Responder:
 # the summary of batch mode
 class TestState(Observable):
     categoryDescriptions = OrderedDict()
+    freeText = LazyText()
     showExecHosts = 0
     defaultBriefText = ""
 
@@ -868,8 +954,77 @@ class MarkedTestState(TestState):
         return MarkedTestState(self.myFreeText, self.briefText, newOldState, self.executionHosts)
 
 
+class TestStatePickler(Pickler):
+    minStoredTextSize = 256
+    lazyTextNames = {}
+
+    def __init__(self, file):
+        Pickler.__init__(self, file, protocol=5)
+        self.texts = []
+        self.textSize = 0
+
+    @classmethod
+    def getLazyTextNames(cls, objClass):
+        if objClass not in cls.lazyTextNames:
+            names = set()
+            for baseClass in objClass.__mro__:
+                names.update(name for name, value in vars(baseClass).items() if isinstance(value, LazyText))
+            cls.lazyTextNames[objClass] = names
+        return cls.lazyTextNames[objClass]
+
+    def reducer_override(self, obj):
+        names = self.getLazyTextNames(type(obj))
+        if not names:
+            return NotImplemented
+        reduced = obj.__reduce_ex__(5)
+        if len(reduced) < 3 or not isinstance(reduced[2], dict):
+            return NotImplemented
+        objState = dict(reduced[2])
+        for name in names:
+            value = objState.get(name)
+            if isinstance(value, StoredText):
+                value = value.read()
+            if isinstance(value, str) and len(value) >= self.minStoredTextSize:
+                objState[name] = StoredText(value)
+        return reduced[:2] + (objState,) + reduced[3:]
+
+    def persistent_id(self, obj):
+        if isinstance(obj, StoredText):
+            data = obj.read().encode("utf-8", "surrogateescape")
+            offset = self.textSize
+            self.texts.append(data)
+            self.textSize += len(data)
+            return "text", offset, len(data)
+
+
+def writeTestState(file, state):
+    stateData = BytesIO()
+    pickler = TestStatePickler(stateData)
+    pickler.dump(state)
+    file.write(stateFileHeader + str(stateFileVersion).encode() + b"\n")
+    file.write(pack(">Q", len(stateData.getvalue())))
+    file.write(stateData.getvalue())
+    for data in pickler.texts:
+        file.write(data)
+
+
 class TestStateUnpickler(Unpickler):
+    classCache = {}
+
+    def __init__(self, file, textData=None, textFileName=None, textStart=0, textLength=0, **kw):
+        Unpickler.__init__(self, file, **kw)
+        self.textData = textData
+        self.textFileName = textFileName
+        self.textStart = textStart
+        self.textLength = len(textData) if textData is not None else textLength
+
     def find_class(self, modName, className):
+        key = modName, className
+        if key not in self.classCache:
+            self.classCache[key] = self.importClass(modName, className)
+        return self.classCache[key]
+
+    def importClass(self, modName, className):
         try:
             namespace = {}
             exec("from " + modName + " import " + className + " as _class", globals(), namespace)
@@ -877,24 +1032,68 @@ class TestStateUnpickler(Unpickler):
         except ImportError as e:
             if not modName.startswith("texttestlib"):
                 try:
-                    return self.find_class("texttestlib." + modName, className)
+                    return self.importClass("texttestlib." + modName, className)
                 except:
                     raise e
             else:
                 raise e
 
+    def persistent_load(self, pid):
+        kind, offset, length = pid
+        if kind != "text":
+            raise UnpicklingError("Unknown reference in test state file: " + repr(pid))
+        if offset + length > self.textLength:
+            raise EOFError("Test state file is truncated")
+        if self.textData is not None:
+            return self.textData[offset:offset + length].decode("utf-8", "surrogateescape")
+        else:
+            return StoredText(fileName=self.textFileName, offset=self.textStart + offset, length=length)
+
+
+def readStateFileVersion(file):
+    if hasattr(file, "peek"):
+        start = file.peek(len(stateFileHeader))[:len(stateFileHeader)]
+    else:
+        position = file.tell()
+        start = file.read(len(stateFileHeader))
+        file.seek(position)
+    if start == stateFileHeader:
+        version = file.readline()[len(stateFileHeader):].strip()
+        return int(version) if version.isdigit() else -1
+
+
+def readExactly(file, length):
+    data = file.read(length)
+    if len(data) < length:
+        raise EOFError("Test state file is truncated")
+    return data
+
+
+def getNewTestStateFromFile(file, lazyText=False):
+    # lazyText means the bulky texts are only read from the file if and when they are used
+    version = readStateFileVersion(file)
+    if version is not None:
+        if version < 1 or version > stateFileVersion:
+            raise UnpicklingError("Unknown test state file format version " + str(version))
+        stateLength = unpack(">Q", readExactly(file, 8))[0]
+        stateData = readExactly(file, stateLength)
+        if lazyText and isinstance(getattr(file, "name", None), str):
+            textStart = file.tell()
+            textLength = os.fstat(file.fileno()).st_size - textStart
+            unpickler = TestStateUnpickler(BytesIO(stateData), textFileName=file.name, textStart=textStart, textLength=textLength)
+        else:
+            unpickler = TestStateUnpickler(BytesIO(stateData), textData=file.read())
+        return unpickler.load()
 
-def getNewTestStateFromFile(file):
     unpickler = TestStateUnpickler(file)
     try:
         return unpickler.load()
     except Exception:
         encoding = getpreferredencoding()
-        from io import BytesIO
         file.seek(0)
         unpickler = TestStateUnpickler(BytesIO(file.read().replace(b"\r\n", b"\n")), encoding=encoding, errors="replace")
         return unpickler.load()
-    
+
 
 log = None
 
@@ -1071,6 +1270,12 @@ def makeWriteable(path):
     os.chmod(path, newPerm)
 
 
+def isHardLinkedFile(path):
+    # Such as test data shared from the data store: making it writeable here would make it writeable everywhere.
+    # Only the directory needs to be writeable to remove it, except on Windows
+    return os.name != "nt" and not os.path.isdir(path) and os.stat(path).st_nlink > 1
+
+
 def getPaths(d):
     paths = [d]
     for root, dirs, files in os.walk(d):
@@ -1084,18 +1289,36 @@ def getPaths(d):
 # Version of rmtree not prone to crashing if directory in use or externally removed
 
 
+def removeInBackground(dir):
+    # Move it out of the way now, so the name can be reused at once, and delete it in another thread.
+    # Not a daemon thread, so we don't exit before it's finished
+    if not os.path.isdir(dir):
+        return
+    try:
+        trashDir = mkdtemp(dir=os.path.dirname(os.path.normpath(dir)), prefix=os.path.basename(dir) + ".removing.")
+        if os.name == "nt":
+            # Windows doesn't manage to overwrite empty directories
+            os.rmdir(trashDir)
+        os.rename(dir, trashDir)
+    except OSError:
+        return rmtree(dir)
+    Thread(target=rmtree, args=(trashDir,), name="Remove " + trashDir).start()
+
+
 def rmtree(dir, attempts=100):
     realDir = os.path.realpath(dir)
     if not os.path.isdir(realDir):
         log.info("Write directory " + dir + " externally removed")
         return
-    # Don't be somewhere under the directory when it's removed
-    try:
-        if os.getcwd().startswith(realDir):
-            root = os.path.dirname(os.path.normpath(dir))
-            os.chdir(root)
-    except OSError:  # pragma: no cover - robustness only
-        pass
+    # Don't be somewhere under the directory when it's removed. Only in the main thread though: the working directory
+    # belongs to the whole process, and other threads (e.g. tests running in parallel with -j) may be relying on it
+    if current_thread() is main_thread():
+        try:
+            cwd = os.getcwd()
+            if cwd == realDir or cwd.startswith(realDir + os.sep):
+                os.chdir(os.path.dirname(realDir))
+        except OSError:  # pragma: no cover - robustness only
+            pass
     for i in range(attempts):
         try:
             shutil.rmtree(realDir)
@@ -1104,6 +1327,8 @@ def rmtree(dir, attempts=100):
             # We own this stuff, don't respect readonly flags set by ourselves, it might just be the SUT doing so...
             for path in getPaths(realDir):
                 try:
+                    if isHardLinkedFile(path):
+                        continue
                     makeWriteable(path)
                 except OSError as e:
                     log.info("Could not change permissions to be able to remove directory " +
@@ -1191,13 +1416,16 @@ def readList(filename):
         return []  # It could be a broken link: don't bail out if so...
 
 
-def readListWithComments(filename, filterMethod=None):
+def readListWithComments(filename, filterMethod=None, lines=None):
     items = OrderedDict()
     badItems = OrderedDict()
     currComment = ""
     emptyLineSymbol = "__EMPTYLINE__"
 
-    for longline in open(filename, encoding=getpreferredencoding(), errors="replace").readlines():
+    if lines is None:
+        with open(filename, encoding=getpreferredencoding(), errors="replace") as f:
+            lines = f.readlines()
+    for longline in lines:
         line = longline.strip()
         if len(line) == 0:
             if currComment:
@@ -1263,6 +1491,29 @@ def ensureDirectoryExists(path, attempts=5):
                 raise
 
 
+# Modification times this close to "now" may not move when the file changes again. FAT has 2 seconds, most others are finer
+fileSystemTimeGranularity = 2 * 10 ** 9
+
+
+def getFileSystemTime(dir):
+    # What the file system holding dir thinks the time is, found by making a file there: file servers don't always agree
+    # with our clock. Note it changes the modification time of dir itself. If we can't write there, our clock will have to do
+    try:
+        fd, path = mkstemp(dir=dir, prefix=".texttest_time")
+    except OSError:
+        return time.time_ns()
+    try:
+        return os.fstat(fd).st_mtime_ns
+    finally:
+        os.close(fd)
+        os.remove(path)
+
+
+def isRecentlyModified(mtime, fileSystemTime):
+    # If so, it might change again without the modification time changing
+    return mtime > fileSystemTime - fileSystemTimeGranularity
+
+
 def retryOnInterrupt(function, *args):
     try:
         return function(*args)
@@ -1553,6 +1804,9 @@ class MultiEntryDictionary(OrderedDict):
     warnings = []
 
     def __init__(self, importKey="", importFileFinder=None, aliases={}, allowSectionHeaders=True, fileTrackSections={}, *args, **kw):
+        # Composite lookups, and the section patterns they match against, are remembered until anything changes
+        self.compositeCache = {}
+        self.sectionPatterns = {}
         OrderedDict.__init__(self, *args, **kw)
         self.diag = logging.getLogger("MultiEntryDictionary")
         self.aliases = aliases
@@ -1570,6 +1824,22 @@ class MultiEntryDictionary(OrderedDict):
         return self.__class__, (self.importKey, Callable(self.importFileFinder),
                                 self.aliases, self.allowSectionHeaders, self.fileTrackSections, items)
 
+    def __setitem__(self, key, value):
+        self.clearCaches()
+        OrderedDict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        self.clearCaches()
+        OrderedDict.__delitem__(self, key)
+
+    def clear(self):
+        self.clearCaches()
+        OrderedDict.clear(self)
+
+    def clearCaches(self):
+        self.compositeCache.clear()
+        self.sectionPatterns.clear()
+
     def addFileTracking(self, key):
         self.fileTrackSections[key] = {}
 
@@ -1658,6 +1928,7 @@ class MultiEntryDictionary(OrderedDict):
         return ""
 
     def addEntry(self, entryName, entry, sectionName="", *args, **kwargs):
+        self.clearCaches()
         currDict, currSection = self.getSectionInfo(sectionName)
         try:
             self._addEntry(entryName, entry, currDict, currSection, *args, **kwargs)
@@ -1666,6 +1937,7 @@ class MultiEntryDictionary(OrderedDict):
                       "' given an invalid value '" + entry + "', ignoring.")
 
     def removeEntry(self, entryName, entry, sectionName=""):
+        self.clearCaches()
         currDict, _ = self.getSectionInfo(sectionName)
         if entryName in currDict:
             dictElem = currDict[entryName]
@@ -1751,14 +2023,34 @@ class MultiEntryDictionary(OrderedDict):
             return value
 
     def getCompositeUnexpanded(self, key, subKey, defaultSubKey="default"):
+        cacheKey = key, subKey, defaultSubKey
+        if cacheKey in self.compositeCache:
+            value = self.compositeCache[cacheKey]
+        else:
+            value = self.findCompositeUnexpanded(key, subKey, defaultSubKey)
+            self.compositeCache[cacheKey] = value
+        # Lists are built up here, don't let the caller change the cached one
+        return list(value) if type(value) == list else value
+
+    def getSectionPatterns(self, key, dict):
+        patterns = self.sectionPatterns.get(key)
+        if patterns is None:
+            # Same as fnmatch.fnmatch, but without looking up the compiled pattern every time
+            patterns = [(re.compile(fnmatch.translate(os.path.normcase(currSubKey))).match, currValue)
+                        for currSubKey, currValue in dict.items()]
+            self.sectionPatterns[key] = patterns
+        return patterns
+
+    def findCompositeUnexpanded(self, key, subKey, defaultSubKey):
         dict = self.get(key)
         # If it wasn't a dictionary, return None
         if not hasattr(dict, "items"):
             return None
         listVal = []
         usingList = False
-        for currSubKey, currValue in dict.items():
-            if fnmatch.fnmatch(subKey, currSubKey):
+        normSubKey = os.path.normcase(subKey)
+        for matcher, currValue in self.getSectionPatterns(key, dict):
+            if matcher(normSubKey):
                 if type(currValue) == list:
                     listVal += currValue
                     usingList = True
@@ -1779,10 +2071,11 @@ class MultiEntryDictionary(OrderedDict):
 
     @classmethod
     def expandEnvironment(cls, value, envMapping):
+        # Most values don't refer to any variables, no need to parse them
         if isinstance(value, str):
-            return string.Template(value).safe_substitute(envMapping)
+            return string.Template(value).safe_substitute(envMapping) if "$" in value else value
         elif isinstance(value, list):
-            return [string.Template(element).safe_substitute(envMapping) for element in value]
+            return [string.Template(element).safe_substitute(envMapping) if "$" in element else element for element in value]
         elif isinstance(value, dict):
             newDict = value.__class__()
             for key, val in list(value.items()):
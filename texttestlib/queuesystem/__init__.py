@@ -89,6 +89,7 @@ class QueueSystemConfig(default.Config):
             elif group.name.startswith("Invisible"):
                 group.addOption("slave", "Private: used to submit slave runs remotely")
                 group.addOption("servaddr", "Private: used to submit slave runs remotely")
+                group.addOption("arraytask", "Private: used to find which test to run in array jobs")
                 group.addOption(
                     "home", "Private: used to communicate local home directory to environments that run as a different user")
 
@@ -163,6 +164,12 @@ class QueueSystemConfig(default.Config):
     def slaveRun(self):
         return "slave" in self.optionMap
 
+    def getFilterList(self, app, suites, options=None, **kw):
+        if options is None and self.slaveRun() and "arraytask" in self.optionMap and "tp" not in self.optionMap:
+            # Started as a task in an array job, only the master knows which test that means
+            self.optionMap["tp"] = slavejobs.fetchArrayTaskTest(app, self.optionMap)
+        return default.Config.getFilterList(self, app, suites, options, **kw)
+
     def getWriteDirectoryName(self, app):
         return self.optionMap.get("slave") or default.Config.getWriteDirectoryName(self, app)
 
@@ -392,6 +399,10 @@ class QueueSystemConfig(default.Config):
                              "Number of processes the grid engine should reserve for tests")
         app.setConfigDefault("queue_system_submit_args", "",
                              "Additional arguments to provide to grid engine submission command")
+        app.setConfigDefault("queue_system_prefetch_count", 0,
+                             "Number of tests to give each slave in advance, so it can read them in while running its current test")
+        app.setConfigDefault("queue_system_max_array_size", 0,
+                             "Maximum number of tests with the same requirements to submit together as one array job. 0 means submit each test separately")
         app.setConfigDefault("queue_system_proxy_executable", "",
                              "Executable to run as a proxy for the real test program")
         app.setConfigDefault("queue_system_proxy_resource", [],
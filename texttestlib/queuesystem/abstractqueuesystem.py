@@ -1,7 +1,7 @@
 
 """ Base class for all the queue system implementations """
 
-import subprocess, os, sys
+import subprocess, os, sys, time
 from locale import getpreferredencoding
 from texttestlib import plugins
 
@@ -28,9 +28,38 @@ class QueueSystem(object):
         else:
             return self.findJobId(stdout), None
 
+    def supportsArrayJobs(self):
+        # Override if many slaves can be submitted with one command, see submitArrayJob
+        return False
+
+    def submitArrayJob(self, cmdArgs, slaveEnv, logDir, taskRules, jobType):
+        # One job with a task for each of the given submission rules, returns the job ids of the tasks
+        jobId, errorMessage = self.submitSlaveJob(cmdArgs, slaveEnv, logDir, taskRules[0], jobType)
+        if jobId is None:
+            return None, errorMessage
+        else:
+            return [self.getArrayTaskJobId(jobId, taskIndex) for taskIndex in range(1, len(taskRules) + 1)], None
+
+    def getArraySubmitCmdArgs(self, submissionRules, jobName, taskCount, commandArgs=[], slaveEnv={}):
+        return self.getSubmitCmdArgs(submissionRules, commandArgs, slaveEnv)
+
+    def getArrayTaskJobId(self, jobId, taskIndex):
+        return jobId
+
     def supportsPolling(self):
         return True
 
+    def getStatusForJobs(self, jobIds):
+        # Override if the queue system can be asked about only the jobs we're still interested in
+        statusInfo = self.getStatusForAllJobs()
+        if statusInfo is not None:
+            return {jobId: statusInfo[jobId] for jobId in jobIds if jobId in statusInfo}
+
+    def waitForJobChange(self, timeout):
+        # Override if the queue system can tell us when jobs finish. Return True if one might have done
+        time.sleep(timeout)
+        return False
+
     def findErrorMessage(self, stderr, *args):
         if len(stderr) > 0:
             basicError = self.findSubmitError(stderr)
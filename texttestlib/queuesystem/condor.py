@@ -55,8 +55,12 @@ class QueueSystem(abstractqueuesystem.QueueSystem):
             return resultOutput
 
     def getStatusForAllJobs(self):
+        return self.getStatusForJobs([])
+
+    def getStatusForJobs(self, jobIds):
+        # condor_q only reports on the clusters given, if any are
         statusDict = {}
-        proc = subprocess.Popen(['condor_q', '-format', '%s ', 'ClusterId', '-format', '%s\\n',
+        proc = subprocess.Popen(['condor_q'] + list(jobIds) + ['-format', '%s ', 'ClusterId', '-format', '%s\\n',
                                  'JobStatus'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
         outMsg = proc.communicate()[0]
         for line in outMsg.splitlines():
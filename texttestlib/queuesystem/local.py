@@ -6,12 +6,32 @@ import os
 import signal
 from . import abstractqueuesystem
 from multiprocessing import cpu_count
+from threading import Thread, Event
+from collections import OrderedDict
 from texttestlib import plugins
 
 
 class QueueSystem(abstractqueuesystem.QueueSystem):
     def __init__(self, *args):
         self.processes = {}
+        self.jobExited = Event()
+
+    def supportsArrayJobs(self):
+        # Not much to gain here, but lets us try out array jobs without a grid
+        return True
+
+    def submitArrayJob(self, cmdArgs, slaveEnv, logDir, taskRules, jobType):
+        jobIds = []
+        for taskIndex, submissionRules in enumerate(taskRules):
+            taskEnv = OrderedDict(slaveEnv)
+            taskEnv["TEXTTEST_ARRAY_TASK_ID"] = str(taskIndex + 1)
+            jobId, errorMessage = self.submitSlaveJob(cmdArgs, taskEnv, logDir, submissionRules, jobType)
+            if jobId is None:
+                for startedJobId in jobIds:
+                    self.killJob(startedJobId)
+                return None, errorMessage
+            jobIds.append(jobId)
+        return jobIds, None
 
     def submitSlaveJob(self, cmdArgs, slaveEnv, logDir, submissionRules, jobType):
         outputFile, errorsFile = submissionRules.getJobFiles()
@@ -33,8 +53,21 @@ class QueueSystem(abstractqueuesystem.QueueSystem):
         else:
             jobId = str(process.pid)
             self.processes[jobId] = process
+            # Wait for it in the background, so the master finds out as soon as it exits
+            waiter = Thread(target=self.waitForExit, args=(process,))
+            waiter.daemon = True
+            waiter.start()
             return jobId, None
 
+    def waitForExit(self, process):
+        process.wait()
+        self.jobExited.set()
+
+    def waitForJobChange(self, timeout):
+        changed = self.jobExited.wait(timeout)
+        self.jobExited.clear()
+        return changed
+
     def getCapacity(self):
         return cpu_count()
 
@@ -73,6 +106,12 @@ class QueueSystem(abstractqueuesystem.QueueSystem):
 def getUserSignalKillInfo(userSignalNumber, explicitKillMethod):
     return explicitKillMethod()
 
+# Used by the tasks of array jobs to find out which test to run
+
+
+def getArrayTaskIndex():
+    return os.getenv("TEXTTEST_ARRAY_TASK_ID")
+
 # Used by slave for producing performance data
 
 
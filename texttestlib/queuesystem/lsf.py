@@ -23,6 +23,17 @@ class QueueSystem(gridqueuesystem.QueueSystem):
         bsubArgs += ["-u", "nobody", "-o", os.devnull, "-e", os.devnull]
         return self.addExtraAndCommand(bsubArgs, submissionRules, commandArgs)
 
+    def supportsArrayJobs(self):
+        return True
+
+    def getArraySubmitCmdArgs(self, submissionRules, jobName, taskCount, commandArgs=[], slaveEnv={}):
+        bsubArgs = self.getSubmitCmdArgs(submissionRules, commandArgs, slaveEnv)
+        bsubArgs[2] = jobName + "[1-" + str(taskCount) + "]"
+        return bsubArgs
+
+    def getArrayTaskJobId(self, jobId, taskIndex):
+        return jobId + "[" + str(taskIndex) + "]"
+
     def getSlaveVarsToBlock(self):
         """Make sure we clear out the master scripts so the slave doesn't use them too,
         otherwise just use the environment as is.
@@ -52,7 +63,7 @@ class QueueSystem(gridqueuesystem.QueueSystem):
         return 1
 
     def _getJobFailureInfo(self, jobId):
-        resultOutput = os.popen("bjobs -a -l " + jobId + " 2>&1").read()
+        resultOutput = os.popen("bjobs -a -l '" + jobId + "' 2>&1").read()
         if resultOutput.find("is not found") != -1:
             return "LSF lost job:" + jobId
         else:
@@ -63,7 +74,8 @@ class QueueSystem(gridqueuesystem.QueueSystem):
         return False
 
     def killJob(self, jobId):
-        resultOutput = os.popen("bkill -s USR1 " + jobId + " 2>&1").read()
+        # Quoted, as tasks in array jobs look like 1234[5]
+        resultOutput = os.popen("bkill -s USR1 '" + jobId + "' 2>&1").read()
         return resultOutput.find("is being terminated") != -1 or resultOutput.find("is being signaled") != -1
 
     def getJobId(self, line):
@@ -148,6 +160,12 @@ def getUserSignalKillInfo(userSignalNumber, explicitKillMethod):
     else:
         return explicitKillMethod()
 
+# Used by the tasks of array jobs to find out which test to run
+
+
+def getArrayTaskIndex():
+    return os.getenv("LSB_JOBINDEX")
+
 # Need to get all hosts for parallel
 
 
@@ -10,9 +10,10 @@ import logging
 import time
 from .utils import *
 from queue import Queue
+from io import BytesIO
 from socketserver import ThreadingTCPServer, StreamRequestHandler
 from threading import RLock, Lock
-from collections import OrderedDict
+from collections import OrderedDict, deque
 from texttestlib import plugins
 from texttestlib.default.console import TextDisplayResponder, InteractiveResponder
 from texttestlib.default.knownbugs import CheckForBugs
@@ -57,6 +58,10 @@ class QueueSystemServer(BaseActionRunner):
         self.maxCapacity = 100000  # infinity, sort of
         self.allApps = allApps
         self.jobs = OrderedDict()
+        # Jobs with tests that haven't completed yet, the only ones we need to ask the queue system about.
+        # A job can have several, if its slave has been given tests in advance
+        self.activeJobs = OrderedDict()
+        self.activeJobLock = Lock()
         self.submissionRules = {}
         self.killedJobs = {}
         self.queueSystems = {}
@@ -67,6 +72,13 @@ class QueueSystemServer(BaseActionRunner):
         self.createDirectories = False
         self.slaveLogDirs = set()
         self.delayedTestsForAdd = []
+        # Tests we took out of the queue while gathering up array jobs or prefetching, but couldn't use.
+        # Both happen in different threads, hold the lock while taking tests out and putting them back
+        self.testsHeldBack = deque()
+        self.heldBackLock = RLock()
+        self.arrayJobs = {}
+        # Tests handed to a slave in advance, keyed by the test it will run them after
+        self.prefetchedTests = {}
         self.remainingForApp = OrderedDict()
         appCapacities = []
         for app in allApps:
@@ -125,7 +137,7 @@ class QueueSystemServer(BaseActionRunner):
 
     def queueTestForRerun(self, test):
         # Clear out the previous job reference, otherwise our grid polling will kill it off
-        self.jobs[test] = []
+        self.clearJobs(test)
         self.addTestToQueues(test)
 
     def addTestToQueues(self, test):
@@ -141,6 +153,7 @@ class QueueSystemServer(BaseActionRunner):
         self.delayedTestsForAdd = []
 
     def notifyAllRead(self, suites):
+        self.addScheduledTests()
         self.addDelayedTests()
         BaseActionRunner.notifyAllRead(self, suites)
         self.allRead = True
@@ -159,17 +172,22 @@ class QueueSystemServer(BaseActionRunner):
 
     def pollQueueSystem(self):
         # Start by polling after 5 seconds, ever after try every 15
+        # Poll straight away if the queue system tells us a job has finished
         interval = float(os.getenv("TEXTTEST_QS_POLL_INTERVAL", "0.5"))         # Amount of time to wait between checks for exit/completion when polling grid/cloud
         attempts = int(float(os.getenv("TEXTTEST_QS_POLL_WAIT", "5")) / interval) # Amount of time to wait before initiating polling of grid/cloud
         subsequentAttempts = int(float(os.getenv("TEXTTEST_QS_POLL_SUBSEQUENT_WAIT", "15")) / interval) # Amount of time to wait before subsequent polling of grid/cloud
+        queueSystem = self.getQueueSystem(list(self.jobs.keys())[0])
         if attempts >= 0:
             while True:
                 for _ in range(attempts):
-                    time.sleep(interval)
+                    jobChanged = queueSystem.waitForJobChange(interval)
                     if self.allComplete:
                         return
                     if self.exited:
                         break
+                    if jobChanged:
+                        self.diag.info("Queue system reports a job has finished, checking status now")
+                        break
                 if not self.exited:
                     self.updateJobStatus()
                 attempts = subsequentAttempts
@@ -183,21 +201,59 @@ class QueueSystemServer(BaseActionRunner):
         return queueSystem.supportsPolling()
 
     def updateJobStatus(self):
+        activeJobs = self.findActiveJobs()
+        if not activeJobs:
+            return
         queueSystem = self.getQueueSystem(list(self.jobs.keys())[0])
-        statusInfo = queueSystem.getStatusForAllJobs()
-        self.diag.info("Got status for all jobs : " + repr(statusInfo))
+        statusInfo = queueSystem.getStatusForJobs(list(activeJobs.keys()))
+        self.diag.info("Got status for active jobs : " + repr(statusInfo))
         if statusInfo is not None:  # queue system not available for some reason
-            for test, jobs in list(self.jobs.items()):
-                if not test.state.isComplete():
-                    for jobId, jobName in jobs:
-                        status = statusInfo.get(jobId)
-                        if status:
-                            # Only do this to test jobs (might make a difference for derived configurations)
-                            # Ignore filtering states for now, which have empty 'briefText'.
-                            self.updateRunStatus(test, status)
-                        elif not status and not self.jobCompleted(test, jobName):
-                            # Do this to any jobs
-                            self.setSlaveFailed(test, self.jobStarted(test, jobName), True, jobId)
+            for jobId, (tests, jobName) in list(activeJobs.items()):
+                status = statusInfo.get(jobId)
+                if status:
+                    # Only do this to test jobs (might make a difference for derived configurations)
+                    # Ignore filtering states for now, which have empty 'briefText'.
+                    # The first test is the one the job is running, the others are waiting their turn
+                    self.updateRunStatus(tests[0], status)
+                else:
+                    # Do this to any jobs, and to every test the job had been given.
+                    # Only the last one counts as the submitted job, the others were counted off when handed out
+                    for test in tests:
+                        if not self.jobCompleted(test, jobName):
+                            previouslySubmitted = True if test is tests[-1] else None
+                            self.setSlaveFailed(test, self.jobStarted(test, jobName), True, jobId, previouslySubmitted)
+
+    def findActiveJobs(self):
+        # Forget about tests that have completed, and jobs with none left, so we don't keep checking on them
+        activeJobs = OrderedDict()
+        with self.activeJobLock:
+            for jobId, (tests, jobName) in list(self.activeJobs.items()):
+                tests[:] = [test for test in tests if not test.state.isComplete()]
+                if tests:
+                    activeJobs[jobId] = list(tests), jobName
+                else:
+                    del self.activeJobs[jobId]
+        return activeJobs
+
+    def addJob(self, test, jobId, jobName):
+        self.jobs.setdefault(test, []).append((jobId, jobName))
+        self.addActiveJob(test, jobId, jobName)
+
+    def addActiveJob(self, test, jobId, jobName):
+        with self.activeJobLock:
+            tests = self.activeJobs.setdefault(jobId, ([], jobName))[0]
+            if test not in tests:
+                tests.append(test)
+
+    def clearJobs(self, test):
+        with self.activeJobLock:
+            for jobId, _ in self.jobs.get(test, []):
+                tests = self.activeJobs.get(jobId, ([], None))[0]
+                if test in tests:
+                    tests.remove(test)
+                    if not tests:
+                        del self.activeJobs[jobId]
+        self.jobs[test] = []
 
     def updateRunStatus(self, test, status):
         newRunStatus, newExplanation = status
@@ -226,6 +282,9 @@ class QueueSystemServer(BaseActionRunner):
 
     def markTestReuse(self, test, newTest):
         self.jobs[newTest] = self.getJobInfo(test)
+        for jobId, jobName in self.jobs[newTest]:
+            # Given in advance, the old test may still be running: keep that on the job as well
+            self.addActiveJob(newTest, jobId, jobName)
         with self.counterLock:
             if self.testCount > 1:
                 self.testCount -= 1
@@ -236,6 +295,11 @@ class QueueSystemServer(BaseActionRunner):
         self.diag.info("Reusing slave from " + test.uniqueName + " for " + newTest.uniqueName + postText)
 
     def getTestForReuse(self, test, state, tryReuse, doneRerun):
+        if test in self.prefetchedTests:
+            # The slave already has its next test, and the job stays busy with that
+            self.diag.info("Slave from " + test.uniqueName + " already has " + self.prefetchedTests[test].uniqueName + " to run next")
+            return
+
         # Pick up any test that matches the current one's resource requirements
         if not self.exited:
             if test in self.reusedTests:
@@ -270,6 +334,31 @@ class QueueSystemServer(BaseActionRunner):
                 self.diag.info("Forcing termination")
                 self.submitTerminators()
 
+    def prefetchTests(self, test, state):
+        # Line up the next tests for the slave running this one, so it can read them in while this one runs
+        prefetchCount = test.getConfigValue("queue_system_prefetch_count")
+        lastTest, testsAhead = test, 0
+        while lastTest in self.prefetchedTests:
+            lastTest = self.prefetchedTests[lastTest]
+            testsAhead += 1
+
+        newTests = []
+        with self.heldBackLock:
+            while testsAhead < prefetchCount and not self.exited:
+                newTest = self.getTest(block=False, replaceTerminators=True)
+                if not newTest:
+                    break
+                if not self.allowReuse(test, state, newTest):
+                    # Leave it for another slave, or a new job
+                    self.testsHeldBack.appendleft(newTest)
+                    break
+                self.markTestReuse(lastTest, newTest)
+                self.prefetchedTests[lastTest] = newTest
+                newTests.append(newTest)
+                lastTest = newTest
+                testsAhead += 1
+        return newTests
+
     def allowReuse(self, oldTest, oldState, newTest):
         # Don't reuse jobs that have been killed
         if newTest.state.isComplete() or oldState.category == "killed":
@@ -304,6 +393,10 @@ class QueueSystemServer(BaseActionRunner):
             return submissionRules
 
     def getTest(self, block, replaceTerminators=False):
+        # Don't wait for the queue holding the lock, the others only take tests without waiting
+        with self.heldBackLock:
+            if self.testsHeldBack:
+                return self.testsHeldBack.popleft()
         testOrStatus = self.getItemFromQueue(self.testQueue, block, replaceTerminators)
         if not testOrStatus:
             return
@@ -401,23 +494,67 @@ class QueueSystemServer(BaseActionRunner):
 
     def runTest(self, test):
         submissionRules = self.getSubmissionRules(test)
+        arrayTests = self.findTestsForArrayJob(test, submissionRules)
+        if arrayTests:
+            return self.runArrayJob([test] + arrayTests, submissionRules)
+
         commandArgs = self.getSlaveCommandArgs(test, submissionRules)
         plugins.log.info("Q: Submitting " + repr(test) + submissionRules.getSubmitSuffix())
         sys.stdout.flush()
-        self.jobs[test] = []  # Preliminary jobs aren't interesting any more
+        self.clearJobs(test)  # Preliminary jobs aren't interesting any more
         slaveEnv = OrderedDict()
-        if not self.submitJob(test, submissionRules, commandArgs, slaveEnv):
-            return
+        if self.submitJob(test, submissionRules, commandArgs, slaveEnv):
+            self.markSubmitted([test])
 
+    def markSubmitted(self, tests):
         with self.counterLock:
-            self.testCount -= 1
-            self.testsSubmitted += 1
+            self.testCount -= len(tests)
+            self.testsSubmitted += len(tests)
             self.diag.info("Submission successful" + self.remainStr())
-        if not test.state.hasStarted():
-            test.changeState(self.getPendingState(test))
+        for test in tests:
+            if not test.state.hasStarted():
+                test.changeState(self.getPendingState(test))
         if self.testsSubmitted == self.maxCapacity:
             self.sendServerState("Completed submission of tests up to capacity")
 
+    def canUseArrayJob(self, test):
+        # Proxies submit the real job themselves, and self-diagnostics are written per job name
+        return self.getQueueSystem(test).supportsArrayJobs() and "xs" not in self.optionMap and \
+            not test.getConfigValue("queue_system_proxy_executable")
+
+    def findTestsForArrayJob(self, test, submissionRules):
+        # Gather up the other waiting tests that need exactly the same from the queue system, up to the capacity left
+        maxSize = min(test.getConfigValue("queue_system_max_array_size"), self.maxCapacity - self.testsSubmitted)
+        if maxSize < 2 or not self.canUseArrayJob(test):
+            return []
+
+        arrayKey = submissionRules.getArrayKey()
+        arrayTests, heldBack = [], []
+        with self.heldBackLock:
+            while len(arrayTests) < maxSize - 1:
+                newTest = self.getTest(block=False, replaceTerminators=True)
+                if not newTest:
+                    break
+                if newTest.state.isComplete():
+                    continue
+                if self.canUseArrayJob(newTest) and self.getSubmissionRules(newTest).getArrayKey() == arrayKey:
+                    arrayTests.append(newTest)
+                else:
+                    heldBack.append(newTest)
+            # They should still be next in line
+            self.testsHeldBack.extendleft(reversed(heldBack))
+        return arrayTests
+
+    def runArrayJob(self, tests, submissionRules):
+        jobName = submissionRules.getArrayJobName(len(self.arrayJobs) + 1)
+        commandArgs = self.getSlaveCommandArgs(tests[0], submissionRules, ["-arraytask", jobName])
+        for test in tests:
+            plugins.log.info("Q: Submitting " + repr(test) + " in array job " + jobName + submissionRules.getSubmitSuffix())
+            self.clearJobs(test)
+        sys.stdout.flush()
+        if self.submitArrayJob(tests, submissionRules, jobName, commandArgs, OrderedDict()):
+            self.markSubmitted(tests)
+
     def fixConfigEnv(self, env, test):
         for envVar in test.getConfigValue("queue_system_environment"):
             val = os.getenv(envVar)
@@ -431,14 +568,14 @@ class QueueSystemServer(BaseActionRunner):
     def getPendingState(self, test):
         return Pending(freeText="Job pending in " + queueSystemName(test.app))
 
-    def getSlaveCommandArgs(self, test, submissionRules):
+    def getSlaveCommandArgs(self, test, submissionRules, selectArgs=None):
         queueSystem = self.getQueueSystem(test)
         args = queueSystem.getTextTestArgs()
         if queueSystem.slavesOnRemoteSystem():
             args += ["-home", os.path.expanduser("~")]
         return args + ["-d", ":".join(self.optionMap.rootDirectories),
                        "-a", test.app.name + test.app.versionSuffix(),
-                       "-l", "-tp", test.getRelPath()] + \
+                       "-l"] + (selectArgs or ["-tp", test.getRelPath()]) + \
             self.getSlaveArgs(test) + self.getRunOptions(test.app, submissionRules)
 
     def getSlaveArgs(self, test):
@@ -545,7 +682,7 @@ class QueueSystemServer(BaseActionRunner):
                 # if the slaves run elsewhere (e.g. the cloud) then the capacity of the system can change dynamically depending on what is available
                 if queueSystem.slavesOnRemoteSystem():
                     self.checkQueueCapacity(queueSystem)
-                self.jobs.setdefault(test, []).append((jobId, jobName))
+                self.addJob(test, jobId, jobName)
                 self.lockDiag.info("Releasing lock for submission...")
                 return True
             else:
@@ -554,6 +691,45 @@ class QueueSystemServer(BaseActionRunner):
                 self.handleErrorState(test)
                 return False
 
+    def submitArrayJob(self, tests, submissionRules, jobName, commandArgs, slaveEnv):
+        self.fixConfigEnv(slaveEnv, tests[0])
+        queueSystem = self.getQueueSystem(tests[0])
+        queueSystem.prepareEnvForSubmit(slaveEnv)
+        cmdArgs = queueSystem.getArraySubmitCmdArgs(submissionRules, jobName, len(tests), commandArgs, slaveEnv)
+        self.diag.info("Creating array job " + jobName + " with command arguments : " + " ".join(cmdArgs))
+        with self.lock:
+            if self.exited:
+                for test in tests:
+                    self.cancel(test)
+                plugins.log.info("Q: Submission cancelled for array job " + jobName + " - exit underway")
+                return False
+
+            self.lockDiag.info("Got lock for submission")
+            # The tasks ask which test to run as soon as they start, which might be before we hear back
+            self.arrayJobs[jobName] = tests
+            taskRules = [self.getSubmissionRules(test) for test in tests]
+            logDir = self.getSlaveLogDir(tests[0])
+            jobIds, errorMessage = queueSystem.submitArrayJob(cmdArgs, slaveEnv, logDir, taskRules, "")
+            if jobIds is not None:
+                self.diag.info("Array job created with task ids " + repr(jobIds))
+                for test, jobId, taskSubmissionRules in zip(tests, jobIds, taskRules):
+                    self.addJob(test, jobId, taskSubmissionRules.getJobName())
+                self.lockDiag.info("Releasing lock for submission...")
+                return True
+            else:
+                self.diag.info("Array job not created : " + errorMessage)
+                for test in tests:
+                    test.changeState(plugins.Unrunnable(errorMessage, "NOT SUBMITTED"))
+                    self.handleErrorState(test)
+                return False
+
+    def getArrayTaskTest(self, jobName, taskIndex):
+        tests = self.arrayJobs.get(jobName, [])
+        if 0 < taskIndex <= len(tests):
+            test = tests[taskIndex - 1]
+            self.diag.info("Task " + str(taskIndex) + " of array job " + jobName + " should run " + test.uniqueName)
+            return test
+
     def checkQueueCapacity(self, queueSystem):
         queueCapacity = queueSystem.getCapacity()
         if queueCapacity:
@@ -562,13 +738,15 @@ class QueueSystemServer(BaseActionRunner):
                     self.maxCapacity = queueCapacity
 
     def handleErrorState(self, test, previouslySubmitted=False):
+        # previouslySubmitted is None for tests handed to a slave in advance, which are already counted off
         with self.counterLock:
-            if self.maxCapacity > 1:
-                self.maxCapacity -= 1
-            if previouslySubmitted:
-                self.testsSubmitted -= 1
-            else:
-                self.testCount -= 1
+            if previouslySubmitted is not None:
+                if self.maxCapacity > 1:
+                    self.maxCapacity -= 1
+                if previouslySubmitted:
+                    self.testsSubmitted -= 1
+                else:
+                    self.testCount -= 1
         self.diag.info(repr(test) + " in error state" + self.remainStr())
         bugchecker = CheckForBugs()
         self.setUpSuites(bugchecker, test)
@@ -727,10 +905,10 @@ class QueueSystemServer(BaseActionRunner):
             # Job accounting info can take ages to find, don't do it from GUI quit
             return "No accounting info found as quitting..."
 
-    def setSlaveFailed(self, test, startNotified, wantStatus, jobId):
+    def setSlaveFailed(self, test, startNotified, wantStatus, jobId, previouslySubmitted=True):
         failReason, fullText = self.getSlaveFailure(test, startNotified, wantStatus)
         fullText = failReason + "\nJob ID was " + jobId + "\n" + fullText
-        self.changeState(test, self.getSlaveFailureState(startNotified, failReason, fullText))
+        self.changeState(test, self.getSlaveFailureState(startNotified, failReason, fullText), previouslySubmitted)
 
     def getSlaveFailure(self, test, startNotified, wantStatus):
         fullText = ""
@@ -777,7 +955,13 @@ class BasicSubmissionRules:
         path = self.test.getRelPath()
         parts = path.split(os.sep)
         parts.reverse()
-        name = self.classPrefix + "-" + ".".join(parts) + "-" + repr(self.test.app).replace(" ", "_").replace("/", "_")
+        return self.makeJobName(self.classPrefix + "-" + ".".join(parts))
+
+    def getArrayJobName(self, arrayIndex):
+        return self.makeJobName(self.classPrefix + "s-" + str(arrayIndex))
+
+    def makeJobName(self, prefix):
+        name = prefix + "-" + repr(self.test.app).replace(" ", "_").replace("/", "_")
         return name.replace(":", "_")
 
     def getJobFiles(self):
@@ -833,6 +1017,12 @@ class SubmissionRules(BasicSubmissionRules):
         # Don't care about the order of the resources
         return set(self.configResources) == set(newRules.configResources)
 
+    def getArrayKey(self):
+        # Tests can only share an array job if everything we tell the queue system about them is the same
+        return repr(self.test.app), self.findQueue(), tuple(sorted(self.findResourceList())), \
+            tuple(self.findMachineList()), self.processesNeeded, self.getParallelEnvironment(), \
+            tuple(self.getExtraSubmitArgs()), self.findPriority(), self.useCoreBinding()
+
 
 class ProxySubmissionRules(SubmissionRules):
     classPrefix = "Proxy"
@@ -957,8 +1147,12 @@ class SlaveRequestHandler(StreamRequestHandler):
         identifier = str(self.rfile.readline().strip(), getpreferredencoding())
         if identifier == "TERMINATE_SERVER":
             return
-
-        self.handleMessage(identifier)
+        elif identifier == framedProtocolLine:
+            self.handleFramedConnection()
+        elif identifier.startswith(arrayTaskRequest):
+            self.handleArrayTaskRequest(identifier)
+        else:
+            self.handleMessage(identifier)
 
     def handleMessage(self, identifier):
         # Don't use port, it changes all the time
@@ -966,9 +1160,7 @@ class SlaveRequestHandler(StreamRequestHandler):
         testString = str(self.rfile.readline().strip(), getpreferredencoding())
         test = self.server.getTest(testString)
         if test is None:
-            clientHost = self.client_address[0]
-            sys.stderr.write("WARNING: Received request from hostname " + self.getHostName(clientHost) +
-                             " (process " + identifier + ")\nwhich could not be parsed:\n'" + testString + "'\n")
+            self.warnUnparsed(identifier, testString)
         elif getFiles:
             self.pushFiles(test)
         elif not test.state.isComplete() or not test.state.hasResults():  # we might have killed it already...
@@ -987,6 +1179,72 @@ class SlaveRequestHandler(StreamRequestHandler):
             # This only occurs on a mac, and doesn't affect functionality.
             pass
 
+    def handleArrayTaskRequest(self, request):
+        _, jobName, taskIndex = request.split()
+        test = QueueSystemServer.instance.getArrayTaskTest(jobName, int(taskIndex))
+        if test:
+            self.wfile.write(socketSerialise(test).encode(getpreferredencoding()))
+        else:
+            clientHost = self.client_address[0]
+            sys.stderr.write("WARNING: Received request from hostname " + self.getHostName(clientHost) +
+                             " for task " + taskIndex + " of unknown array job " + jobName + "\n")
+
+    def warnUnparsed(self, identifier, testString):
+        clientHost = self.client_address[0]
+        sys.stderr.write("WARNING: Received request from hostname " + self.getHostName(clientHost) +
+                         " (process " + identifier + ")\nwhich could not be parsed:\n'" + testString + "'\n")
+
+    def handleFramedConnection(self):
+        # Persistent connection: the slave sends all its messages here until it terminates
+        reader = FrameReader(self.rfile)
+        writer = FrameWriter(self.wfile)
+        writer.writeText(helloFrame, " ".join(getCompressionCodecs()))
+        writer.flush()
+        while True:
+            try:
+                frameType, payload = reader.readFrame(allowEnd=True)
+                if frameType is None:
+                    break
+                elif frameType != identifierFrame:
+                    raise FrameError("Expected start of message, received frame of type " + repr(frameType))
+                response = self.handleFramedMessage(reader, str(payload, getpreferredencoding()))
+                writer.writeText(responseFrame, response)
+                writer.flush()
+            except socket.error as e:
+                self.server.diag.info("Closing connection from " + repr(self.client_address) + " : " + str(e))
+                break
+
+    def handleFramedMessage(self, reader, identifier):
+        identifier, sendFiles, getFiles, tryReuse, rerun = parseIdentifier(identifier)
+        testString = reader.readText(testFrame)
+        test = self.server.getTest(testString)
+        if test is None:
+            self.warnUnparsed(identifier, testString)
+            reader.skipMessage()
+        elif getFiles:
+            userAndHost = reader.readText(userAndHostFrame)
+            paths = []
+            while True:
+                frameType, payload = reader.readExpected(pathFrame, endMessageFrame)
+                if frameType == endMessageFrame:
+                    break
+                paths.append(str(payload, getpreferredencoding()))
+            self.server.pushFiles(test, userAndHost, paths)
+        elif not test.state.isComplete() or not test.state.hasResults():  # we might have killed it already...
+            if sendFiles:
+                self.server.diag.info("Test " + test.uniqueName +
+                                      " - receiving files sent from slave to sandbox directory")
+                reader.readDirectory(test.writeDirectory)
+            stateData = reader.readExpected(stateFrame)[1]
+            reader.readExpected(endMessageFrame)
+            _, state = test.getNewState(BytesIO(stateData), updatePaths=True)
+            return self.processState(test, state, identifier, tryReuse, rerun)
+        else:
+            self.server.diag.info("Test " + test.uniqueName + " already complete, ignoring new results")
+            reader.skipMessage()
+            return self.getReuseResponse(test, test.state, tryReuse, False)
+        return ""
+
     def getHostName(self, ipAddress):
         try:
             return socket.gethostbyaddr(ipAddress)[0].split(".")[0]
@@ -1001,35 +1259,60 @@ class SlaveRequestHandler(StreamRequestHandler):
             paths.append(str(line.strip(), encoding))
         self.server.pushFiles(test, userAndHost, paths)
 
-    def sendReuseResponse(self, *args):
+    def getReuseResponse(self, *args):
         newTest = QueueSystemServer.instance.getTestForReuse(*args)
         if newTest:
             response = socketSerialise(newTest)
             self.server.diag.info("Sending reuse response " + response)
+            return response
+        else:
+            return ""
+
+    def getPrefetchResponse(self, test, state, tryReuse):
+        if not tryReuse:
+            return ""
+        newTests = QueueSystemServer.instance.prefetchTests(test, state)
+        response = "\n".join(map(socketSerialise, newTests))
+        if response:
+            self.server.diag.info("Sending prefetch response " + repr(response))
+        return response
+
+    def sendReuseResponse(self, *args):
+        response = self.getReuseResponse(*args)
+        if response:
             self.wfile.write(response.encode(getpreferredencoding()))
 
     def handleRequestFromHost(self, test, pid, tryReuse, rerun):
         # The updates are only for testing against old slave traffic,
         # a bit sad we can't disable them when not testing...
         _, state = test.getNewState(self.rfile, updatePaths=True)
-        if test.state.isComplete():
-            state.lifecycleChange = "recalculated"
-        doneRerun = self.server.changeStateOrRerun(test, state, rerun)
         try:
             self.connection.shutdown(socket.SHUT_RD)
         except socket.error:
             # This only occurs on a mac, and doesn't affect functionality.
             pass
+        response = self.processState(test, state, pid, tryReuse, rerun)
+        if response:
+            self.wfile.write(response.encode(getpreferredencoding()))
+
+    def processState(self, test, state, pid, tryReuse, rerun):
+        if test.state.isComplete():
+            state.lifecycleChange = "recalculated"
+        doneRerun = self.server.changeStateOrRerun(test, state, rerun)
         if state.isComplete():
-            self.sendReuseResponse(test, state, tryReuse, doneRerun)
+            return self.getReuseResponse(test, state, tryReuse, doneRerun)
         else:
             QueueSystemServer.instance.setRemoteProcessId(test, pid)
+            return self.getPrefetchResponse(test, state, tryReuse)
 
 
 class SlaveServerResponder(plugins.Responder, ThreadingTCPServer):
     # Python's default value of 5 isn't very much...
     # There doesn't seem to be any disadvantage of allowing a longer queue, so we will use the system's maximum size
     request_queue_size = socket.SOMAXCONN
+    # Slaves keep their connections open, don't wait for them when shutting down
+    daemon_threads = True
+    block_on_close = False
 
     def __init__(self, optionMap, allApps):
         plugins.Responder.__init__(self)
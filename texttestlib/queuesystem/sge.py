@@ -67,6 +67,19 @@ class QueueSystem(gridqueuesystem.QueueSystem):
         qsubArgs += ["-o", os.devnull, "-e", self.getSlaveStartErrorFile()]
         return self.addExtraAndCommand(qsubArgs, submissionRules, commandArgs)
 
+    def supportsArrayJobs(self):
+        return True
+
+    def getArraySubmitCmdArgs(self, submissionRules, jobName, taskCount, commandArgs=[], slaveEnv={}):
+        qsubArgs = self.getSubmitCmdArgs(submissionRules, commandArgs, slaveEnv)
+        qsubArgs[2] = jobName
+        qsubArgs[3:3] = ["-t", "1-" + str(taskCount)]
+        return qsubArgs
+
+    def getArrayTaskJobId(self, jobId, taskIndex):
+        # qsub describes array jobs as e.g. 1234.1-10:1, qdel and qmod accept 1234.5 for a single task
+        return jobId.split(".")[0] + "." + str(taskIndex)
+
     def getResourceArg(self, submissionRules):
         resourceList = submissionRules.findResourceList()
         machines = submissionRules.findMachineList()
@@ -105,6 +118,12 @@ class QueueSystem(gridqueuesystem.QueueSystem):
         return jobId
 
     def getStatusForAllJobs(self):
+        return self.getStatusForJobs()
+
+    def getStatusForJobs(self, jobIds=None):
+        # qstat can't be restricted to particular jobs, but we only need to examine the ones we asked about
+        if jobIds is not None:
+            jobIds = set(jobIds)
         statusDict = {}
         proc = subprocess.Popen(["qstat"], stdin=open(os.devnull), stdout=subprocess.PIPE, stderr=subprocess.PIPE, encoding=getpreferredencoding())
         outMsg = proc.communicate()[0]
@@ -115,21 +134,42 @@ class QueueSystem(gridqueuesystem.QueueSystem):
         for line in outMsg.splitlines():
             words = line.split()
             if len(words) >= 5 and words[0].isdigit():
-                jobId = words[0]
                 statusLetter = self.getStatusLetter(words, 4)
-                if statusLetter in self.errorStatuses:
-                    self.errorReasons[jobId] = self.getErrorReason(jobId)
-                    self.killJob(jobId)
-                    continue
-
-                status = self.allStatuses.get(statusLetter)
-                if status:
-                    statusDict[jobId] = status
-                else:
-                    log.info("WARNING: unexpected job status " + repr(statusLetter) + " received from SGE!")
-                    statusDict[jobId] = statusLetter, statusLetter
+                lineJobIds = [words[0]] + self.getTaskJobIds(words, words.index(statusLetter, 4))
+                for jobId in lineJobIds:
+                    if jobIds is None or jobId in jobIds:
+                        self.addStatus(statusDict, jobId, statusLetter)
         return statusDict
 
+    def addStatus(self, statusDict, jobId, statusLetter):
+        if statusLetter in self.errorStatuses:
+            self.errorReasons[jobId] = self.getErrorReason(jobId.split(".")[0])
+            self.killJob(jobId)
+            return
+
+        status = self.allStatuses.get(statusLetter)
+        if status:
+            statusDict[jobId] = status
+        else:
+            log.info("WARNING: unexpected job status " + repr(statusLetter) + " received from SGE!")
+            statusDict[jobId] = statusLetter, statusLetter
+
+    def getTaskJobIds(self, words, statusIndex):
+        # After the state and the date come the queue (if running), the slots and, for array jobs, the tasks
+        remaining = words[statusIndex + 3:]
+        if remaining and not remaining[0].isdigit():
+            remaining = remaining[1:]
+        if len(remaining) < 2:
+            return []
+        taskIds = []
+        for part in remaining[1].split(","):
+            taskRange, _, step = part.partition(":")
+            first, _, last = taskRange.partition("-")
+            if first.isdigit() and (last or first).isdigit() and (step or "1").isdigit():
+                taskIds += [self.getArrayTaskJobId(words[0], taskIndex)
+                            for taskIndex in range(int(first), int(last or first) + 1, int(step or 1))]
+        return taskIds
+
     def isDate(self, text):
         return len(text) == 10 and text.count("/") == 2
 
@@ -182,6 +222,9 @@ class QueueSystem(gridqueuesystem.QueueSystem):
             return "Could not find info about job: " + jobId + "\nqacct error was as follows:\n" + acctError
 
     def getAccountInfo(self, jobId, extraArgs=[]):
+        if "." in jobId:  # a task in an array job
+            jobId, taskIndex = jobId.split(".")
+            extraArgs = ["-t", taskIndex] + extraArgs
         cmdArgs = ["qacct", "-j", jobId] + extraArgs
         proc = subprocess.Popen(cmdArgs, stdin=open(os.devnull), stdout=subprocess.PIPE, stderr=subprocess.PIPE, encoding=getpreferredencoding())
         outMsg, errMsg = proc.communicate()
@@ -272,6 +315,12 @@ def getUserSignalKillInfo(userSignalNumber, explicitKillMethod):
     else:
         return explicitKillMethod()
 
+# Used by the tasks of array jobs to find out which test to run
+
+
+def getArrayTaskIndex():
+    return os.getenv("SGE_TASK_ID")
+
 # Used by slave to find all execution machines
 
 
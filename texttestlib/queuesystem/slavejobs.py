@@ -9,11 +9,14 @@ import time
 import socket
 import signal
 import logging
+from threading import Lock, Thread
+from queue import Queue, Empty
 from .utils import *
 from texttestlib import plugins
 from texttestlib.default.runtest import RunTest
-from texttestlib.default.sandbox import FindExecutionHosts, MachineInfoFinder
+from texttestlib.default.sandbox import FindExecutionHosts, MachineInfoFinder, MakeWriteDirectory, PrepareWriteDirectory
 from texttestlib.default.actionrunner import ActionRunner
+from texttestlib.default.scheduling import TestScheduler
 from texttestlib.utils import getUserName
 from pickle import dumps
 from locale import getpreferredencoding
@@ -24,6 +27,23 @@ def importAndCallFromQueueSystem(app, *args):
     return plugins.importAndCall(moduleName, *args)
 
 
+def fetchArrayTaskTest(app, optionMap):
+    taskIndex = importAndCallFromQueueSystem(app, "getArrayTaskIndex")
+    servAddrStr = optionMap.get("servaddr", os.getenv("CAPTUREMOCK_SERVER"))
+    if not taskIndex or not servAddrStr:
+        raise plugins.TextTestError("Cannot run array job task, no task index or server address has been provided!")
+    host, port = servAddrStr.split(":")
+    sendSocket = socket.create_connection((host, int(port)))
+    request = arrayTaskRequest + " " + optionMap.get("arraytask") + " " + taskIndex + "\n"
+    sendSocket.sendall(request.encode(getpreferredencoding()))
+    sendSocket.shutdown(socket.SHUT_WR)
+    response = str(sendSocket.makefile("rb").read(), getpreferredencoding())
+    sendSocket.close()
+    if not response:
+        raise plugins.TextTestError("Master process has no test for task " + taskIndex + " of array job " + optionMap.get("arraytask"))
+    return socketParse(response)[1]
+
+
 # Use a non-monitoring runTest, but the rest from unix
 class RunTestInSlave(RunTest):
     def getBriefText(self, execMachines):
@@ -31,9 +51,10 @@ class RunTestInSlave(RunTest):
 
     def getKillInfoOtherSignal(self, test):
         if os.name == "posix":
-            if self.killSignal == signal.SIGUSR1:
+            killSignal = self.getKillSignal(test)
+            if killSignal == signal.SIGUSR1:
                 return self.getUserSignalKillInfo(test, "1")
-            elif self.killSignal == signal.SIGUSR2:
+            elif killSignal == signal.SIGUSR2:
                 return self.getUserSignalKillInfo(test, "2")
 
         return RunTest.getKillInfoOtherSignal(self, test)
@@ -76,7 +97,18 @@ class SocketResponder(plugins.Responder, plugins.Observable):
         self.killed = False
         self.transferAll = optionMap.get("keepslave") or optionMap.get("keeptmp")
         self.testsForRerun = []
+        # Tests the master has given us that we haven't finished yet
+        self.testsAhead = set()
+        # Results sent while the next test runs, and the master's replies to them.
+        # Only the thread running the tests acts on the replies, as they can change the test tree
+        self.backgroundSends = []
+        self.backgroundResponses = Queue()
         self.serverAddress = self.getServerAddress(optionMap)
+        # Traffic recorded by CaptureMock needs to stay as text, otherwise keep one framed connection open to the master
+        self.useFramedProtocol = not os.getenv("CAPTUREMOCK_SERVER")
+        self.connection = None
+        self.codec = None
+        self.connectionLock = Lock()
 
     def getServerAddress(self, optionMap):
         servAddrStr = optionMap.get("servaddr", os.getenv("CAPTUREMOCK_SERVER"))
@@ -115,27 +147,92 @@ class SocketResponder(plugins.Responder, plugins.Observable):
     def notifyRerun(self, test):
         self.testsForRerun.append(test)
 
+    def notifyAdd(self, test, initial):
+        if not initial and test.classId() == "test-case":
+            self.testsAhead.add(test)
+
     def notifyLifecycleChange(self, test, state, changeDesc):
         testData = socketSerialise(test)
         protocol = int(os.getenv("TEXTTEST_PICKLE_PROTOCOL", 2)) # Which pickle protocol to use. Useful to set to plain text for self-tests.
         pickleData = dumps(state, protocol=protocol)
         sendFiles = self.synchFiles and changeDesc == "complete" and (self.transferAll or not test.state.hasSucceeded())
-        fullData = self.getProcessIdentifier(test, sendFiles) + os.linesep + testData + os.linesep
-        if sendFiles:
-            fullData += directorySerialise(test.writeDirectory) + os.linesep
-        fullDataBytes = fullData.encode(getpreferredencoding()) + pickleData
-        return self.sendAndInterpret(fullDataBytes, self.interpretResponse, state)
+        identifier = self.getProcessIdentifier(test, sendFiles)
+        if self.useFramedProtocol:
+            def writeMessage(writer):
+                writer.writeText(identifierFrame, identifier)
+                writer.writeText(testFrame, testData)
+                if sendFiles:
+                    writer.writeDirectory(test.writeDirectory, self.codec)
+                writer.writeFrame(stateFrame, pickleData)
+            fullData = writeMessage
+        else:
+            def writeData(f):
+                f.write((identifier + os.linesep + testData + os.linesep).encode(getpreferredencoding()))
+                if sendFiles:
+                    directorySerialise(test.writeDirectory, f)
+                f.write(pickleData)
+            fullData = writeData
+
+        if changeDesc == "complete":
+            self.testsAhead.discard(test)
+            if self.testsAhead and not sendFiles:
+                # We already have the next test, don't hold it up while the master takes in these results
+                thread = Thread(target=self.sendInBackground, args=(fullData, state))
+                self.backgroundSends.append(thread)
+                thread.start()
+                return
+        # If nothing is left to run, hear what the master said to everything else first
+        self.handleBackgroundResponses(wait=changeDesc == "complete")
+        return self.sendAndInterpret(fullData, self.interpretResponse, state)
+
+    def sendInBackground(self, fullData, state):
+        with self.connectionLock:
+            self.backgroundResponses.put((self.send(fullData), state))
+
+    def handleBackgroundResponses(self, wait):
+        if wait:
+            for thread in self.backgroundSends:
+                thread.join()
+            self.backgroundSends = []
+        while True:
+            try:
+                response, state = self.backgroundResponses.get_nowait()
+            except Empty:
+                return
+            if response is None:
+                self.notify("NoMoreExtraTests")
+            else:
+                self.interpretResponse(response, state, inBackground=True)
 
     def sendAndInterpret(self, fullData, responseMethod, *args):
+        # fullData is either the bytes to send, or a method writing them to a file (or frames, if we use the framed protocol)
+        with self.connectionLock:
+            response = self.send(fullData)
+        if response is None:
+            self.notify("NoMoreExtraTests")
+        elif responseMethod:
+            return responseMethod(response, *args)
+        else:
+            return True
+
+    def send(self, fullData):
+        # Returns the master's response, or None if we couldn't get one. Call with the connection lock
         sleepTime = 1
         for _ in range(9):
-            sendSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            if not self.connect(sendSocket):
-                return self.notify("NoMoreExtraTests")
+            if self.useFramedProtocol:
+                if self.connection is None and not self.openConnection():
+                    return
+            else:
+                sendSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                if not self.connect(sendSocket):
+                    return
             try:
-                response = self.sendData(sendSocket, fullData)
-                return responseMethod(response, *args) if responseMethod else True
+                if self.useFramedProtocol:
+                    return self.sendMessage(fullData)
+                else:
+                    return self.sendData(sendSocket, fullData)
             except socket.error as e:
+                self.closeConnection()
                 plugins.log.info("Failed to communicate with master process - waiting " +
                                  str(sleepTime) + " seconds and then trying again.")
                 plugins.log.info("Error received was " + str(e))
@@ -145,10 +242,63 @@ class SocketResponder(plugins.Responder, plugins.Observable):
         message = "Terminating as failed to communicate with master process : " + self.exceptionOutput()
         sys.stderr.write(message)
         plugins.log.info(message.strip())
-        self.notify("NoMoreExtraTests")
+
+    def openConnection(self):
+        sendSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if not self.connect(sendSocket):
+            return False
+        reader = FrameReader(sendSocket.makefile("rb"))
+        writer = FrameWriter(sendSocket.makefile("wb"))
+        self.connection = sendSocket, reader, writer
+        try:
+            writer.file.write((framedProtocolLine + "\n").encode(getpreferredencoding()))
+            writer.flush()
+            self.setResponseTimeout(sendSocket)
+            self.codec = chooseCompressionCodec(reader.readText(helloFrame).split())
+        except socket.error:
+            # Let the caller retry, as for any other failure to communicate
+            self.codec = None
+        return True
+
+    def closeConnection(self):
+        if self.connection is not None:
+            sendSocket, reader, writer = self.connection
+            self.connection = None
+            for closeable in [reader.file, writer.file, sendSocket]:
+                try:
+                    closeable.close()
+                except socket.error:
+                    pass
+
+    def setResponseTimeout(self, sendSocket):
+        if self.synchFiles:
+            # Remote socket, possibly firewalls that kill connections, possibly other things. Use timeout and be prepared to retry...
+            # TCP timeout is typically 30 seconds, give up a bit before that
+            sendSocket.settimeout(25)
+
+    def sendMessage(self, writeMessage):
+        if self.codec is None:
+            raise FrameError("No greeting received from master process")
+        sendSocket, reader, writer = self.connection
+        sendSocket.settimeout(None)
+        writeMessage(writer)
+        writer.writeFrame(endMessageFrame)
+        writer.flush()
+        self.setResponseTimeout(sendSocket)
+        return reader.readText(responseFrame)
+
+    def notifyAllComplete(self):
+        with self.connectionLock:
+            self.closeConnection()
 
     def sendData(self, sendSocket, fullData):
-        sendSocket.sendall(fullData)
+        if callable(fullData):
+            # Stream it straight to the socket, it may contain whole sandbox directories
+            sendFile = sendSocket.makefile("wb")
+            fullData(sendFile)
+            sendFile.close()
+        else:
+            sendSocket.sendall(fullData)
         sendSocket.shutdown(socket.SHUT_WR)
         if self.synchFiles:
             # Remote socket, possibly firewalls that kill connections, possibly other things. Use timeout and be prepared to retry...
@@ -158,24 +308,96 @@ class SocketResponder(plugins.Responder, plugins.Observable):
         sendSocket.close()
         return str(response, getpreferredencoding())
 
-    def interpretResponse(self, response, state):
-        if len(response) > 0:
-            appDesc, testPath = socketParse(response)
+    def interpretResponse(self, response, state, inBackground=False):
+        # Several tests if the master is giving us them in advance
+        for testString in response.splitlines():
+            appDesc, testPath = socketParse(testString)
             appParts = appDesc.split(".")
             self.notify("ExtraTest", testPath, appParts[0], appParts[1:])
-        elif state.isComplete():
+        # Replies to results sent in the background can overtake the reply for the test we had lined up.
+        # Only the reply for the last test can tell us there is nothing more to do
+        if len(response) == 0 and state.isComplete() and not self.testsAhead and not inBackground:
             self.notify("NoMoreExtraTests")
 
     def notifyRequiredTestData(self, test, paths):
         if self.synchFiles:
             for path in paths:
                 plugins.log.info(test.getIndent() + "Fetching required test data at " + repr(path) + " ...")
-            data = makeIdentifierLine(str(os.getpid()), getFiles=True) + "\n" + socketSerialise(test) + "\n" + \
-                getUserName() + "@" + getIPAddress([test]) + "\n" + "\n".join(paths)
-            self.sendAndInterpret(data.encode(getpreferredencoding()), None)  # Just wait, no response to interpret
+            identifier = makeIdentifierLine(str(os.getpid()), getFiles=True)
+            userAndHost = getUserName() + "@" + getIPAddress([test])
+            if self.useFramedProtocol:
+                def writeMessage(writer):
+                    writer.writeText(identifierFrame, identifier)
+                    writer.writeText(testFrame, socketSerialise(test))
+                    writer.writeText(userAndHostFrame, userAndHost)
+                    for path in paths:
+                        writer.writeText(pathFrame, path)
+                self.sendAndInterpret(writeMessage, None)  # Just wait, no response to interpret
+            else:
+                data = identifier + "\n" + socketSerialise(test) + "\n" + userAndHost + "\n" + "\n".join(paths)
+                self.sendAndInterpret(data.encode(getpreferredencoding()), None)  # Just wait, no response to interpret
 
 
 class SlaveActionRunner(ActionRunner):
+    # Actions that only get the sandbox ready. For tests we are given in advance, these are done while the current test runs
+    sandboxActionClasses = (MakeWriteDirectory, PrepareWriteDirectory)
+
+    def __init__(self, *args):
+        ActionRunner.__init__(self, *args)
+        self.sandboxPreparations = {}
+        self.sandboxesPrepared = {}
+
+    def addTest(self, test):
+        ActionRunner.addTest(self, test)
+        appRunner = self.appRunners.get(test.app)
+        if self.currentTestRunners and appRunner and not test.app.getRemoteTestTmpDir(test)[1]:
+            actions = self.findSandboxActions(appRunner)
+            if actions:
+                self.diag.info("Preparing sandbox for " + test.uniqueName + " in advance")
+                # One at a time, in the order we'll run them
+                previous = list(self.sandboxPreparations.values())[-1] if self.sandboxPreparations else None
+                thread = Thread(target=self.prepareSandbox, args=(test, actions, previous))
+                self.sandboxPreparations[test] = thread
+                thread.start()
+
+    def findSandboxActions(self, appRunner):
+        # Only those at the start of the sequence, finding execution hosts is the only thing allowed before them
+        actions = []
+        for action in appRunner.actionSequence:
+            if isinstance(action, self.sandboxActionClasses):
+                actions.append(action)
+            elif not isinstance(action, FindExecutionHosts):
+                break
+        return actions
+
+    def prepareSandbox(self, test, actions, previous):
+        if previous:
+            previous.join()
+        try:
+            for action in actions:
+                action(test)
+            self.sandboxesPrepared[test] = actions
+        except Exception:
+            # The test's own action sequence will try again, and report any problem properly
+            self.diag.info("Failed to prepare sandbox for " + test.uniqueName + " in advance :\n" + plugins.getExceptionString())
+
+    def runTest(self, test):
+        thread = self.sandboxPreparations.pop(test, None)
+        if thread:
+            thread.join()
+        ActionRunner.runTest(self, test)
+
+    def makeTestRunner(self, test, appRunner):
+        testRunner = ActionRunner.makeTestRunner(self, test, appRunner)
+        preparedActions = self.sandboxesPrepared.pop(test, [])
+        if preparedActions:
+            testRunner.setActionSequence([action for action in appRunner.actionSequence if action not in preparedActions])
+        return testRunner
+
+    def makeScheduler(self):
+        # The master decides the order and records how long the tests took
+        return TestScheduler(active=False)
+
     def notifyAllRead(self, goodSuites):
         # don't ordinarily add a terminator, we might get given more tests via the socket (code above)
         # Need to add one if we haven't found any tests though
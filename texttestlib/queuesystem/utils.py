@@ -4,14 +4,23 @@ Utilities for both master and slave code
 """
 
 import os
+import zlib
 import socket
+import struct
 from texttestlib import plugins
 from locale import getpreferredencoding
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 noReusePostfix = ".NO_REUSE"
 rerunPostfix = ".RERUN_TEST"
 sendFilePostfix = ".SEND_FILES"
 getFilePostfix = ".GET_FILES"
+# Sent by the tasks of array jobs, which don't know which test they should run until they ask
+arrayTaskRequest = "TEXTTEST_ARRAY_TASK"
 
 
 def getIPAddress(apps):
@@ -83,40 +92,198 @@ def parseIdentifier(line):
 dirText = "DIRECTORY_CONTENTS"
 fileText = "FILE_CONTENTS"
 endPrefix = "END_"
+copyBlockSize = 1024 * 1024
 
 
-def directorySerialise(dirName, ignoreLinks=False):
-    text = ""
+def iterDirectoryFiles(dirName):
     for root, _, files in os.walk(dirName):
         for fn in sorted(files):
             path = os.path.join(root, fn)
             if not os.path.islink(path):
-                relpath = plugins.relpath(path, dirName)
-                text += fileText + " " + relpath + "\n"
-                with open(path) as f:
-                    text += f.read()
-                if not text.endswith("\n"):
-                    text += "\n"
-                text += endPrefix + fileText + "\n"
-    text += endPrefix + dirText
-    return text
+                yield path, plugins.relpath(path, dirName)
+
+
+def directorySerialise(dirName, f):
+    # Written straight to the binary file f, a block at a time, so memory use doesn't depend on the directory size.
+    # Each file is a header line giving its size and relative path, followed by exactly that many bytes
+    encoding = getpreferredencoding()
+    for path, relpath in iterDirectoryFiles(dirName):
+        with open(path, "rb") as currFile:
+            size = os.fstat(currFile.fileno()).st_size
+            f.write((fileText + " " + str(size) + " " + relpath + "\n").encode(encoding))
+            remaining = size
+            while remaining > 0:
+                block = currFile.read(min(remaining, copyBlockSize))
+                if not block:
+                    break
+                f.write(block)
+                remaining -= len(block)
+            if remaining > 0:
+                # File shrank while we were reading it: pad it out, or the reader will lose its place
+                f.write(b"\0" * remaining)
+    f.write((endPrefix + dirText + "\n").encode(encoding))
 
 
 def directoryUnserialise(rootDir, f):
-    currFile = None
-    for line in f:
-        lineStr = str(line, getpreferredencoding())
-        if currFile is not None:
-            if lineStr.startswith(endPrefix + fileText):
+    encoding = getpreferredencoding()
+    for line in iter(f.readline, b""):
+        lineStr = str(line, encoding).rstrip("\r\n")
+        if lineStr.startswith(fileText):
+            _, size, relpath = lineStr.split(" ", 2)
+            path = os.path.join(rootDir, relpath)
+            plugins.ensureDirExistsForFile(path)
+            remaining = int(size)
+            with open(path, "wb") as currFile:
+                while remaining > 0:
+                    block = f.read(min(remaining, copyBlockSize))
+                    if not block:
+                        return
+                    currFile.write(block)
+                    remaining -= len(block)
+        elif lineStr.startswith(endPrefix + dirText):
+            break
+
+
+# Framed binary protocol between slaves and master, used on persistent connections.
+# After the protocol line, every frame is a type byte and a payload length, followed by the payload.
+# A message is a sequence of frames ending with an end-of-message frame, the master replies with a single frame.
+framedProtocolLine = "TEXTTEST_FRAMED_PROTOCOL"
+frameHeader = struct.Struct("!cQ")
+helloFrame = b"H"
+identifierFrame = b"I"
+testFrame = b"T"
+stateFrame = b"S"
+userAndHostFrame = b"U"
+pathFrame = b"P"
+fileFrame = b"F"
+endFileFrame = b"E"
+endDirectoryFrame = b"D"
+endMessageFrame = b"M"
+responseFrame = b"R"
+# File data is sent in compressed chunks, the frame type says how it was compressed
+chunkFrames = {"zstd": b"Z", "zlib": b"z"}
+
+
+class FrameError(ConnectionError):
+    pass
+
+
+def getCompressionCodecs():
+    # In order of preference
+    return ["zstd", "zlib"] if zstandard else ["zlib"]
+
+
+def chooseCompressionCodec(remoteCodecs):
+    for codec in getCompressionCodecs():
+        if codec in remoteCodecs:
+            return codec
+    return "zlib"
+
+
+def makeCompressor(codec):
+    if codec == "zstd":
+        return zstandard.ZstdCompressor().compressobj()
+    else:
+        return zlib.compressobj()
+
+
+def makeDecompressor(codecFrame):
+    if codecFrame == chunkFrames["zstd"]:
+        if zstandard is None:
+            raise FrameError("Received zstd-compressed data, but the zstandard module is not installed")
+        return zstandard.ZstdDecompressor().decompressobj()
+    else:
+        return zlib.decompressobj()
+
+
+class FrameWriter:
+    def __init__(self, file):
+        self.file = file
+
+    def writeFrame(self, frameType, payload=b""):
+        self.file.write(frameHeader.pack(frameType, len(payload)) + payload)
+
+    def writeText(self, frameType, text):
+        self.writeFrame(frameType, text.encode(getpreferredencoding()))
+
+    def flush(self):
+        self.file.flush()
+
+    def writeFileChunks(self, path, codec):
+        # Read from disk and compress a chunk at a time, so memory use doesn't depend on the file size
+        compressor = makeCompressor(codec)
+        chunkFrame = chunkFrames[codec]
+        with open(path, "rb") as f:
+            block = f.read(copyBlockSize)
+            while block:
+                data = compressor.compress(block)
+                if data:
+                    self.writeFrame(chunkFrame, data)
+                block = f.read(copyBlockSize)
+        data = compressor.flush()
+        if data:
+            self.writeFrame(chunkFrame, data)
+
+    def writeDirectory(self, dirName, codec):
+        for path, relpath in iterDirectoryFiles(dirName):
+            self.writeText(fileFrame, relpath)
+            self.writeFileChunks(path, codec)
+            self.writeFrame(endFileFrame)
+        self.writeFrame(endDirectoryFrame)
+
+
+class FrameReader:
+    def __init__(self, file):
+        self.file = file
+
+    def readExactly(self, size):
+        data = self.file.read(size)
+        if len(data) < size:
+            raise FrameError("Connection closed in the middle of a frame")
+        return data
+
+    def readFrame(self, allowEnd=False):
+        header = self.file.read(frameHeader.size)
+        if not header and allowEnd:
+            return None, b""
+        if len(header) < frameHeader.size:
+            raise FrameError("Connection closed while waiting for a frame")
+        frameType, size = frameHeader.unpack(header)
+        return frameType, self.readExactly(size)
+
+    def readExpected(self, *frameTypes):
+        frameType, payload = self.readFrame()
+        if frameType not in frameTypes:
+            raise FrameError("Expected frame of type " + repr(frameTypes) + ", received " + repr(frameType))
+        return frameType, payload
+
+    def readText(self, frameType):
+        return str(self.readExpected(frameType)[1], getpreferredencoding())
+
+    def readDirectory(self, rootDir):
+        currFile, decompressor = None, None
+        while True:
+            frameType, payload = self.readFrame()
+            if frameType == fileFrame:
+                path = os.path.join(rootDir, str(payload, getpreferredencoding()))
+                plugins.ensureDirExistsForFile(path)
+                currFile = open(path, "wb")
+                decompressor = None
+            elif frameType in chunkFrames.values() and currFile is not None:
+                if decompressor is None:
+                    decompressor = makeDecompressor(frameType)
+                currFile.write(decompressor.decompress(payload))
+            elif frameType == endFileFrame and currFile is not None:
                 currFile.close()
                 currFile = None
+            elif frameType == endDirectoryFrame and currFile is None:
+                return
             else:
-                currFile.write(lineStr)
-        else:
-            if lineStr.startswith(fileText):
-                fn = lineStr.strip().split()[-1]
-                path = os.path.join(rootDir, fn)
-                plugins.ensureDirExistsForFile(path)
-                currFile = open(path, "w")
-            elif lineStr.startswith(endPrefix + dirText):
-                break
+                if currFile is not None:
+                    currFile.close()
+                raise FrameError("Unexpected frame of type " + repr(frameType) + " while reading files")
+
+    def skipMessage(self):
+        # Read and throw away everything up to the end of the current message
+        while self.readFrame()[0] != endMessageFrame:
+            pass
@@ -10,14 +10,17 @@ import logging
 import glob
 import functools
 import fnmatch
+import hashlib
 
 from multiprocessing import cpu_count
+from concurrent.futures import ThreadPoolExecutor
 from collections import OrderedDict
 from pickle import Pickler, Unpickler, UnpicklingError
 from threading import Lock
 from tempfile import mkstemp, mkdtemp
 from copy import deepcopy
 from functools import reduce, cmp_to_key
+from bisect import bisect_left
 from locale import getpreferredencoding
 
 helpIntro = """
@@ -27,27 +30,152 @@ http://www.texttest.org
 """
 
 
+class DirectoryIndex:
+    # Listings of test directories, kept between runs and only listed again when their modification time changes.
+    # Reading a big test tree over NFS is otherwise dominated by listing every test directory, one after the other.
+    # There is a file for each test suite root directory, holding only the directories the last run looked at
+    dirName = "directory_indexes"
+    indexes = {}
+    seen = {}
+    fileSystemTimes = {}
+    changedRoots = set()
+    lock = Lock()
+    executor = None
+    diag = logging.getLogger("Directory Index")
+
+    @classmethod
+    def getIndexFile(cls, rootDir):
+        personalDir = plugins.getPersonalConfigDir()
+        if personalDir:
+            return os.path.join(personalDir, cls.dirName, hashlib.sha1(rootDir.encode("utf-8", "surrogateescape")).hexdigest())
+
+    @classmethod
+    def getListings(cls, rootDir):
+        if rootDir not in cls.indexes:
+            cls.indexes[rootDir] = cls.load(rootDir)
+            cls.seen[rootDir] = set()
+            # Taken before we list anything, so any listing we make is at least this late
+            cls.fileSystemTimes[rootDir] = plugins.getFileSystemTime(rootDir)
+        return cls.indexes[rootDir]
+
+    @classmethod
+    def load(cls, rootDir):
+        indexFile = cls.getIndexFile(rootDir)
+        if indexFile and os.path.isfile(indexFile):
+            try:
+                with open(indexFile, "rb") as f:
+                    storedRoot, listings = Unpickler(f).load()
+                if storedRoot == rootDir:
+                    cls.diag.info("Read " + str(len(listings)) + " directory listings for " + rootDir + " from " + indexFile)
+                    return listings
+            except (OSError, EOFError, UnpicklingError, AttributeError, ValueError):
+                cls.diag.info("Could not read directory index at " + indexFile + ", ignoring it")
+        return {}
+
+    @classmethod
+    def save(cls):
+        with cls.lock:
+            for rootDir, listings in cls.indexes.items():
+                # Forget directories that have gone, or that aren't part of the tests any more
+                for dir in set(listings) - cls.seen[rootDir]:
+                    del listings[dir]
+                    cls.changedRoots.add(rootDir)
+                if rootDir in cls.changedRoots:
+                    cls.saveFile(rootDir, listings)
+            cls.changedRoots = set()
+
+    @classmethod
+    def saveFile(cls, rootDir, listings):
+        indexFile = cls.getIndexFile(rootDir)
+        if not indexFile:
+            return
+        try:
+            plugins.ensureDirectoryExists(os.path.dirname(indexFile))
+            # Write somewhere else and move it into place, other runs may be reading it
+            fd, tmpFileName = mkstemp(dir=os.path.dirname(indexFile))
+            with os.fdopen(fd, "wb") as f:
+                Pickler(f, protocol=4).dump((rootDir, listings))
+            os.replace(tmpFileName, indexFile)
+            cls.diag.info("Wrote " + str(len(listings)) + " directory listings for " + rootDir + " to " + indexFile)
+        except OSError as e:
+            cls.diag.info("Could not write directory index at " + indexFile + " : " + str(e))
+
+    @classmethod
+    def getContents(cls, dir, rootDir):
+        with cls.lock:
+            listings = cls.getListings(rootDir)
+            cls.seen[rootDir].add(dir)
+            mtime, contents = listings.get(dir, (None, None))
+            fileSystemTime = cls.fileSystemTimes[rootDir]
+        try:
+            currMtime = os.stat(dir).st_mtime_ns
+        except OSError:  # usually caused by people removing stuff externally
+            return []
+        if currMtime == mtime:
+            return contents
+
+        try:
+            contents = sorted(entry.name for entry in os.scandir(dir))
+        except OSError:
+            return []
+        with cls.lock:
+            # Don't keep the listing if the directory changed so recently that it could change again, even while
+            # we were listing it, without its modification time changing
+            if not plugins.isRecentlyModified(currMtime, fileSystemTime):
+                listings[dir] = currMtime, contents
+            else:
+                listings.pop(dir, None)
+            cls.changedRoots.add(rootDir)
+        return contents
+
+    @classmethod
+    def getExecutor(cls):
+        with cls.lock:
+            if cls.executor is None:
+                cls.executor = ThreadPoolExecutor(max_workers=min(32, cpu_count() * 4))
+            return cls.executor
+
+    @classmethod
+    def prefetch(cls, dirs, rootDir):
+        # Check or list lots of directories at once, as the time goes on waiting for the file system
+        if len(dirs) > 1:
+            return dict(zip(dirs, cls.getExecutor().map(cls.getContents, dirs, [rootDir] * len(dirs))))
+        else:
+            return {dir: cls.getContents(dir, rootDir) for dir in dirs}
+
+
 class DirectoryCache:
-    def __init__(self, dir):
+    def __init__(self, dir, contents=None):
         self.dir = dir
         self.contents = []
-        self.refresh()
+        if contents is None:
+            self.refresh()
+        else:
+            self.setContents(contents)
 
     def refresh(self):
         try:
-            self.contents = os.listdir(self.dir)
-            self.contents.sort()
+            contents = os.listdir(self.dir)
+            contents.sort()
         except OSError:  # usually caused by people removing stuff externally
-            self.contents = []
+            contents = []
+        self.setContents(contents)
+
+    def setContents(self, contents):
+        # Everything below is worked out from the (sorted) contents when first asked for, and kept until the next refresh
+        self.contents = contents
+        self.contentSet = frozenset(contents)
+        self.splitContents = None
+        self.stemVersionSets = {}
+        self.subDirCaches = {}
 
     def hasStem(self, stem):
-        for fileName in self.contents:
-            if fileName.startswith(stem):
-                return True
-        return False
+        # The contents are sorted, so anything starting with the stem comes straight after where it would be inserted
+        index = bisect_left(self.contents, stem)
+        return index < len(self.contents) and self.contents[index].startswith(stem)
 
     def exists(self, fileName):
-        return fileName in self.contents
+        return fileName in self.contentSet
 
     def pathName(self, fileName):
         return os.path.join(self.dir, fileName)
@@ -71,26 +199,46 @@ class DirectoryCache:
         stem = os.path.normpath(stem)
         if os.sep in stem:
             root, local = os.path.split(stem)
-            newCache = DirectoryCache(os.path.join(self.dir, root))
-            return newCache.findVersionSets(local, predicate)
+            return self.getSubDirCache(root).findVersionSets(local, predicate)
 
         versionSets = OrderedDict()
-        for fileName in self.contents:
-            versionSet = self.findVersionSet(fileName, stem)
-            if versionSet is not None and (predicate is None or predicate(versionSet)):
+        for versionSet, fileName in self.getStemVersionSets(stem):
+            if predicate is None or predicate(versionSet):
                 versionSets.setdefault(versionSet, []).append(self.pathName(fileName))
         return versionSets
 
+    def getStemVersionSets(self, stem):
+        versionSets = self.stemVersionSets.get(stem)
+        if versionSets is None:
+            versionSets = []
+            for index in range(bisect_left(self.contents, stem), len(self.contents)):
+                fileName = self.contents[index]
+                if not fileName.startswith(stem):
+                    break
+                versionSet = self.findVersionSet(fileName, stem)
+                if versionSet is not None:
+                    versionSets.append((versionSet, fileName))
+            self.stemVersionSets[stem] = versionSets
+        return versionSets
+
+    def getSubDirCache(self, subDir):
+        cache = self.subDirCaches.get(subDir)
+        if cache is None:
+            cache = DirectoryCache(os.path.join(self.dir, subDir))
+            self.subDirCaches[subDir] = cache
+        return cache
+
     def findStemsMatching(self, pattern):
         return self.findAllStems(lambda stem, vset: fnmatch.fnmatch(stem, pattern))
 
     def findAllStems(self, predicate=None):
-        stems = []
-        for file in self.contents:
-            stem, versionSet = self.splitStem(file)
+        if self.splitContents is None:
+            self.splitContents = [self.splitStem(file) for file in self.contents]
+        stems = OrderedDict()
+        for stem, versionSet in self.splitContents:
             if len(stem) > 0 and stem not in stems and (predicate is None or predicate(stem, versionSet)):
-                stems.append(stem)
-        return stems
+                stems[stem] = True
+        return list(stems.keys())
 
 
 class DynamicMapping:
@@ -164,44 +312,130 @@ class TestEnvironment(OrderedDict):
         self.diag.info("Single: got " + var + " = " + repr(value))
         return value
 
-    def getSelfReference(self, var, originalVar, expandExternal):
-        if var == originalVar:
-            return self._getSingleValue(var, expandExternal=expandExternal)
-
-    def getSingleValueNoSelfRef(self, var, originalVar, expandExternal):
-        if var != originalVar:
-            return self._getSingleValue(var, expandExternal=expandExternal)
-
-    def storeVariables(self, vars, expandExternal=True):
+    def storeVariables(self, vars, expandExternal=True, base=None):
+        if len(self) > 0:
+            # Values set directly before we were populated, they come first so the base can't be used
+            vars = (base.vars if base else []) + vars
+            base = EnvironmentLayer(list(self.items()), expandExternal)
+        layer = EnvironmentLayer(vars, expandExternal, base)
+        for var, value in layer.values.items():
+            self.diag.info("Storing " + var + " = " + repr(value))
+            self[var] = value
+
+
+class EnvironmentLayer:
+    # The environment resulting from a list of variable settings, applied in order on top of an (optional) base layer.
+    # Expands each variable once, after the variables it refers to, so that tests with the same environment files
+    # can share the work done for them and only redo what their own settings affect.
+    cycleWarnings = set()
+
+    def __init__(self, vars, expandExternal=True, base=None):
+        self.expandExternal = expandExternal
+        self.vars = (base.vars if base else []) + list(vars)
+        self.diag = logging.getLogger("read environment")
+        self.rawValues = OrderedDict(base.rawValues) if base else OrderedDict()
+        changed = set()
         for var, valueOrMethod in vars:
-            newValue = self.expandSelfReferences(var, valueOrMethod, expandExternal)
+            newValue = self.expandSelfReferences(var, valueOrMethod)
             if newValue is not None:
-                self.diag.info("Storing " + var + " = " + repr(newValue))
-                self[var] = newValue
+                self.rawValues[var] = newValue
+                changed.add(var)
+
+        self.references = {}
+        self.dependents = None
+        self.values = OrderedDict()
+        toExpand = self.findAffected(base, changed) if base else self.rawValues
+        for var in self.rawValues:
+            if var in toExpand:
+                self.expand(var, [])
+            else:
+                self.values[var] = base.values[var]
+                self.references[var] = base.references[var]
 
-        while self.expandVariables(expandExternal):
-            pass
+    def getSingleValue(self, var, defaultValue=None):
+        if var in self.rawValues:
+            return self.rawValues[var]
+        # We create expansions of PATH externally, make sure we expand them if needed
+        return os.getenv(var, defaultValue) if self.expandExternal or var == "PATH" else defaultValue
 
-    def expandSelfReferences(self, var, valueOrMethod, expandExternal):
+    def expandSelfReferences(self, var, valueOrMethod):
         if type(valueOrMethod) in (str, bytes):
-            mapping = DynamicMapping(self.getSelfReference, var, expandExternal)
+            if "$" not in valueOrMethod:
+                return valueOrMethod
             self.diag.info("Expanding self references for " + repr(var) + " in " + repr(valueOrMethod))
+            mapping = DynamicMapping(self.getSelfReference, var)
             return string.Template(valueOrMethod).safe_substitute(mapping)
         else:
-            return valueOrMethod(var, self._getSingleValue(var, ""))
-
-    def expandVariables(self, expandExternal):
-        expanded = False
-        for var, value in self.items():
-            if "$" in value:
-                self.diag.info("Expanding " + var + "...")
-            mapping = DynamicMapping(self.getSingleValueNoSelfRef, var, expandExternal)
+            return valueOrMethod(var, self.getSingleValue(var, ""))
+
+    def getSelfReference(self, var, originalVar):
+        if var == originalVar:
+            return self.getSingleValue(var)
+
+    @staticmethod
+    def findReferences(value):
+        references = set()
+        if "$" in value:
+            for match in string.Template.pattern.finditer(value):
+                name = match.group("named") or match.group("braced")
+                if name:
+                    references.add(name)
+        return references
+
+    def findAffected(self, base, changed):
+        # Everything set here, and everything in the base that refers to it, directly or indirectly
+        dependents = base.getDependents()
+        affected = set()
+        toCheck = list(changed)
+        while toCheck:
+            var = toCheck.pop()
+            if var not in affected:
+                affected.add(var)
+                toCheck += dependents.get(var, [])
+        return affected
+
+    def getDependents(self):
+        if self.dependents is None:
+            self.dependents = {}
+            for var, references in self.references.items():
+                for reference in references:
+                    self.dependents.setdefault(reference, []).append(var)
+        return self.dependents
+
+    def expand(self, var, varsBeingExpanded):
+        if var in self.values:
+            return self.values[var]
+        value = self.rawValues[var]
+        references = self.findReferences(value)
+        self.references[var] = references
+        if references:
+            varsBeingExpanded.append(var)
+            mapping = DynamicMapping(self.getExpandedReference, var, varsBeingExpanded)
             newValue = string.Template(value).safe_substitute(mapping)
+            varsBeingExpanded.pop()
             if newValue != value:
-                expanded = True
                 self.diag.info("Expanded " + var + " = " + newValue)
-                self[var] = newValue
-        return expanded
+                value = newValue
+        self.values[var] = value
+        return value
+
+    def getExpandedReference(self, var, originalVar, varsBeingExpanded):
+        if var == originalVar:
+            return
+        if var not in self.rawValues:
+            return self.getSingleValue(var)
+        if var in varsBeingExpanded:
+            cycle = varsBeingExpanded[varsBeingExpanded.index(var):] + [var]
+            self.warnCycle(cycle)
+            return
+        return self.expand(var, varsBeingExpanded)
+
+    def warnCycle(self, cycle):
+        cycleText = " -> ".join(cycle)
+        if cycleText not in self.cycleWarnings:
+            self.cycleWarnings.add(cycleText)
+            plugins.printWarning("Environment variables refer to each other in a cycle (" + cycleText +
+                                 "), leaving the reference to " + cycle[-1] + " unexpanded.")
 
 
 # Base class for TestCase and TestSuite
@@ -216,9 +450,10 @@ class Test(plugins.Observable):
         self.app = app
         self.parent = parent
         self.dircache = dircache
-        self.configDir = None
+        # Local configuration is read on demand: most tests don't have any, and many are filtered away anyway
+        self.localConfigDir = None
+        self.configLoaded = False
         self.diag = logging.getLogger("test objects")
-        self.reloadConfiguration()
         populateFunction = plugins.Callable(app.setEnvironment, self)
         self.environment = TestEnvironment(populateFunction)
         # Java equivalent of the environment mechanism...
@@ -240,13 +475,23 @@ class Test(plugins.Observable):
     def hasLocalConfig(self):
         return self.parent is not None and self.dircache.hasStem("config." + self.app.name)
 
+    @property
+    def configDir(self):
+        self.loadConfiguration()
+        return self.localConfigDir
+
+    def loadConfiguration(self):
+        if not self.configLoaded:
+            self.reloadConfiguration()
+
     def reloadConfiguration(self):
+        self.configLoaded = True
         if self.hasLocalConfig():
             parentConfigDir = self.getParentConfigDir()
             newConfigDir = deepcopy(parentConfigDir)
             self.app.readValues(newConfigDir, "config", [self.dircache], insert=False, errorOnUnknown=True)
-            self.configDir = newConfigDir
-            self.diagnose("config file settings are: " + "\n" + repr(self.configDir))
+            self.localConfigDir = newConfigDir
+            self.diagnose("config file settings are: " + "\n" + repr(self.localConfigDir))
 
     def getConfigFileDefining(self, versionApp, sectionName, key, value):
         configDir = self.configDir or self.getParentConfigDir()
@@ -299,8 +544,10 @@ class Test(plugins.Observable):
     def classDescription(self):
         return self.classId().replace("-", " ")
 
-    def diagnose(self, message):
-        self.diag.info("In test " + self.uniqueName + " : " + message)
+    def diagnose(self, message, *args):
+        # Any arguments are only formatted into the message if the diagnostics are actually being written
+        if self.diag.isEnabledFor(logging.INFO):
+            self.diag.info("In test " + self.uniqueName + " : " + (message % args if args else message))
 
     def setUniqueName(self, newName):
         if newName != self.uniqueName:
@@ -339,6 +586,9 @@ class Test(plugins.Observable):
     def makeBackupFileName(self, number):
         pass
 
+    def getBackupCount(self):
+        return 0
+
     def isDefinitionFileStem(self, stem):
         return self.app.fileMatches(stem, self.defFileStems())
 
@@ -358,16 +608,16 @@ class Test(plugins.Observable):
         return stems
 
     def listApprovedFiles(self, allVersions, defFileCategory="all"):
-        self.diagnose("Looking for standard files, definition files in category " + repr(defFileCategory))
+        self.diagnose("Looking for standard files, definition files in category %r", defFileCategory)
         defFileStems = self.expandedDefFileStems(defFileCategory)
         defFiles = self.getFilesFromStems(defFileStems, allVersions)
         resultFiles = self.listResultFiles(allVersions)
-        self.diagnose("Found " + repr(resultFiles) + " and " + repr(defFiles))
+        self.diagnose("Found %r and %r", resultFiles, defFiles)
         return resultFiles, defFiles
 
     def listResultFiles(self, allVersions):
         exclude = self.expandedDefFileStems() + self.getDataFileNames() + ["file_edits"]
-        self.diagnose("Excluding " + repr(exclude))
+        self.diagnose("Excluding %r", exclude)
 
         def predicate(stem, vset): return stem not in exclude and self.app.name in vset
         stems = self.dircache.findAllStems(predicate)
@@ -391,7 +641,7 @@ class Test(plugins.Observable):
         return files
 
     def listStdFilesWithStem(self, stem, allVersions):
-        self.diagnose("Getting files for stem " + stem)
+        self.diagnose("Getting files for stem %s", stem)
         files = []
         if allVersions:
             files += self.findAllStdFiles(stem)
@@ -403,13 +653,13 @@ class Test(plugins.Observable):
 
     def getDataFilesWithName(self, dataFileName):
         existingDataFiles = []
-        self.diagnose("Searching for data files called " + dataFileName)
+        self.diagnose("Searching for data files called %s", dataFileName)
         for fileName in self.dircache.findAllFiles(dataFileName):
             dataFiles, _ = self.listFiles(fileName, dataFileName, followLinks=True)
             for fullPath in dataFiles:
                 if not fullPath in existingDataFiles:
                     existingDataFiles.append(fullPath)
-        self.diagnose("Found data files as " + repr(existingDataFiles))
+        self.diagnose("Found data files as %r", existingDataFiles)
         return existingDataFiles
 
     def listDataFiles(self):
@@ -433,8 +683,8 @@ class Test(plugins.Observable):
                             if inherited not in suiteInherited:
                                 suiteInherited.append(inherited)
                         break
-        self.diagnose("Local data files = " + repr(dataFiles))
-        self.diagnose("Inherited data files = " + repr(inheritedDataFiles))
+        self.diagnose("Local data files = %r", dataFiles)
+        self.diagnose("Inherited data files = %r", inheritedDataFiles)
         return dataFiles, inheritedDataFiles
 
     def listFiles(self, fileName, dataFile, followLinks):
@@ -459,7 +709,7 @@ class Test(plugins.Observable):
         dataFiles = []
         ignoredFiles = []
         dirs = []
-        self.diag.info("Listing files from " + repr(files) + ", ignoring " + repr(filesToIgnore))
+        self.diag.info("Listing files from %r, ignoring %r", files, filesToIgnore)
         for file in files:
             if self.app.fileMatches(os.path.basename(file), filesToIgnore):
                 ignoredFiles.append(file)
@@ -510,16 +760,16 @@ class Test(plugins.Observable):
             return self.app
 
     def getFileName(self, stem, refVersion=None):
-        self.diagnose("Getting file from " + stem)
+        self.diagnose("Getting file from %s", stem)
         return self.getAppForVersion(refVersion).getFileNameFromCaches([self.dircache], stem)
 
     def getPathName(self, stem, configName=None, refVersion=None):
-        self.diagnose("Getting path name from " + stem)
+        self.diagnose("Getting path name from %s", stem)
         app = self.getAppForVersion(refVersion)
         return self.pathNameMethod(stem, configName, app.getFileNameFromCaches)
 
     def getAllPathNames(self, stem, configName=None, refVersion=None):
-        self.diagnose("Getting all path names from " + stem)
+        self.diagnose("Getting all path names from %s", stem)
         app = self.getAppForVersion(refVersion)
         return self.pathNameMethod(stem, configName, app.getAllFileNames)
 
@@ -527,7 +777,8 @@ class Test(plugins.Observable):
         if configName is None:
             configName = stem
         dirCaches = self.getDirCachesToRoot(configName)
-        self.diagnose("Directories to be searched: " + repr([d.dir for d in dirCaches]))
+        if self.diag.isEnabledFor(logging.INFO):
+            self.diagnose("Directories to be searched: %r", [d.dir for d in dirCaches])
         return method(dirCaches, stem)
 
     def getAllTestsToRoot(self):
@@ -547,7 +798,7 @@ class Test(plugins.Observable):
         return self.app.getAllDirCaches(configName, fromTests, envMapping=self.environment)
 
     def getAllFileNames(self, stem, refVersion=None):
-        self.diagnose("Getting file from " + stem)
+        self.diagnose("Getting file from %s", stem)
         appToUse = self.app
         if refVersion:
             appToUse = self.app.getRefVersionApplication(refVersion)
@@ -556,20 +807,21 @@ class Test(plugins.Observable):
     def getConfigValue(self, key, expandVars=True, envMapping=None):
         if envMapping is None:
             envMapping = self.environment
-        if self.configDir:
-            return self.configDir.getSingle(key, expandVars, envMapping)
-        else:
-            confObj = self.parent or self.app
-            return confObj.getConfigValue(key, expandVars, envMapping)
+        return self.findConfigDir().getSingle(key, expandVars, envMapping)
 
     def getCompositeConfigValue(self, key, subKey, expandVars=True, envMapping=None):
         if envMapping is None:
             envMapping = self.environment
-        if self.configDir:
-            return self.configDir.getComposite(key, subKey, expandVars, envMapping)
-        else:
-            confObj = self.parent or self.app
-            return confObj.getCompositeConfigValue(key, subKey, expandVars, envMapping)
+        return self.findConfigDir().getComposite(key, subKey, expandVars, envMapping)
+
+    def findConfigDir(self):
+        # Nearest local configuration, going upwards to the root suite, otherwise the application's
+        test = self
+        while test is not None:
+            if test.configDir:
+                return test.configDir
+            test = test.parent
+        return self.app.configDir
 
     def configValueMatches(self, key, filePattern):
         for currPattern in self.getConfigValue(key):
@@ -658,9 +910,9 @@ class Test(plugins.Observable):
 
     def isAcceptedByAll(self, filters, checkContents=True):
         for filter in filters:
-            self.notifyIfMainThread("ActionProgress")
+            self.notifyProgressIfMainThread()
             if not self.isAcceptedBy(filter, checkContents):
-                self.diagnose("Rejected due to " + repr(filter))
+                self.diagnose("Rejected due to %r", filter)
                 return False
         return True
 
@@ -683,12 +935,12 @@ class Test(plugins.Observable):
 
     def findCommonAncestor(self, other):
         if self.hasAncestor(other):
-            self.diagnose("Have ancestor " + other.uniqueName)
+            self.diagnose("Have ancestor %s", other.uniqueName)
             return other
         elif other.parent:
             return self.findCommonAncestor(other.parent)
         else:
-            self.diagnose("Unrelated to " + other.uniqueName)
+            self.diagnose("Unrelated to %s", other.uniqueName)
 
     def hasAncestor(self, other):
         if self is other:
@@ -701,14 +953,14 @@ class Test(plugins.Observable):
     def changeState(self, state):
         isCompletion = not self.state.isComplete() and state.isComplete()
         self.state = state
-        self.diagnose("Change notified to state " + state.category)
+        self.diagnose("Change notified to state %s", state.category)
         if state and state.lifecycleChange:
             self.sendStateNotify(isCompletion)
 
     def sendStateNotify(self, isCompletion):
         notifyMethod = self.getNotifyMethod(isCompletion)
         notifyMethod("LifecycleChange", self.state, self.state.lifecycleChange)
-        self.diagnose("Send state notify with lifecycle change " + self.state.lifecycleChange)
+        self.diagnose("Send state notify with lifecycle change %s", self.state.lifecycleChange)
         if self.state.lifecycleChange == "complete":
             notifyMethod("Complete")
 
@@ -877,18 +1129,31 @@ class TestCase(Test):
         # We allow one non-option after the last one in case it's an argument
         return min(lastOptionIndex + 2, len(optionArgs))
 
-    def listUnownedTmpPaths(self):
-        paths, ignoredPaths = [], []
-        filelist = os.listdir(self.localWriteDirectory)
-        filelist.sort()
-        for file in filelist:
-            if file in ["framework_tmp", "file_edits", "traffic_intercepts"] or file.endswith("." + self.app.name):
+    def scanUnownedTmpPaths(self):
+        # As listFiles does for each path, but keeping the os.scandir entries so their stat information can be reused
+        entries, ignoredPaths = [], []
+        for entry in self.scanDirectory(self.localWriteDirectory):
+            if entry.name in ["framework_tmp", "file_edits", "traffic_intercepts"] or entry.name.endswith("." + self.app.name):
                 continue
-            fullPath = os.path.join(self.localWriteDirectory, file)
-            newPaths, newIgnoredPaths = self.listFiles(fullPath, file, followLinks=False)
-            paths += newPaths
-            ignoredPaths += newIgnoredPaths
-        return paths, ignoredPaths
+            filesToIgnore = self.getCompositeConfigValue("test_data_ignore", entry.name)
+            self.scanEntriesFrom([entry], filesToIgnore, entries, ignoredPaths)
+        return entries, ignoredPaths
+
+    def scanDirectory(self, dir):
+        return sorted(os.scandir(dir), key=lambda entry: entry.name)
+
+    def scanEntriesFrom(self, dirEntries, filesToIgnore, entries, ignoredPaths):
+        dirs = []
+        for entry in dirEntries:
+            if self.app.fileMatches(entry.name, filesToIgnore):
+                ignoredPaths.append(entry.path)
+            elif entry.is_dir(follow_symlinks=False):
+                dirs.append(entry)
+            else:
+                entries.append(entry)
+        for entry in dirs:
+            entries.append(entry)
+            self.scanEntriesFrom(self.scanDirectory(entry.path), filesToIgnore, entries, ignoredPaths)
 
     def makeTmpFileName(self, stem, forComparison=True, forFramework=False):
         local = not forComparison and not forFramework
@@ -911,46 +1176,74 @@ class TestCase(Test):
         return False
 
     def restoreLatestBackup(self):
-        newPath = self.backupPreviousTemporaryData(restoreLatest=True)
-        os.rename(newPath, os.path.join(os.path.dirname(newPath), "backup.aborted"))
+        backupCount = self.getBackupCount()
+        latestBackup = self.makeBackupFileName(backupCount)
+        if not os.path.isdir(latestBackup):
+            return
+        abortedPath = os.path.join(self.getBackupDirectory(), "backup.aborted")
+        plugins.removeInBackground(abortedPath)
+        os.rename(self.getDirectory(temporary=1), abortedPath)
+        os.rename(latestBackup, self.getDirectory(temporary=1))
+        self.writeBackupCount(backupCount - 1)
         stateFile = self.getStateFile()
         if os.path.isfile(stateFile):
-            return plugins.getNewTestStateFromFile(open(stateFile))
-
-    def backupPreviousTemporaryData(self, restoreLatest=False):
-        writeDir = self.getDirectory(temporary=1)
-        newBackupPath, oldBackupPaths = self.findBackupPaths()
-        localTmpDir = mkdtemp(dir=os.path.dirname(writeDir), prefix=os.path.basename(newBackupPath) + ".")
-        if os.name == "nt":
-            # Windows doesn't manage to overwrite empty directories. Linux does.
-            os.rmdir(localTmpDir)
-        os.rename(writeDir, localTmpDir)
-        if not restoreLatest:
-            self.makeWriteDirectory()
-        for oldBackupPath in reversed(oldBackupPaths):
-            currLocation = os.path.join(localTmpDir, plugins.relpath(oldBackupPath, writeDir))
-            currDest = writeDir if not os.path.exists(writeDir) else oldBackupPath
-            os.rename(currLocation, currDest)
-        os.rename(localTmpDir, newBackupPath)
+            with open(stateFile, "rb") as f:
+                return plugins.getNewTestStateFromFile(f)
+
+    def backupPreviousTemporaryData(self):
+        # Each earlier run is a generation in the backup directory, so moving the sandbox there is all it takes
+        backupCount = self.getBackupCount() + 1
+        newBackupPath = self.makeBackupFileName(backupCount)
+        plugins.ensureDirectoryExists(self.getBackupDirectory())
+        os.rename(self.getDirectory(temporary=1), newBackupPath)
+        self.writeBackupCount(backupCount)
+        self.makeWriteDirectory()
+        self.trimBackups(backupCount)
         localWriteDir = self.getDirectory(temporary=1, local=1)
-        if localWriteDir != writeDir:
-            plugins.rmtree(localWriteDir)
+        if localWriteDir != self.getDirectory(temporary=1):
+            # Nothing needs to wait for the old data to disappear
+            plugins.removeInBackground(localWriteDir)
             plugins.ensureDirectoryExists(localWriteDir)
         return newBackupPath
 
-    def findBackupPaths(self):
-        number = 1
-        oldPaths = []
-        while True:
-            path = self.makeBackupFileName(number)
-            if os.path.exists(path):
-                oldPaths.append(path)
-                number += 1
-            else:
-                return path, oldPaths
+    def trimBackups(self, backupCount):
+        # Only the latest generations are kept, if so configured. They still count as reruns when they've gone
+        maxBackups = self.getConfigValue("max_sandbox_backups")
+        if maxBackups > 0:
+            for number in range(backupCount - maxBackups, 0, -1):
+                backupPath = self.makeBackupFileName(number)
+                if not os.path.isdir(backupPath):
+                    break
+                plugins.removeInBackground(backupPath)
+
+    def getBackupDirectory(self):
+        # Beside the sandbox rather than in it, so that backing it up is a single rename
+        return self.getDirectory(temporary=1) + ".backups"
+
+    def getBackupCountFile(self):
+        return os.path.join(self.getBackupDirectory(), "backup.count")
+
+    def getBackupCount(self):
+        # How many times the sandbox has been backed up, which is also how often the test has been rerun.
+        # It's a file as they may also be made by other processes, e.g. slaves on the grid, and old ones may have been removed
+        try:
+            with open(self.getBackupCountFile()) as f:
+                return int(f.read())
+        except (OSError, ValueError):
+            return 0
+
+    def writeBackupCount(self, backupCount):
+        # Write somewhere else and move it into place, others may be reading it
+        fd, tmpFileName = mkstemp(dir=self.getBackupDirectory())
+        with os.fdopen(fd, "w") as f:
+            f.write(str(backupCount))
+        os.replace(tmpFileName, self.getBackupCountFile())
+
+    def hasBackup(self, number):
+        return 0 < number <= self.getBackupCount()
 
     def makeBackupFileName(self, number):
-        return self.makeTmpFileName("backup.previous." + str(number), forFramework=1)
+        return os.path.join(self.getBackupDirectory(), "backup.previous." + str(number))
 
     def getNewState(self, file, **updateArgs):
         try:
@@ -967,14 +1260,13 @@ class TestCase(Test):
         stateFile = self.getStateFile()
         if os.path.isfile(stateFile):
             # Debug info, trying to find out why it doesn't get saved sometimes
-            if os.path.exists(self.makeBackupFileName(1)):
+            if self.hasBackup(1):
                 plugins.printWarning("File already exists at " + stateFile + " - while saving state. Not overwriting!")
             # Don't overwrite previous saved state
             return
 
         file = plugins.openForWrite(stateFile, "wb")
-        pickler = Pickler(file, protocol=2)
-        pickler.dump(self.state)
+        plugins.writeTestState(file, self.state)
         file.close()
 
     def isAcceptedBy(self, filter, *args):
@@ -991,21 +1283,60 @@ class TestCase(Test):
 
 # class for caching and managing changes to test suite files
 class TestSuiteFileHandler:
+    # Parsed test suite files are kept until the file changes on disk. Edits are written straight away,
+    # unless writes are being held (as the GUI does while performing an action), when they are written by flush()
     def __init__(self):
         self.cache = {}
+        self.prefetched = {}
+        self.unwritten = []
+        self.writesHeld = False
+
+    def getSignature(self, fileName):
+        try:
+            stat = os.stat(fileName)
+            return stat.st_mtime_ns, stat.st_size
+        except OSError:
+            pass
+
+    def prefetch(self, fileNames):
+        # Read lots of suite files at once, as the time goes on waiting for the file system
+        fileNames = [fileName for fileName in fileNames if fileName not in self.cache]
+        if len(fileNames) > 1:
+            for fileName, data in zip(fileNames, DirectoryIndex.getExecutor().map(self.readLines, fileNames)):
+                if data:
+                    self.prefetched[fileName] = data
+
+    def discardPrefetched(self, fileNames):
+        for fileName in fileNames:
+            self.prefetched.pop(fileName, None)
+
+    def readLines(self, fileName):
+        signature = self.getSignature(fileName)
+        try:
+            with open(fileName, encoding=getpreferredencoding(), errors="replace") as f:
+                return signature, f.readlines()
+        except OSError:
+            pass
 
     def readWithWarnings(self, fileName, ignoreCache=False, filterMethod=None):
         items, badTests = self.readFromFileOrCache(fileName, ignoreCache, filterMethod)
         goodTests = self.getTestWithDescriptions(items)
-        self.cache[fileName] = items
         return goodTests, badTests
 
     def readFromFileOrCache(self, fileName, ignoreCache=False, filterMethod=None):
+        if fileName in self.unwritten:
+            return self.cache[fileName][1], OrderedDict()
+        signature = self.getSignature(fileName)
         if not ignoreCache:
-            cached = self.cache.get(fileName)
-            if cached is not None:
+            cachedSignature, cached = self.cache.get(fileName, (None, None))
+            if cached is not None and cachedSignature == signature:
                 return cached, OrderedDict()
-        return plugins.readListWithComments(fileName, plugins.Callable(self.getExclusionReasons, filterMethod))
+        prefetchedSignature, lines = self.prefetched.pop(fileName, (None, None))
+        if prefetchedSignature != signature:
+            lines = None
+        items, badTests = plugins.readListWithComments(fileName, plugins.Callable(self.getExclusionReasons, filterMethod), lines)
+        self.cache[fileName] = signature, items
+        return items, badTests
 
     def getTestWithDescriptions(self, tests):
         onlyTest = OrderedDict()
@@ -1018,9 +1349,7 @@ class TestSuiteFileHandler:
         return self.readWithWarnings(*args, **kw)[0]
 
     def readWithComments(self, fileName, *args, **kw):
-        items, _ = self.readFromFileOrCache(fileName, *args, **kw)
-        self.cache[fileName] = items
-        return items
+        return self.readFromFileOrCache(fileName, *args, **kw)[0]
 
     def getExclusionReasons(self, testName, existingTestNames, fileName, filterMethod):
         if testName in existingTestNames:
@@ -1040,6 +1369,24 @@ class TestSuiteFileHandler:
         newFile = plugins.openForWrite(fileName)
         newFile.write(output.lstrip())
         newFile.close()
+        self.cache[fileName] = self.getSignature(fileName), content
+
+    def update(self, fileName, content):
+        if self.writesHeld:
+            self.cache[fileName] = None, content
+            if fileName not in self.unwritten:
+                self.unwritten.append(fileName)
+        else:
+            self.write(fileName, content)
+
+    def holdWrites(self):
+        self.writesHeld = True
+
+    def flush(self):
+        self.writesHeld = False
+        for fileName in self.unwritten:
+            self.write(fileName, self.cache[fileName][1])
+        self.unwritten = []
 
     def makeWriteEntries(self, content):
         entries = []
@@ -1065,9 +1412,7 @@ class TestSuiteFileHandler:
         cacheList = list(cache.items())
         position = self.getInsertPosition(cache, index) if mapIndex else index
         cacheList.insert(position, (testName, description))
-        newCache = OrderedDict(cacheList)
-        self.cache[fileName] = newCache
-        self.write(fileName, newCache)
+        self.update(fileName, OrderedDict(cacheList))
 
     def getInsertPosition(self, cache, position):
         testList = list(self.getTestWithDescriptions(cache).items())
@@ -1086,7 +1431,7 @@ class TestSuiteFileHandler:
         cache = self.readWithComments(fileName)
         description = self.removeFromCache(cache, testName)[0]
         if description is not None:
-            self.write(fileName, cache)
+            self.update(fileName, cache)
 
     def removeFromCache(self, cache, testName):
         description = cache.get(testName)
@@ -1117,12 +1462,10 @@ class TestSuiteFileHandler:
     def sort(self, fileName, comparator):
         tests = self.read(fileName)
         comments = self.getCommentsWithPositions(fileName)
-        newList = [(testName, tests[testName]) for testName in sorted(list(tests.keys()), comparator)]
+        newList = [(testName, tests[testName]) for testName in sorted(list(tests.keys()), key=cmp_to_key(comparator))]
         for index, key, comment in comments:
             newList.insert(index, (key, comment))
-        newDict = OrderedDict(newList)
-        self.cache[fileName] = newDict
-        self.write(fileName, newDict)
+        self.update(fileName, OrderedDict(newList))
 
     def getCommentsWithPositions(self, fileName):
         cache = list(self.readWithComments(fileName).items())
@@ -1318,44 +1661,74 @@ class TestSuite(Test):
             return sorted(testNames, key=cmp_to_key(lambda a, b: self.compareTests(False, testCaseNames, a, b)))
 
     def createTestCases(self, filters, testNames, initial, guideSuite=None):
-        testCaches = {}
+        testCaches = self.createTestCaches(list(testNames.keys()))
+        prefetchedFiles = [] if guideSuite else self.prefetchTestSuiteFiles(list(testCaches.values()))
         testCaseNames = []
         if self.autoSortOrder:
-            for testName in list(testNames.keys()):
-                dircache = self.createTestCache(testName)
-                testCaches[testName] = dircache
+            for testName, dircache in list(testCaches.items()):
                 if not dircache.hasStem("testsuite"):
                     testCaseNames.append(testName)
 
         for testNameOrPath in self.getOrderedTestNames(list(testNames.keys()), testCaseNames):
             testName = os.path.basename(testNameOrPath)
-            dirCache = testCaches.get(testName, self.createTestCache(testNameOrPath))
+            dirCache = testCaches[testNameOrPath]
             desc = testNames.get(testNameOrPath)
             self.createTestOrSuite(testName, desc, dirCache, filters, initial, guideSuite)
+        # Anything not read by now is for other versions, or for suites the filters didn't select
+        self.testSuiteFileHandler.discardPrefetched(prefetchedFiles)
 
     def createTestOrSuite(self, testName, description, dirCache, filters, initial=True, guideSuite=None):
         className = self.getSubtestClass(dirCache)
-        subTest = self.createSubtest(testName, description, dirCache, className)
-        if subTest and subTest.isAcceptedByAll(filters, checkContents=False):
+        subTest = self.createSubtest(testName, description, dirCache, className, deferConfig=True)
+        if subTest and self.acceptsSubtest(subTest, filters):
             guideSubTest = guideSuite.findSubtest(testName) if guideSuite else None
             if subTest.readContents(filters, initial, guideSubTest):
                 self.testcases.append(subTest)
                 subTest.notify("Add", initial)
 
+    def acceptsSubtest(self, subTest, filters):
+        # Only read the test's own configuration if the filters need it or select the test
+        try:
+            if subTest.isAcceptedByAll(filters, checkContents=False):
+                subTest.loadConfiguration()
+                return True
+        except BadConfigError as e:
+            self.writeConfigError(subTest.name, e)
+        return False
+
+    def createTestCaches(self, testNames):
+        dirs = [os.path.join(self.getDirectory(), testName) for testName in testNames]
+        allContents = DirectoryIndex.prefetch(dirs, self.app.getDirectory())
+        return OrderedDict((testName, DirectoryCache(dir, allContents[dir])) for testName, dir in zip(testNames, dirs))
+
+    def prefetchTestSuiteFiles(self, testCaches):
+        prefix = "testsuite." + self.app.name
+        fileNames = []
+        for cache in testCaches:
+            fileNames += [cache.pathName(f) for f in cache.contents if f.startswith(prefix)]
+        self.testSuiteFileHandler.prefetch(fileNames)
+        return fileNames
+
     def createTestCache(self, testName):
-        return DirectoryCache(os.path.join(self.getDirectory(), testName))
+        dir = os.path.join(self.getDirectory(), testName)
+        return DirectoryCache(dir, DirectoryIndex.getContents(dir, self.app.getDirectory()))
 
     def getSubtestClass(self, cache):
         return TestSuite if cache.hasStem("testsuite." + self.app.name) else TestCase
 
-    def createSubtest(self, testName, description, cache, className):
+    def createSubtest(self, testName, description, cache, className, deferConfig=False):
         try:
             test = className(testName, description, cache, self.app, self)
+            if not deferConfig:
+                test.loadConfiguration()
             test.setObservers(self.observers)
             return test
         except BadConfigError as e:
-            sys.stderr.write("ERROR: Could not create test '" + testName +
-                             "', problems with configuration:\n" + str(e) + "\n")
+            self.writeConfigError(testName, e)
+
+    def writeConfigError(self, testName, e):
+        sys.stderr.write("ERROR: Could not create test '" + testName +
+                         "', problems with configuration:\n" + str(e) + "\n")
 
     def addTestCase(self, *args, **kwargs):
         return self.addTest(TestCase, *args, **kwargs)
@@ -1528,6 +1901,7 @@ class Application(object):
         self.extras = []
         # Cache all environment files in the whole suite to stop constantly re-reading them
         self.envFiles = {}
+        self.envFileLayers = {}
         self.versions = versions
         self.diag = logging.getLogger("application")
         self.inputOptions = inputOptions
@@ -1765,17 +2139,30 @@ class Application(object):
     def setEnvironment(self, test):
         test.environment.diag.info("Reading environment for " + repr(test))
         envFiles = test.getAllPathNames("environment")
-        allVars = sum((self.readEnvironment(f) for f in envFiles), [])
-        allProps = []
+        expandExternal = self.configObject.expandExternalEnvironment()
+        fileLayer = self.getEnvironmentFileLayer(envFiles, expandExternal)
+        allVars = list(fileLayer.vars)
+        configVars, allProps = [], []
         for suite in test.getAllTestsToRoot():
             vars, props = self.configObject.getConfigEnvironment(suite, allVars)
             allVars += vars
+            configVars += vars
             allProps += props
 
-        test.environment.storeVariables(allVars, self.configObject.expandExternalEnvironment())
+        test.environment.storeVariables(configVars, expandExternal, fileLayer)
         for var, value, propFile in allProps:
             test.addProperty(var, value, propFile)
 
+    def getEnvironmentFileLayer(self, envFiles, expandExternal):
+        # Tests using the same environment files, typically all tests in a suite, share their expansion
+        key = tuple(envFiles), expandExternal
+        layer = self.envFileLayers.get(key)
+        if layer is None:
+            allVars = sum((self.readEnvironment(f) for f in envFiles), [])
+            layer = EnvironmentLayer(allVars, expandExternal)
+            self.envFileLayers[key] = layer
+        return layer
+
     def readEnvironment(self, envFile):
         if envFile in self.envFiles:
             return self.envFiles[envFile]
@@ -1858,7 +2245,7 @@ class Application(object):
         allFiles = []
         for vset in sortedVersionSets:
             allFiles += versionSets[vset]
-        self.diag.info("Files for stem " + stem + " found " + repr(allFiles))
+        self.diag.info("Files for stem %s found %r", stem, allFiles)
         return allFiles
 
     def getRefVersionApplication(self, refVersion):
@@ -1912,6 +2299,9 @@ class Application(object):
                               "Directories to be copied to the sandbox, and merged together")
         self.setConfigDefault("copy_test_path_script", {"default": ""},
                               "Script to use when copying data files, instead of straight copy")
+        self.setConfigDefault("copy_test_path_method", {"default": "copy"},
+                              "How to copy test data files: 'copy', 'clone' (copy-on-write where the file system supports it), " +
+                              "or 'readonly' (as 'clone', otherwise hard link: only for data tests never change)")
         self.setConfigDefault("link_test_path", [], "Paths to be linked from the temp. directory when running tests")
         self.setConfigDefault("test_data_ignore", {"default": []},
                               "Elements under test data structures which should not be viewed or change-monitored")
@@ -2051,7 +2441,7 @@ class Application(object):
 
     def compareForPriority(self, vset1, vset2):
         versionSet = set(self.versions)
-        self.diag.info("Compare " + repr(vset1) + " to " + repr(vset2))
+        self.diag.info("Compare %r to %r", vset1, vset2)
         if len(versionSet) > 0:
             if vset1.issuperset(versionSet):
                 return 1
@@ -2063,20 +2453,20 @@ class Application(object):
         priority2 = self.getVersionSetPriority(vset2)
         # Low number implies higher priority...
         if priority1 != priority2:
-            self.diag.info("Version priority " + repr(priority1) + " vs " + repr(priority2))
+            self.diag.info("Version priority %r vs %r", priority1, priority2)
             return self.cmp(priority2, priority1)
 
         versionCount1 = len(vset1.intersection(explicitVersions))
         versionCount2 = len(vset2.intersection(explicitVersions))
         if versionCount1 != versionCount2:
             # More explicit versions implies higher priority
-            self.diag.info("Version count " + repr(versionCount1) + " vs " + repr(versionCount2))
+            self.diag.info("Version count %r vs %r", versionCount1, versionCount2)
             return self.cmp(versionCount1, versionCount2)
 
         baseVersions = set(self.getBaseVersions())
         baseCount1 = len(vset1.intersection(baseVersions))
         baseCount2 = len(vset2.intersection(baseVersions))
-        self.diag.info("Base count " + repr(baseCount1) + " vs " + repr(baseCount2))
+        self.diag.info("Base count %r vs %r", baseCount1, baseCount2)
         # More base versions implies higher priority.
         return self.cmp(baseCount1, baseCount2)
 